@@ -6,4 +6,11 @@ __author__      = "Graham Klyne (GK@ACM.ORG)"
 __copyright__   = "Copyright 2013-2014, University of Oxford"
 __license__     = "MIT (http://opensource.org/licenses/MIT)"
 
+import os.path
+
+# Sub-command modules are imported when first used (see dipmain), possibly
+# after the current directory has changed, so the package path is made
+# absolute in case it was found through a relative entry in sys.path.
+__path__ = [ os.path.abspath(p) for p in __path__ ]
+
 # End.
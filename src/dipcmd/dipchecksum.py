@@ -0,0 +1,180 @@
+# !/usr/bin/env python
+
+"""
+dipchecksum.py - fixity checksums for files in a deposit information package
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import errno
+import json
+import hashlib
+import logging
+
+from multiprocessing    import Pool
+
+log = logging.getLogger(__name__)
+
+from dipcmd             import diperrors
+from dipcmd.diplocal    import dip_use, file_state, open_dip
+
+CHECKSUMFILE    = "checksums.json"
+READBUFFERSIZE  = 1024*1024
+ALGORITHMS      = ["md5", "sha256"]
+
+def file_digests(p):
+    """
+    Compute digests of a file's content.
+
+    Returns a pair (path, digests), where digests is a dictionary of hex
+    digest values keyed by algorithm name, or None if the file cannot be
+    read (e.g. it is not readable, or has been removed since it was listed).
+    """
+    hashes = dict( (a, hashlib.new(a)) for a in ALGORITHMS )
+    try:
+        with open(p, "rb") as f:
+            while True:
+                buf = f.read(READBUFFERSIZE)
+                if not buf:
+                    break
+                for h in hashes.values():
+                    h.update(buf)
+    except (IOError, OSError) as exc:
+        log.debug("Cannot read %s: %s"%(p, exc))
+        return (p, None)
+    return (p, dict( (a, h.hexdigest()) for (a, h) in hashes.items() ))
+
+def read_checksum_cache(dipdir):
+    """
+    Read the checksum cache for a DIP, returning a dictionary keyed by
+    absolute file path.  Each entry is a dictionary with the file state
+    (see diplocal.file_state) for which the digests were computed, and
+    a digest for each supported algorithm.
+    """
+    try:
+        with open(os.path.join(dipdir, CHECKSUMFILE), "r") as cachefile:
+            return json.load(cachefile)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return {}
+        raise
+    except ValueError:
+        log.warning("Ignoring invalid checksum cache in %s"%(dipdir))
+        return {}
+
+def write_checksum_cache(dipdir, cache):
+    """
+    Write the checksum cache for a DIP, replacing any previous cache.
+    """
+    cachename = os.path.join(dipdir, CHECKSUMFILE)
+    with open(cachename+".tmp", "w") as cachefile:
+        json.dump(cache, cachefile)
+    os.rename(cachename+".tmp", cachename)
+    return
+
+def compute_checksums(dipdir, paths, jobs=1):
+    """
+    Return digests for the indicated files, using cached values where the
+    file is unchanged since the digests were computed.
+
+    dipdir      is a fully qualified DIP directory name, where the checksum
+                cache is kept.
+    paths       is a list of files for which digests are required.
+    jobs        is the number of worker processes used to compute digests
+                that are not cached.
+
+    Returns a dictionary keyed by absolute file path, each value being a
+    dictionary of hex digest values keyed by algorithm name.  Files that
+    cannot be read are omitted, with a message to stderr.
+    """
+    cache    = read_checksum_cache(dipdir)
+    digests  = {}
+    states   = {}
+    pending  = []
+    for p in paths:
+        ap    = os.path.abspath(p)
+        state = file_state(ap)
+        if state is None:
+            print("Cannot access file for checksum: %s"%(ap), file=sys.stderr)
+            continue
+        entry = cache.get(ap)
+        if entry and entry['state'] == state:
+            digests[ap] = dict( (a, entry[a]) for a in ALGORITHMS )
+        else:
+            states[ap] = state
+            pending.append(ap)
+    if pending:
+        if jobs > 1:
+            pool = Pool(jobs)
+            try:
+                results = list(pool.imap_unordered(file_digests, pending, chunksize=16))
+            finally:
+                pool.terminate()
+        else:
+            results = [ file_digests(ap) for ap in pending ]
+        for (ap, ds) in results:
+            if ds is None:
+                print("Cannot read file for checksum: %s"%(ap), file=sys.stderr)
+                continue
+            digests[ap] = ds
+            entry = { 'state': states[ap] }
+            entry.update(ds)
+            cache[ap] = entry
+        write_checksum_cache(dipdir, cache)
+    return digests
+
+def dip_checksum(dipdir, algorithm="sha256", jobs=1):
+    """
+    Compute fixity checksums for files in a deposit information package, and
+    write them to stdout in the format used by md5sum/sha256sum; i.e.
+
+        <hex-digest>  <file-path>
+
+    dipdir      is a fully qualified directory name where a DIP is expected.
+    algorithm   is the digest algorithm to report ("md5" or "sha256").
+    jobs        is the number of worker processes used to compute digests.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    status = dip_use(dipdir, report_dir=False)
+    if status != diperrors.DIP_SUCCESS:
+        return status
+    d       = open_dip(dipdir)
+    paths   = [ df.path for df in d.get_files() ]
+    digests = compute_checksums(dipdir, paths, jobs=jobs)
+    for ap in sorted(digests):
+        print("%s  %s"%(digests[ap][algorithm], ap))
+    if len(digests) != len(paths):
+        return diperrors.DIP_FILEMISSING
+    return diperrors.DIP_SUCCESS
+
+def write_manifests(dipdir, paths, manifestdir, basedir=None, jobs=1):
+    """
+    Write manifest files (manifest-md5.txt, manifest-sha256.txt) listing
+    digests of the indicated files, using cached digests where available.
+
+    dipdir      is a fully qualified DIP directory name.
+    paths       is a list of files to be included in the manifests.
+    manifestdir is the directory where manifest files are written.
+    basedir     if supplied, file paths in the manifests are relative to
+                this directory.
+    jobs        is the number of worker processes used to compute digests.
+
+    Returns the digests used, as returned by compute_checksums.
+    """
+    digests = compute_checksums(dipdir, paths, jobs=jobs)
+    for a in ALGORITHMS:
+        with open(os.path.join(manifestdir, "manifest-%s.txt"%a), "w") as mf:
+            for ap in sorted(digests):
+                mp = os.path.relpath(ap, basedir) if basedir else ap
+                mf.write("%s  %s\n"%(digests[ap][a], mp))
+    return digests
+
+# End.
@@ -16,6 +16,7 @@ import os.path
 import re
 import json
 import errno
+import tempfile
 import logging
 
 log = logging.getLogger(__name__)
@@ -28,6 +29,9 @@ SwordService = namedtuple('SwordService', ['servicedoc_uri', 'collection_uri', '
 
 CONFIGFILE = "dip_config.json"
 
+# Configuration managers, keyed by configuration file name.  See config_manager.
+_config_managers = {}
+
 def strip_quotes(val):
     if val and val.startswith('"') and val.endswith('"'):
         val = val[1:-1]
@@ -46,30 +50,149 @@ def get_dipdir(dip_config, dir):
 def configfilename(configbase):
     return os.path.abspath(os.path.join(configbase, CONFIGFILE))
 
-def readconfig(configbase):
+def default_config():
     """
-    Read configuration in indicated directory and return as a dictionary
+    Return configuration used when no configuration file is present
     """
-    dip_config = (
+    return (
         { "dipbase":  None
         , "dipdir":   None
         })
-    configfile = None
-    try:
-        with open(configfilename(configbase), 'r') as configfile:
-            dip_config = json.load(configfile)
-            # log.debug("readconfig: %s"%(configfilename(configbase)))
-            # log.debug("dip_config: %s"%([dip_config]))
-    except IOError as exc: # Python >2.5
-        if exc.errno == errno.ENOENT:
-            pass    # Ignore file not exists for now
+
+def config_text(config):
+    """
+    Return configuration dictionary formatted as text for the configuration file
+    """
+    return json.dumps(config, indent=4) + "\n"
+
+class ConfigManager(object):
+    """
+    Cached access to the configuration in indicated directory.
+
+    The parsed configuration is held in memory and re-read only when the
+    configuration file's modification time, size or inode changes.  Writes
+    are applied to the in-memory copy and flushed to the file when not
+    deferred (see ConfigSession); the file is replaced atomically, and only
+    if the configuration has changed.
+    """
+
+    def __init__(self, configbase):
+        self._configbase = configbase
+        self._configfile = configfilename(configbase)
+        self._config     = None     # Parsed configuration
+        self._filestat   = None     # File (mtime, size, inode) when last read or written
+        self._savedtext  = None     # File content when last read or written, or None
+        self._pending    = False    # True if written since last flush
+        self._deferred   = 0        # Depth of active ConfigSession scopes
+        return
+
+    def _stat(self):
+        try:
+            st = os.stat(self._configfile)
+        except OSError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _load(self, filestat):
+        try:
+            with open(self._configfile, 'r') as configfile:
+                text = configfile.read()
+        except IOError as exc: # Python >2.5
+            if exc.errno == errno.ENOENT:
+                (self._config, self._savedtext) = (default_config(), None)
+            else:
+                raise
         else:
+            (self._config, self._savedtext) = (json.loads(text), text)
+        self._filestat = filestat
+        self._pending  = False
+        return
+
+    def read(self):
+        """
+        Return configuration dictionary, re-reading the file if it has changed
+        """
+        filestat = self._stat()
+        if self._config is None:
+            self._load(filestat)
+        elif filestat != self._filestat:
+            if self._pending:
+                log.warning("Configuration file changed, keeping unsaved changes: %s"%(self._configfile))
+            else:
+                self._load(filestat)
+        return self._config
+
+    def write(self, config):
+        """
+        Update configuration dictionary, and save it unless writes are deferred
+        """
+        self._config  = config
+        self._pending = True
+        if not self._deferred:
+            self.flush()
+        return
+
+    def dirty(self):
+        """
+        Return True if there are written changes that have not been saved
+        """
+        return self._pending and config_text(self._config) != self._savedtext
+
+    def flush(self):
+        """
+        Save written changes to the configuration file, if there are any.
+
+        The new content is written to a temporary file in the configuration
+        directory, which then replaces the configuration file.
+
+        Returns True if the file was written, otherwise False.
+        """
+        if not self.dirty():
+            self._pending = False
+            return False
+        ensure_config_dir(self._configbase)
+        text = config_text(self._config)
+        (fd, tmpname) = tempfile.mkstemp(
+            dir=os.path.dirname(self._configfile), prefix="."+CONFIGFILE, suffix=".tmp"
+            )
+        try:
+            with os.fdopen(fd, 'w') as configfile:
+                configfile.write(text)
+                configfile.flush()
+                os.fsync(configfile.fileno())
+            os.rename(tmpname, self._configfile)
+        except:
+            os.remove(tmpname)
             raise
-    return dip_config
+        self._filestat  = self._stat()
+        self._savedtext = text
+        self._pending   = False
+        return True
 
-def writeconfig(configbase, config):
+    def begin_session(self):
+        self._deferred += 1
+        return
+
+    def end_session(self):
+        self._deferred -= 1
+        if not self._deferred:
+            self.flush()
+        return
+
+def config_manager(configbase):
     """
-    Write supplied configuration dictionary to indicated directory
+    Return the configuration manager for the indicated directory
+    """
+    configfile = configfilename(configbase)
+    if configfile not in _config_managers:
+        _config_managers[configfile] = ConfigManager(configbase)
+    return _config_managers[configfile]
+
+def ensure_config_dir(configbase):
+    """
+    Ensure that the configuration directory exists
     """
     try:
         os.makedirs(configbase)
@@ -78,22 +201,50 @@ def writeconfig(configbase, config):
             pass
         else:
             raise
-    with open(configfilename(configbase), 'w') as configfile:
-        json.dump(config, configfile, indent=4)
-        configfile.write("\n")
+    return
+
+def readconfig(configbase):
+    """
+    Read configuration in indicated directory and return as a dictionary
+    """
+    return config_manager(configbase).read()
+
+def writeconfig(configbase, config):
+    """
+    Write supplied configuration dictionary to indicated directory
+    """
+    config_manager(configbase).write(config)
     return
 
 def resetconfig(configbase):
     """
     Reset configuration in indicated directory
     """
-    dip_config = (
-        { "dipbase":  None
-        , "dipdir":   None
-        })
-    writeconfig(configbase, dip_config)
+    writeconfig(configbase, default_config())
     return
 
+class ConfigSession(object):
+    """
+    Context handler class that defers writes of the configuration in
+    indicated directory until the end of its scope.
+
+    All commands run in the scope share the cached in-memory configuration,
+    and any changes are written back once on exit.  Nested sessions for the
+    same directory are written back when the outermost session exits.
+    """
+
+    def __init__(self, configbase):
+        self._manager = config_manager(configbase)
+        return
+
+    def __enter__(self):
+        self._manager.begin_session()
+        return
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self._manager.end_session()
+        return False
+
 def dip_show_config_item(config, itemname, prefix="", obscure=False):
     if (itemname in config) and (config[itemname] is not None):
         itemval = config[itemname]
@@ -140,34 +291,49 @@ def dip_get_dip_dir(configbase, filebase, options, default=False):
     dipdir = os.path.join(filebase, dipref)
     return (diperrors.DIP_SUCCESS, dipdir)
 
-def dip_get_service_details(configbase, filebase, options, createnew=False):
-    dip_config     = readconfig(configbase)
-    collection_uri = strip_quotes(options.collection_uri)
+def service_details(
+        configbase, collection_uri, servicedoc_uri=None, username=None, password=None,
+        createnew=False):
+    """
+    Return SWORD service details for a collection, using any details given
+    in place of those configured for it.  Nothing is printed.
+
+    createnew   if True, a collection that is not configured is allowed.
+
+    Returns a pair (status, ss), where ss is a SwordService value, or None
+    if the status is non-zero.
+    """
     if not collection_uri:
-        print("No SWORD collection specified for deposit", file=sys.stderr)
         return (diperrors.DIP_NOCOLLECTION, None)
-    if  ( ('collections'  in dip_config) and 
-          (collection_uri in dip_config['collections']) ):
-        svcinfo = dip_config['collections'][collection_uri]
-        # log.debug("svcinfo for %s: %r"%(collection_uri, dip_config['collections']))
-        ss = SwordService(
-            collection_uri=collection_uri,
-            servicedoc_uri=strip_quotes(options.servicedoc_uri) or svcinfo.get('servicedoc_uri', None),
-            username=strip_quotes(options.username) or svcinfo.get('username', None),
-            password=strip_quotes(options.password) or svcinfo.get('password', None)
-            )
+    collections = readconfig(configbase).get('collections') or {}
+    if collection_uri in collections:
+        svcinfo = collections[collection_uri]
     elif createnew:
-        ss = SwordService(
-            collection_uri=collection_uri,
-            servicedoc_uri=None,
-            username=None,
-            password=None
-            )
+        svcinfo = {}
     else:
-        print("Unknown SWORD collection specified for deposit (use dip config to configure)", file=sys.stderr)
         return (diperrors.DIP_UNKNOWNCOLL, None)
+    ss = SwordService(
+        collection_uri=collection_uri,
+        servicedoc_uri=servicedoc_uri or svcinfo.get('servicedoc_uri', None),
+        username=username or svcinfo.get('username', None),
+        password=password or svcinfo.get('password', None)
+        )
     return (diperrors.DIP_SUCCESS, ss)
 
+def dip_get_service_details(configbase, filebase, options, createnew=False):
+    (status, ss) = service_details(configbase,
+        strip_quotes(options.collection_uri),
+        servicedoc_uri=strip_quotes(options.servicedoc_uri),
+        username=strip_quotes(options.username),
+        password=strip_quotes(options.password),
+        createnew=createnew
+        )
+    if status == diperrors.DIP_NOCOLLECTION:
+        print("No SWORD collection specified for deposit", file=sys.stderr)
+    elif status == diperrors.DIP_UNKNOWNCOLL:
+        print("Unknown SWORD collection specified for deposit (use dip config to configure)", file=sys.stderr)
+    return (status, ss)
+
 def dip_save_service_details(configbase, filebase, ss, dip_config=None):
     collection_uri = ss.collection_uri
     if dip_config is None:
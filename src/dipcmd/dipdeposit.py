@@ -19,71 +19,174 @@ import shutil
 import logging
 import errno
 import json
+import hashlib
+import httplib
+import time
+
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
 import dip
 
 from dipcmd     import diperrors
-from diplocal   import dip_use
+from dipcmd.dipconfig import SwordService
+from diplocal   import dip_use, file_state, find_dips, open_dip
+
+from dipcmd.dipchecksum import write_manifests
+from dipcmd.dippackage  import (
+    SIMPLEZIP, package_filename, package_members, package_fresh, build_zip_package,
+    read_package_index
+    )
+from dipcmd.dipstatus   import StatusStore
+from dipcmd.dipservice  import service_capabilities, collection_accepts_packaging
+from dipcmd.dipthrottle import host_throttle
+from dipcmd.dipsword    import sword_connection, deposit_package, deposit_segments
 
 STATUSFILE = "deposit_status/"
+CHECKPOINTSUFFIX = ".checkpoint"
 
-def dip_package(dipdir, basedir=None, format="http://purl.org/net/sword/package/SimpleZip"):
+def dip_package(dipdir, basedir=None, format=SIMPLEZIP, jobs=1):
     """
     Create package for deposit from DIP contents.  Write name of package file to stdout.
 
+    SimpleZip packages are built by the streaming packager in dippackage,
+    which compresses files in parallel and keeps memory use bounded for
+    large packages.  When re-packaging, only files that have changed since
+    the previous package are compressed, and if nothing has changed the
+    previous package is used as it is.  Other formats are packaged by the
+    dip library.
+
+    Manifests of file checksums (manifest-md5.txt, manifest-sha256.txt) are
+    written alongside the package, using cached checksums where files are
+    unchanged (see dipchecksum).
+
     dipdir  is a fully qualified directory name where a DIP is expected.
     basedir is a base directory used for calculation of relative paths within the package
+    jobs    is the number of worker processes used to compress files and
+            compute checksums
 
     returns zero to indicate success, or a non-zero status code.
     """
     status = dip_use(dipdir, report_dir=False)
     if status != diperrors.DIP_SUCCESS:
         return status
-    d = dip.DIP(dipdir)
+    d = open_dip(dipdir)
     print("Packaging deposit information package at %s"%dipdir)
-    package_info = d.package(package_format=format, basedir=basedir)
-    print(package_info.path)
+    package_path = current_package(d, dipdir, basedir=basedir, format=format, jobs=jobs)
+    print(package_path)
     return diperrors.DIP_SUCCESS
 
+def current_package(d, dipdir, basedir=None, format=SIMPLEZIP, jobs=1):
+    """
+    Return name of a package file reflecting the current DIP contents,
+    building the package only if there is no existing SimpleZip package or
+    any of the files from which it was built have changed.
+
+    d       is a dip.DIP object for the DIP.
+    dipdir  is a fully qualified DIP directory name.
+    basedir is a base directory used for calculation of relative paths within the package
+    format  is the packaging format.
+    jobs    is the number of worker processes used to compress files and
+            compute checksums
+    """
+    if format == SIMPLEZIP:
+        pkgname = package_filename(dipdir, format)
+        members = package_members(d, basedir=basedir)
+        if package_fresh(pkgname, members):
+            log.info("Package is up to date: %s"%(pkgname))
+            return pkgname
+        package_path = build_zip_package(pkgname, members, jobs=jobs)
+    else:
+        package_path = d.package(package_format=format, basedir=basedir).path
+    write_manifests(
+        dipdir, [ df.path for df in d.get_files() ], os.path.dirname(package_path),
+        basedir=basedir, jobs=jobs
+        )
+    return package_path
+
 def dip_deposit(
             configbase, dipdir,
             collection_uri=None, servicedoc_uri=None, username=None, password=None,
-            basedir=None, format="http://purl.org/net/sword/package/SimpleZip"
+            basedir=None, format=SIMPLEZIP, package=None, jobs=1, segment_size=None
             ):
     """
     In initiate deposit (currently completes synchronously, but future versions may
     return before final status of deposit is known).
+
+    If `package` is given, that package file is deposited as it is.  Otherwise
+    a SimpleZip package of the DIP is deposited, re-using the current package
+    if none of the DIP's files have changed since it was built.  Packages in
+    other formats are built and deposited by the dip library.
+
+    If `segment_size` is given, the package is deposited in segments of that
+    size (see dipsword.deposit_segments).  Progress is recorded in a
+    checkpoint file in the deposit status directory, so that if the deposit
+    is interrupted, running it again sends only the segments that have not
+    been acknowledged by the server.
+
+    package      is the name of a prebuilt package file to deposit, or None.
+    jobs         is the number of worker processes used if the DIP is packaged.
+    segment_size is the size in bytes of segments for a resumable deposit,
+                 or None.
     """
-    # @@TODO support deposit from package file or dip(?)
-    if not servicedoc_uri:
-        raise ValueError("@@TODO - service document discovery")
-    if not username:
-        print("No username provided for deposit operation", file=sys.stderr)
-        return diperrors.DIP_NOUSERNAME
-    if not password:
-        print("No password provided for deposit operation", file=sys.stderr)
-        return diperrors.DIP_NOPASSWORD
-    d = dip.DIP(dipdir)
-    # print("Depositing deposit information package at %s"%dipdir)
-    # print("  collection_uri=%s"%collection_uri)
-    # print("  servicedoc_uri=%s"%servicedoc_uri)
-    # print("  username=%s"%username)
-    # print("  password=%s"%password)
-    sss = dip.Endpoint(
-        col_iri=collection_uri, 
-        sd_iri=servicedoc_uri, 
-        username=username,
-        package=format
+    ss = SwordService(
+        collection_uri=collection_uri, servicedoc_uri=servicedoc_uri,
+        username=username, password=password
         )
-    d.set_endpoint(endpoint=sss)
-    # See: https://github.com/CottageLabs/dip/blob/master/tests/test_sss.py#L145
-    cm, dr = d.deposit(sss.id, user_pass=password, basedir=basedir)
-    if cm.response_code not in [200, 201]:
-        print("SWORD deposit failed: %d"%cm.response_code)
-        print(format_CommsMeta(cm))
-        return diperrors.DIP_DEPOSITFAIL
+    (status, token, message) = deposit_dip_to(
+        configbase, dipdir, ss, basedir=basedir, format=format, package=package,
+        jobs=jobs, segment_size=segment_size
+        )
+    if status != diperrors.DIP_SUCCESS:
+        print(message, file=sys.stderr)
+        return status
+    print("token=%s"%(token))
+    return diperrors.DIP_SUCCESS
+
+def deposit_dip_to(
+            configbase, dipdir, ss,
+            basedir=None, format=SIMPLEZIP, package=None, jobs=1, segment_size=None
+            ):
+    """
+    Deposit a DIP (or a prebuilt package) to a SWORD collection, as for
+    dip_deposit, without displaying anything.
+
+    ss      is a SwordService value with details of the collection.
+
+    Returns a triple (status, token, message), where status is zero to
+    indicate success or a non-zero status code, token is the deposit token
+    (or None if the deposit fails), and message describes any failure.
+    """
+    (status, message) = deposit_details_status(configbase, [ss], package, format)
+    if status != diperrors.DIP_SUCCESS:
+        return (status, None, message)
+    d = open_dip(dipdir)
+    # print("Depositing deposit information package at %s"%dipdir)
+    # print("  collection_uri=%s"%ss.collection_uri)
+    # print("  servicedoc_uri=%s"%ss.servicedoc_uri)
+    # print("  username=%s"%ss.username)
+    # print("  password=%s"%ss.password)
+    sss = deposit_endpoint(d, ss, format)
+    if not package and format == SIMPLEZIP:
+        package = current_package(d, dipdir, basedir=basedir, format=format, jobs=jobs)
+    try:
+        if package:
+            (status, dr, message) = deposit_to_collection(
+                configbase, ss, package, format=format, segment_size=segment_size
+                )
+            if status != diperrors.DIP_SUCCESS:
+                return (status, None, message)
+        else:
+            # See: https://github.com/CottageLabs/dip/blob/master/tests/test_sss.py#L145
+            cm, dr = d.deposit(sss.id, user_pass=ss.password, basedir=basedir)
+            if cm.response_code not in [200, 201]:
+                return ( diperrors.DIP_DEPOSITFAIL, None,
+                         "SWORD deposit failed: %d\n%s"%(cm.response_code, format_CommsMeta(cm)) )
+            if receipt_token(dr) is None:
+                return (diperrors.DIP_DEPOSITFAIL, None, receipt_problem(dr))
+    except (IOError, httplib.HTTPException) as e:
+        return (diperrors.DIP_INTERRUPTED, None, "Deposit interrupted (%s)"%(e))
 
     # print("********\n")
     # print(format_CommsMeta(cm))
@@ -93,23 +196,315 @@ def dip_deposit(
 
     # find out the state of the deposit
     # print("******** states:\n")
-    # statement = d.get_repository_statement(sss.id, user_pass=password) # gets a sword2.Statement object
+    # statement = d.get_repository_statement(sss.id, user_pass=ss.password) # gets a sword2.Statement object
     # states = statement.states   # the statement object provides access to the list of states the object is in
     # for term, description in states:
     #     print(term)      # the URI which represents the state the item is in
     #     print(description)   # a human readable description of the state (e.g. "It is in the Archive!")
     # print("********\n")
 
-    # Save deposit receipt for later; use id to construct filename
-    tagauth, container_id, token = dr.id.split('/')
-    drfilename = status_filename(configbase, token)
-    ensure_dir(os.path.dirname(drfilename))
-    with open(drfilename, "w") as drf:
-        drf.write(status_json(token, dr))
+    token = save_deposit_receipt(
+        configbase, dr, collection_uri=ss.collection_uri, dipdir=dipdir,
+        files=package and read_package_index(package) or None
+        )
+    return (diperrors.DIP_SUCCESS, token, None)
+
+def dip_deposit_multiple(
+            configbase, dipdir, services,
+            basedir=None, format=SIMPLEZIP, package=None, jobs=1, segment_size=None
+            ):
+    """
+    Deposit a DIP to several SWORD collections.
+
+    The DIP is packaged once (unless a package file is supplied), and the
+    package is then uploaded to all the collections concurrently.  Each
+    collection has its own DIP endpoint, deposit receipt and token.  The
+    result for each collection is written to stdout as one of:
+
+        collection_uri=<collection-uri> token=<deposit-token>
+        collection_uri=<collection-uri> exit_status=<status>
+
+    services     is a list of SwordService values for the collections.
+    Other parameters are as for `dip_deposit`.
+
+    returns zero if all deposits succeed, or the first non-zero status code.
+    """
+    status = check_deposit_details(configbase, services, package, format)
+    if status != diperrors.DIP_SUCCESS:
+        return status
+    d = open_dip(dipdir)
+    for ss in services:
+        deposit_endpoint(d, ss, format)
+    if not package:
+        package = current_package(d, dipdir, basedir=basedir, format=format, jobs=jobs)
+    def deposit(ss):
+        try:
+            return deposit_to_collection(
+                configbase, ss, package, format=format, segment_size=segment_size
+                )
+        except Exception as e:
+            log.exception("Deposit to %s failed"%(ss.collection_uri))
+            return (diperrors.DIP_DEPOSITFAIL, None, "SWORD deposit failed: %s"%(e))
+    pool = ThreadPool(len(services))
+    try:
+        results = pool.map(deposit, services)
+    finally:
+        pool.terminate()
+    status = diperrors.DIP_SUCCESS
+    files  = read_package_index(package) or None
+    for (ss, (dstatus, dr, message)) in zip(services, results):
+        if dstatus == diperrors.DIP_SUCCESS:
+            token = save_deposit_receipt(
+                configbase, dr, collection_uri=ss.collection_uri, dipdir=dipdir, files=files
+                )
+            print("collection_uri=%s token=%s"%(ss.collection_uri, token))
+        else:
+            print("%s: %s"%(ss.collection_uri, message), file=sys.stderr)
+            print("collection_uri=%s exit_status=%d"%(ss.collection_uri, dstatus))
+            status = status or dstatus
+    return status
+
+def dip_deposit_all(
+            configbase, basedir, services, jobs=1, server_jobs=None, segment_size=None
+            ):
+    """
+    Deposit all DIPs found under a base directory to one or more SWORD
+    collections.
+
+    DIPs are deposited by a pool of `jobs` worker threads.  Each worker
+    packages a DIP (re-using its current package if it is up to date) and
+    deposits it to each of the collections in turn.  If `server_jobs` is
+    given, no more than that many uploads are made to any one server at a
+    time.  A summary table with a line for each DIP and collection, giving
+    the exit status and deposit token, is written to stdout.
+
+    basedir      is the directory under which DIPs are found (see diplocal.find_dips).
+    services     is a list of SwordService values for the collections.
+    jobs         is the number of DIPs deposited concurrently.
+    server_jobs  is the maximum number of concurrent uploads to a server, or None.
+    segment_size is the size in bytes of segments for a resumable deposit,
+                 or None.
+
+    returns zero if all deposits succeed, or the first non-zero status code.
+    """
+    status = check_deposit_details(configbase, services, None)
+    if status != diperrors.DIP_SUCCESS:
+        return status
+    dipdirs = [ d for d in find_dips(basedir) if dip_use(d, report_dir=False) == 0 ]
+    if not dipdirs:
+        print("No deposit information packages found in %s"%(basedir), file=sys.stderr)
+        return diperrors.DIP_NODIPHERE
+    def deposit(dipdir):
+        try:
+            return deposit_dip(
+                configbase, dipdir, services, basedir,
+                max_uploads=server_jobs, segment_size=segment_size
+                )
+        except Exception as e:
+            log.exception("Deposit of %s failed"%(dipdir))
+            return [ (dipdir, ss.collection_uri, diperrors.DIP_DEPOSITFAIL, str(e))
+                     for ss in services ]
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = [ r for rs in pool.imap(deposit, dipdirs) for r in rs ]
+    finally:
+        pool.terminate()
+    rows   = [("DIP", "COLLECTION", "STATUS", "TOKEN")]
+    status = diperrors.DIP_SUCCESS
+    for (dipdir, collection_uri, dstatus, result) in results:
+        token = result
+        if dstatus != diperrors.DIP_SUCCESS:
+            print("%s: %s"%(dipdir, result), file=sys.stderr)
+            token  = "-"
+            status = status or dstatus
+        rows.append((os.path.relpath(dipdir, basedir), collection_uri, str(dstatus), token))
+    widths = [ max(len(r[i]) for r in rows) for i in range(3) ]
+    for r in rows:
+        print("%-*s  %-*s  %*s  %s"%(widths[0], r[0], widths[1], r[1], widths[2], r[2], r[3]))
+    failed = len([ r for r in results if r[2] != diperrors.DIP_SUCCESS ])
+    print("Deposited: %d, failed: %d"%(len(results)-failed, failed))
+    return status
+
+def deposit_dip(configbase, dipdir, services, basedir, max_uploads=None, segment_size=None):
+    """
+    Package a DIP and deposit it to each of the indicated SWORD collections,
+    making no more than `max_uploads` concurrent uploads to any one server
+    if given (see dipthrottle.host_throttle).
+
+    Returns a list of (dipdir, collection_uri, status, result) for each
+    collection, where result is the deposit token or a failure message.
+    """
+    d = open_dip(dipdir)
+    for ss in services:
+        deposit_endpoint(d, ss)
+    package = current_package(d, dipdir, basedir=basedir)
+    results = []
+    for ss in services:
+        (status, dr, message) = deposit_to_collection(
+            configbase, ss, package, segment_size=segment_size, max_uploads=max_uploads
+            )
+        if status == diperrors.DIP_SUCCESS:
+            message = save_deposit_receipt(
+                configbase, dr, collection_uri=ss.collection_uri, dipdir=dipdir,
+                files=read_package_index(package) or None
+                )
+        results.append((dipdir, ss.collection_uri, status, message))
+    return results
+
+def check_deposit_details(configbase, services, package, format=SIMPLEZIP):
+    """
+    Check that details needed for deposit to the indicated services are
+    available, that the package file (if any) exists, and that the
+    collections accept the packaging format according to their (saved)
+    service documents.  A service document that cannot be obtained does not
+    prevent the deposit.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    (status, message) = deposit_details_status(configbase, services, package, format)
+    if status != diperrors.DIP_SUCCESS:
+        print(message, file=sys.stderr)
+    return status
+
+def deposit_details_status(configbase, services, package, format=SIMPLEZIP):
+    """
+    Check details needed for deposit as for check_deposit_details, without
+    displaying any problem found.
+
+    Returns a pair (status, message), where status is zero to indicate
+    success or a non-zero status code, and message describes any problem.
+    """
+    for ss in services:
+        if not ss.servicedoc_uri:
+            raise ValueError("@@TODO - service document discovery")
+        if not ss.username:
+            return (diperrors.DIP_NOUSERNAME, "No username provided for deposit operation")
+        if not ss.password:
+            return (diperrors.DIP_NOPASSWORD, "No password provided for deposit operation")
+    if package and not os.path.isfile(package):
+        return (diperrors.DIP_NOPACKAGE, "Package file not found: %s"%(package))
+    for ss in services:
+        collections = service_capabilities(configbase, ss)
+        if not collection_accepts_packaging(collections, ss.collection_uri, format):
+            return ( diperrors.DIP_BADPACKAGING
+                   , "Collection %s does not accept packaging %s"%(ss.collection_uri, format)
+                   )
+    return (diperrors.DIP_SUCCESS, None)
+
+def deposit_endpoint(d, ss, format=SIMPLEZIP):
+    """
+    Record and return the DIP endpoint for deposit to a SWORD service.
+    """
+    sss = dip.Endpoint(
+        col_iri=ss.collection_uri, 
+        sd_iri=ss.servicedoc_uri, 
+        username=ss.username,
+        package=format
+        )
+    d.set_endpoint(endpoint=sss)
+    return sss
+
+def deposit_to_collection(
+            configbase, ss, package, format=SIMPLEZIP, segment_size=None, max_uploads=None
+            ):
+    """
+    Deposit a package file to a SWORD collection, in segments if
+    `segment_size` is given (see `dip_deposit`).
+
+    Returns a triple (status, receipt, message), where status is zero to
+    indicate success or a non-zero status code, receipt is the final deposit
+    receipt, and message describes any failure.  Requests are limited by
+    any throttle limits configured for the collection, and by `max_uploads`
+    if given (see dipthrottle).
+    """
+    throttle = host_throttle(
+        configbase, ss.collection_uri, ss.servicedoc_uri, max_uploads=max_uploads
+        )
+    conn = sword_connection(ss.servicedoc_uri, ss.username, ss.password, throttle=throttle)
+    if not segment_size:
+        dr = deposit_package(conn, ss.collection_uri, package, format=format)
+        if dr.code not in [200, 201]:
+            return (diperrors.DIP_DEPOSITFAIL, dr, "SWORD deposit failed: %d"%dr.code)
+        if receipt_token(dr) is None:
+            return (diperrors.DIP_DEPOSITFAIL, dr, receipt_problem(dr))
+        return (diperrors.DIP_SUCCESS, dr, None)
+    cpname = checkpoint_filename(configbase, ss.collection_uri, package)
+    checkpoint = read_checkpoint(cpname, ss.collection_uri, package, segment_size)
+    if checkpoint['acknowledged']:
+        print("Resuming deposit of %s (%d segments already deposited)"%
+              (package, len(checkpoint['acknowledged'])), file=sys.stderr)
+    ensure_dir(os.path.dirname(cpname))
+    try:
+        dr = deposit_segments(
+            conn, ss.collection_uri, package, checkpoint,
+            lambda cp: write_checkpoint(cpname, cp)
+            )
+    except (IOError, httplib.HTTPException) as e:
+        return ( diperrors.DIP_INTERRUPTED, None, 
+                 "Deposit interrupted (%s); run the deposit again to resume"%(e) )
+    if dr.code not in [200, 201, 204]:
+        return (diperrors.DIP_DEPOSITFAIL, dr, "SWORD deposit failed: %d"%dr.code)
+    if receipt_token(dr) is None:
+        # Keep the checkpoint, so the receipt is requested again by the next attempt
+        return ( diperrors.DIP_DEPOSITFAIL, dr,
+                 receipt_problem(dr)+"; run the deposit again to retry" )
+    os.remove(cpname)
+    return (diperrors.DIP_SUCCESS, dr, None)
+
+def save_deposit_receipt(configbase, dr, collection_uri=None, dipdir=None, files=None):
+    """
+    Save deposit receipt for later; use id to construct the token.
+
+    files   is the index of the deposited package (see dippackage.read_package_index),
+            used to determine the changes sent by a later update, or None.
+
+    Returns the deposit token.
+    """
+    token = receipt_token(dr)
+    deposit_status = status_info(token, dr, collection_uri=collection_uri, dipdir=dipdir)
+    deposit_status['files'] = files
+    StatusStore(configbase).put(token, deposit_status)
+    return token
+
+def receipt_token(dr):
+    """
+    Return the deposit token from a deposit receipt, or None if the receipt
+    does not have an id from which the token can be obtained.
+    """
     # id has form tag:container@sss/container_id/token
-    # @@TODO: this next statement might be fragile
-    print("token=%s"%(token))
-    return diperrors.DIP_SUCCESS
+    # @@TODO: this might be fragile
+    idparts = (getattr(dr, "id", None) or "").split('/')
+    if len(idparts) != 3 or not idparts[2]:
+        return None
+    return idparts[2]
+
+def receipt_problem(dr):
+    """
+    Return a message describing a deposit receipt without a usable id.
+    """
+    return ( "SWORD deposit receipt has no usable id (status %s): %s"%
+             (getattr(dr, "code", None), getattr(dr, "id", None)) )
+
+def read_deposit_status(configbase, token):
+    """
+    Return saved status information for a deposit as a dictionary, or None
+    if the token is not known.
+    """
+    return StatusStore(configbase).get(token)
+
+def write_deposit_status(configbase, token, deposit_status):
+    """
+    Save updated status information for a deposit, replacing the previous
+    information.
+    """
+    StatusStore(configbase).put(token, deposit_status)
+    return
+
+def saved_tokens(configbase):
+    """
+    Return list of tokens of deposits for which status information is saved.
+    """
+    return StatusStore(configbase).tokens()
 
 def dip_status(configbase, dipdir, token, collection_uri=None):
     """
@@ -117,17 +512,14 @@ def dip_status(configbase, dipdir, token, collection_uri=None):
 
     This command provides a route to future support of asynchronous deposit 
     completion.  For now, it is implemented as a query to a sybnchronously
-    completed deposit operation.
-
-    @@TODO: can we use the token to query the SSS for status of the deposit?
+    completed deposit operation.  See dipwatch.dip_status_watch for a
+    command that queries the server for the state of deposits.
     """
     # Retrieve copy of deposit receipt as dictionary
-    drfilename = status_filename(configbase, token)
-    if not os.path.isfile(drfilename):
+    dr = read_deposit_status(configbase, token)
+    if dr is None:
         print("Unknown deposit token: %s"%token)
         return diperrors.DIP_UNKNOWNTOKEN
-    with open(drfilename) as drf:
-        dr = json.loads(drf.read())
     deposit_status = dr['response_headers']['status']
     if deposit_status not in [200,201]:
         print("Deposit failed: %03d"%deposit_status)
@@ -135,18 +527,64 @@ def dip_status(configbase, dipdir, token, collection_uri=None):
     print(dr['cont_iri'])    # URI of deposited package zip file
     return diperrors.DIP_SUCCESS
 
-def status_filename(configbase, token):
+def checkpoint_filename(configbase, collection_uri, package):
+    """
+    Returns filename for saving progress of a resumable deposit of a package
+    to a collection
+    """
+    key = hashlib.sha1("%s\n%s"%(collection_uri, package)).hexdigest()
+    return os.path.abspath(os.path.join(configbase, STATUSFILE, key+CHECKPOINTSUFFIX))
+
+def read_checkpoint(cpname, collection_uri, package, segment_size):
+    """
+    Return checkpoint for a resumable deposit of a package to a collection
+    (see dipsword.deposit_segments).
+
+    The saved checkpoint is returned if there is one for the same package
+    content and segment size; otherwise a new checkpoint is returned.
     """
-    Returns filename for saving deposit status information
+    checkpoint = (
+        { 'collection_uri':     collection_uri
+        , 'package':            package
+        , 'state':              file_state(package)
+        , 'segment_size':       segment_size
+        , 'acknowledged':       []
+        })
+    try:
+        with open(cpname, "r") as cpf:
+            saved = json.load(cpf)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return checkpoint
+    except ValueError:
+        log.warning("Ignoring invalid deposit checkpoint %s"%(cpname))
+        return checkpoint
+    if ( saved.get('state')        != checkpoint['state'] or
+         saved.get('segment_size') != segment_size ):
+        print("Package changed since interrupted deposit, starting new deposit: %s"%(package),
+              file=sys.stderr)
+        return checkpoint
+    return saved
+
+def write_checkpoint(cpname, checkpoint):
+    """
+    Save checkpoint for a resumable deposit, replacing any previous checkpoint.
     """
-    return os.path.abspath(os.path.join(configbase, STATUSFILE, token))
+    with open(cpname+".tmp", "w") as cpf:
+        json.dump(checkpoint, cpf, indent=2, separators=(',', ': '))
+    os.rename(cpname+".tmp", cpname)
+    return
 
-def status_json(token, dr):
+def status_info(token, dr, collection_uri=None, dipdir=None):
     """
-    Extract status information from depoisit recept as JSON string
+    Extract status information from deposit receipt as a dictionary
     """
-    status = (
+    return (
         { 'token':              token
+        , 'collection_uri':     collection_uri
+        , 'dipdir':             dipdir and os.path.abspath(dipdir)
+        , 'deposited':          time.time()
         , 'title':              dr.title
         , 'id':                 dr.id
         , 'updated':            dr.updated
@@ -158,6 +596,7 @@ def status_json(token, dr):
         , 'alternate':          dr.alternate
         , 'se_iri':             dr.se_iri
         , 'cont_iri':           dr.cont_iri
+        , 'statement':          dr.atom_statement_iri
         # , 'content':            dr.content
         # , 'links':              dr.links
         # , 'metadata':           dr.metadata
@@ -165,7 +604,6 @@ def status_json(token, dr):
         , 'response_headers':   dr.response_headers
         # , 'location':           dr.location
         })
-    return json.dumps(status, indent=2, separators=(',', ': '))
 
 def format_CommsMeta(cm):
     txt    = "CommsMeta("
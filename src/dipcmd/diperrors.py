@@ -30,3 +30,12 @@ DIP_NOPASSWORD      = 76    # No password specified (command line or config?)
 DIP_DEPOSITFAIL     = 77    # Deposit operation rejected by server
 DIP_NOTOKEN         = 78    # No token specified for status query
 DIP_UNKNOWNTOKEN    = 79    # Unknown deposit token
+DIP_CMDFAIL         = 80    # Sub-command failed unexpectedly (batch mode)
+DIP_FILEMISSING     = 81    # File in DIP is missing or cannot be read
+DIP_NOPACKAGE       = 82    # Package file for deposit not found
+DIP_INTERRUPTED     = 83    # Deposit interrupted (can be resumed)
+DIP_BADPACKAGING    = 84    # Packaging format not accepted by collection
+DIP_NOUPDATE        = 85    # Deposit has no saved file list or IRI for update
+DIP_SERVING         = 86    # dip serve is already running
+DIP_NOTSERVING      = 87    # dip serve is not running
+DIP_WATCHINCOMPLETE = 88    # status --watch stopped before all deposits finished
@@ -0,0 +1,271 @@
+# !/usr/bin/env python
+
+"""
+diphttp.py - HTTP layer for SWORD v2 requests that streams request bodies
+
+The default HTTP layer used by the sword2 library reads a file payload into
+memory before sending it.  The layer defined here sends file payloads in
+fixed-size chunks, using chunked transfer encoding, so that memory used for
+a deposit does not depend on the size of the package.
+
+Connections are kept alive and reused for later requests to the same
+server, through a connection pool that is shared by all SWORD operations
+in a process (see `connection_pool`).
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import base64
+import select
+import socket
+import httplib
+import urlparse
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+from sword2.http_layer  import HttpLayer, HttpResponse
+
+from dipcmd.dipthrottle import retry_after
+
+CHUNKSIZE       = 1024*1024     # Size of chunks read from payload and sent
+HTTPTIMEOUT     = 30.0
+MAXIDLE         = 4             # Maximum idle connections kept for each server
+
+# Connection pool shared by HTTP layers that are not given a pool
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP connections, keyed by scheme and server.
+
+    A connection is taken from the pool for each request, and returned when
+    the response has been read unless the server has indicated that it will
+    close the connection.  Idle connections that have been closed by the
+    server are discarded when next taken from the pool.  The pool may be
+    used by several threads.
+    """
+
+    def __init__(self, timeout=HTTPTIMEOUT, maxidle=MAXIDLE):
+        self._timeout = timeout
+        self._maxidle = maxidle
+        self._lock    = threading.Lock()
+        self._idle    = {}      # Idle connections, keyed by (scheme, netloc)
+        self._stats   = { 'created': 0, 'reused': 0, 'discarded': 0, 'requests': 0 }
+        return
+
+    def get(self, scheme, netloc):
+        """
+        Return a connection to the indicated server, re-using an idle
+        connection if one is available.
+        """
+        with self._lock:
+            self._stats['requests'] += 1
+            idle = self._idle.get((scheme, netloc), [])
+            while idle:
+                conn = idle.pop()
+                if not connection_dropped(conn):
+                    self._stats['reused'] += 1
+                    return conn
+                conn.close()
+                self._stats['discarded'] += 1
+            self._stats['created'] += 1
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self._timeout)
+        return httplib.HTTPConnection(netloc, timeout=self._timeout)
+
+    def put(self, scheme, netloc, conn):
+        """
+        Return a connection to the pool after use.
+        """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self._maxidle:
+                idle.append(conn)
+                return
+        self.discard(conn)
+        return
+
+    def discard(self, conn):
+        """
+        Close a connection that cannot be re-used.
+        """
+        conn.close()
+        with self._lock:
+            self._stats['discarded'] += 1
+        return
+
+    def stats(self):
+        """
+        Return dictionary of pool statistics: connections created, reused and
+        discarded, the number of requests made and the number of connections
+        currently idle.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum( len(idle) for idle in self._idle.values() )
+        return stats
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+        return
+
+def connection_pool():
+    """
+    Return the connection pool shared by SWORD operations in this process.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool()
+        return _connection_pool
+
+def connection_dropped(conn):
+    """
+    Return True if an idle connection has been closed by the server (or has
+    unexpected data waiting), and so cannot be used for another request.
+    """
+    if conn.sock is None:
+        return True
+    try:
+        (readable, writable, errors) = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+class StreamingHttpResponse(HttpResponse):
+    """
+    Response from a request, presented as required by the sword2 library:
+    headers are accessed by (lower case) name, and "status" by integer value.
+    """
+
+    def __init__(self, status, headers):
+        self.status  = int(status)
+        self.headers = dict( (h.lower(), v) for (h, v) in headers )
+        return
+
+    def __getitem__(self, att):
+        if att == "status":
+            return self.status
+        return self.headers[att]
+
+    def get(self, att, default=None):
+        if att == "status":
+            return self.status
+        return self.headers.get(att, default)
+
+    def keys(self):
+        return list(self.headers.keys()) + ["status"]
+
+class StreamingHttpLayer(HttpLayer):
+    """
+    sword2 HTTP layer that streams file payloads, using connections from a
+    connection pool (by default, the pool shared by all SWORD operations).
+
+    A payload that is a file-like object is read and sent in chunks of
+    CHUNKSIZE bytes.  If `chunked` is True (the default), the body is sent
+    with chunked transfer encoding; otherwise it is sent with the
+    Content-Length supplied by the caller.  Credentials are sent with every
+    request (preemptive basic authentication), as a streamed body cannot be
+    re-sent in response to an authentication challenge.
+
+    If a `throttle` is given (see dipthrottle.HostThrottle), requests and
+    the data sent are limited as it requires, and a 429 or 503 response
+    pauses further requests for the time given by its Retry-After header.
+    """
+
+    def __init__(self, pool=None, chunked=True, chunksize=CHUNKSIZE, throttle=None):
+        self._pool      = pool or connection_pool()
+        self._chunked   = chunked
+        self._chunksize = chunksize
+        self._throttle  = throttle
+        self._auth      = None
+        return
+
+    def add_credentials(self, username, password):
+        self._auth = "Basic " + base64.b64encode("%s:%s"%(username, password))
+        return
+
+    def request(self, uri, method, headers=None, payload=None):
+        if not self._throttle:
+            return self._request(uri, method, headers, payload)
+        with self._throttle.request(upload=payload is not None):
+            (resp, content) = self._request(uri, method, headers, payload)
+        if resp.status in [429, 503]:
+            self._throttle.pause(retry_after(resp.get('retry-after')))
+        return (resp, content)
+
+    def _request(self, uri, method, headers, payload):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(uri)
+        target  = urlparse.urlunsplit(("", "", path or "/", query, ""))
+        headers = dict(headers or {})
+        if self._auth:
+            headers['Authorization'] = self._auth
+        conn = self._pool.get(scheme, netloc)
+        try:
+            conn.putrequest(method, target, skip_accept_encoding=True)
+            if hasattr(payload, 'read'):
+                if self._chunked:
+                    headers.pop('Content-Length', None)
+                    headers['Transfer-Encoding'] = "chunked"
+                self._send_headers(conn, headers)
+                self._send_stream(conn, payload)
+            else:
+                if payload is not None:
+                    headers['Content-Length'] = str(len(payload))
+                self._send_headers(conn, headers)
+                if payload:
+                    if self._throttle:
+                        self._throttle.transfer(len(payload))
+                    conn.send(payload)
+            resp    = conn.getresponse()
+            content = resp.read()
+        except:
+            self._pool.discard(conn)
+            raise
+        if resp.will_close:
+            self._pool.discard(conn)
+        else:
+            self._pool.put(scheme, netloc, conn)
+        log.debug("%s %s: %d"%(method, uri, resp.status))
+        return (StreamingHttpResponse(resp.status, resp.getheaders()), content)
+
+    def _send_headers(self, conn, headers):
+        for (h, v) in headers.items():
+            conn.putheader(h, v)
+        conn.endheaders()
+        return
+
+    def _send_stream(self, conn, payload):
+        while True:
+            buf = payload.read(self._chunksize)
+            if not buf:
+                break
+            if self._throttle:
+                self._throttle.transfer(len(buf))
+            if self._chunked:
+                conn.send("%x\r\n"%len(buf))
+                conn.send(buf)
+                conn.send("\r\n")
+            else:
+                conn.send(buf)
+        if self._chunked:
+            conn.send("0\r\n\r\n")
+        return
+
+# End.
@@ -18,6 +18,22 @@ import argparse
 import shutil
 import logging
 import errno
+import io
+import json
+import fcntl
+import tempfile
+import threading
+import __builtin__
+
+from multiprocessing.pool   import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir     # Backport for Python < 3.5
+    except ImportError:
+        scandir = None
 
 log = logging.getLogger(__name__)
 
@@ -33,18 +49,31 @@ def dip_create(dipdir):
 
     returns zero to indicate success, or a non-zero status code.
     """
+    (status, message) = create_dip(dipdir)
+    if status != diperrors.DIP_SUCCESS:
+        print(message, file=sys.stderr)
+        return status
+    print("Created deposit information package at %s"%(dipdir))
+    return diperrors.DIP_SUCCESS
+
+def create_dip(dipdir):
+    """
+    Create a deposit information package in the designated directory, as for
+    dip_create, without displaying anything.
+
+    dipdir  is a fully qualified directory name where the DIP is created.
+
+    Returns a pair (status, message), where status is zero if the DIP is
+    created, or a non-zero status code, and message describes any problem.
+    """
     try:
         os.makedirs(dipdir)
     except OSError as exc: # Python >2.5
         if exc.errno == errno.EEXIST:
-            print("Specified directory already exists: %s"%(dipdir), file=sys.stderr)
-            return diperrors.DIP_EXISTS
-        else:
-            print("Error %d creating DIP directory: %s"%(exc.errno, dipdir), file=sys.stderr)
-        return exc.errno
-    d = dip.DIP(dipdir)
-    print("Created deposit information package at %s"%(dipdir))
-    return diperrors.DIP_SUCCESS
+            return (diperrors.DIP_EXISTS, "Specified directory already exists: %s"%(dipdir))
+        return (exc.errno, "Error %d creating DIP directory: %s"%(exc.errno, dipdir))
+    open_dip(dipdir)
+    return (diperrors.DIP_SUCCESS, None)
 
 def dip_use(dipdir, report_dir=True):
     """
@@ -54,20 +83,38 @@ def dip_use(dipdir, report_dir=True):
 
     returns zero to indicate success, or a non-zero status code.
     """
+    (status, message) = dip_check(dipdir)
+    if status != diperrors.DIP_SUCCESS:
+        print(message, file=sys.stderr)
+        return status
+    if report_dir:
+        print(dipdir)
+    return diperrors.DIP_SUCCESS
+
+def dip_check(dipdir):
+    """
+    Check that the designated directory contains a deposit information
+    package.  The DIP is not changed: an interrupted update is recovered by
+    the next update (see DipTransaction).
+
+    dipdir  is a fully qualified directory name where a DIP is expected.
+
+    Returns a pair (status, message), where status is zero if the directory
+    contains a DIP, otherwise a non-zero status code, and message describes
+    the problem found, or is None.
+    """
     if not os.path.isdir(dipdir):
-        print("Specified directory does not exist: %s"%(dipdir), file=sys.stderr)
-        return diperrors.DIP_NOTEXISTS
+        return (diperrors.DIP_NOTEXISTS, "Specified directory does not exist: %s"%(dipdir))
     if  ( not os.path.isfile(os.path.join(dipdir, "deposit.json")) or
           not os.path.isdir(os.path.join(dipdir, "metadata")) or
           not os.path.isdir(os.path.join(dipdir, "history")) or
           not os.path.isdir(os.path.join(dipdir, "packages")) or
           not os.path.isfile(os.path.join(dipdir, "metadata", "dcterms.xml"))
         ):
-        print("Specified directory does not contain a deposit information package: %s"%(dipdir), file=sys.stderr)
-        return diperrors.DIP_NODIPHERE
-    if report_dir:
-        print(dipdir)
-    return diperrors.DIP_SUCCESS
+        return ( diperrors.DIP_NODIPHERE
+               , "Specified directory does not contain a deposit information package: %s"%(dipdir)
+               )
+    return (diperrors.DIP_SUCCESS, None)
 
 def dip_show(dipdir):
     """
@@ -80,7 +127,7 @@ def dip_show(dipdir):
     status = dip_use(dipdir, report_dir=False)
     if status != diperrors.DIP_SUCCESS:
         return status
-    d   = dip.DIP(dipdir)
+    d   = open_dip(dipdir)
     print("Deposit information package at %s"%dipdir)
 
     print("Files:")
@@ -117,12 +164,128 @@ def dip_remove(dipdir):
     if status != diperrors.DIP_SUCCESS:
         return status
     shutil.rmtree(dipdir)
+    forget_dip(dipdir)
     print("Removed deposit information package at %s"%(dipdir))
     return diperrors.DIP_SUCCESS
 
-def dip_visit_files(basedir, filepath, scan, recursive, visitfn):
+def list_dir(dirpath):
+    """
+    List content of a directory
+
+    dirpath     is the directory to be listed
+
+    Returns a pair (files, subdirs) of lists of paths of the files and
+    subdirectories in the directory.  Where `scandir` is available, the file
+    type information returned with each directory entry is used in place of
+    a separate `stat` call for each entry.
+    """
+    files   = []
+    subdirs = []
+    if scandir:
+        for entry in scandir(dirpath):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    else:
+        for f in os.listdir(dirpath):
+            p = os.path.join(dirpath, f)
+            if os.path.isdir(p):
+                subdirs.append(p)
+            else:
+                files.append(p)
+    return (files, subdirs)
+
+def directory_id(dirpath):
+    """
+    Return a value that identifies a directory, however it is referenced:
+    a pair (device, inode), following symbolic links.
     """
-    Recursive helper function to process files and subdirectories
+    st = os.stat(dirpath)
+    return (st.st_dev, st.st_ino)
+
+def find_dips(basedir):
+    """
+    Generator returns directories at or under the indicated base directory
+    that contain a deposit information package file, in sorted order.
+
+    Subdirectories of a DIP are not searched, and symbolic links to
+    directories are not followed.  The directories returned should be
+    checked with `dip_use` before use.
+    """
+    dirs = [basedir]
+    while dirs:
+        dirpath = dirs.pop()
+        if os.path.isfile(os.path.join(dirpath, DIPFILE)):
+            yield dirpath
+            continue
+        try:
+            (files, subdirs) = list_dir(dirpath)
+        except OSError as e:
+            log.warning("Cannot list directory %s: %s"%(dirpath, e))
+            continue
+        dirs.extend(sorted(
+            (d for d in subdirs if not os.path.islink(d)), reverse=True
+            ))
+    return
+
+def walk_files(basedir, filepath, scan, recursive, jobs=1):
+    """
+    Generator returns the files found at a file or directory path
+
+    If a file is specified, that file is returned.
+
+    If a directory is specified, the files it contains are returned if `scan`
+    is True, and files in nested directories if `recursive` is also True.
+    Directories are processed iteratively, one level at a time, so the depth
+    of nesting is not limited by the Python recursion limit.  Symbolic links
+    to directories are followed, but each directory is scanned only once, so
+    that links that form a cycle do not cause an endless scan.
+
+    basedir     is a base directory for resolving relative file references
+    filepath    is a file or directory to be visited
+    scan        is True if the indicated directory is to be scanned
+    recursive   is True if all nested directories are to be scanned
+    jobs        is the number of directories that may be listed concurrently.
+                Values greater than 1 use a thread pool, which can help to
+                hide latency on network file systems.
+    """
+    p = os.path.join(basedir, filepath)
+    if not os.path.isdir(p):
+        yield p
+        return
+    if not scan:
+        return
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        dirs    = [p]
+        visited = set([directory_id(p)])
+        while dirs:
+            if pool:
+                listings = pool.imap(list_dir, dirs)
+            else:
+                listings = (list_dir(d) for d in dirs)
+            subdirs = []
+            for (dirfiles, dirsubdirs) in listings:
+                if recursive:
+                    for d in dirsubdirs:
+                        dirid = directory_id(d)
+                        if dirid in visited:
+                            log.info("Directory already scanned: %s"%(d))
+                            continue
+                        visited.add(dirid)
+                        subdirs.append(d)
+                for f in dirfiles:
+                    yield f
+            dirs = subdirs
+    finally:
+        if pool:
+            pool.terminate()
+    return
+
+def dip_visit_files(basedir, filepath, scan, recursive, visitfn, jobs=1):
+    """
+    Helper function to process files and subdirectories
 
     If a file is specified, the visitor finction is applied to that file.
 
@@ -133,95 +296,412 @@ def dip_visit_files(basedir, filepath, scan, recursive, visitfn):
     scan        is True if the current directory is to be scanned
     recursive   is True if all nested directories are to be scanned
     visitfn     is a visitor function to be applied to each visited file.
+    jobs        is the number of directories that may be listed concurrently.
 
     Returns diperrors.DIP_SUCCESS, or the value from the first visitor function
     call that does not return return diperrors.DIP_SUCCESS.
     """
     # log.debug("dip_visit_files: %s, %s"%(basedir, filepath))
-    p = os.path.join(basedir, filepath)
-    if os.path.isdir(p):
-        if scan:
-            files = os.listdir(p)
-            for f in files:
-                status = dip_visit_files(p, f, recursive, recursive, visitfn)
-                if status != diperrors.DIP_SUCCESS:
-                    break
-    else:
-        status = visitfn(p)
+    status = diperrors.DIP_SUCCESS
+    files  = walk_files(basedir, filepath, scan, recursive, jobs=jobs)
+    try:
+        for p in files:
+            status = visitfn(p)
+            if status != diperrors.DIP_SUCCESS:
+                break
+    finally:
+        files.close()
     return status
 
-def dip_add_files(dipdir, files, recursive=False, basedir=None):
+DIPFILE     = "deposit.json"
+JOURNALFILE = "deposit.json.journal"
+LOCKFILE    = "deposit.json.lock"
+INDEXFILE   = "file_index.json"
+
+# DIP objects opened by this process, keyed by directory; each is saved
+# with the state of its deposit.json when opened
+_dip_handles      = {}
+_dip_handles_lock = threading.Lock()
+
+def open_dip(dipdir):
+    """
+    Return a dip.DIP object for the DIP in the indicated directory.
+
+    Objects are kept for use by later commands in the same process (e.g. a
+    `dip serve` process), and are opened again if the DIP's deposit.json has
+    changed since.
+    """
+    dipdir  = os.path.abspath(dipdir)
+    dipfile = os.path.join(dipdir, DIPFILE)
+    state   = file_state(dipfile)
+    with _dip_handles_lock:
+        (openstate, d) = _dip_handles.get(dipdir, (None, None))
+        if d is None or state is None or state != openstate:
+            d = dip.DIP(dipdir)
+            _dip_handles[dipdir] = (file_state(dipfile), d)
+    return d
+
+def forget_dip(dipdir):
+    """
+    Discard any saved DIP object for the indicated directory, so that it is
+    opened again when next used.
+    """
+    with _dip_handles_lock:
+        _dip_handles.pop(os.path.abspath(dipdir), None)
+    return
+
+# Content written to DIP files during transactions, keyed by file name:
+# None until the file is first written, then the DeferredFile written.
+# While any file is deferred, deferred_open replaces the dip library's
+# `open`; the replaced value (if any) is kept in _deferred_saved_open.
+_deferred_files      = {}
+_deferred_files_lock = threading.Lock()
+_deferred_saved_open = []
+
+class DeferredFile(io.BytesIO):
+    """
+    In-memory file used in place of a DIP's deposit.json while the DIP is
+    updated in a transaction.  The content is kept when the file is closed.
+    """
+
+    def __init__(self, content=""):
+        io.BytesIO.__init__(self, content)
+        self.content = None
+        return
+
+    def value(self):
+        return self.content if self.closed else self.getvalue()
+
+    def close(self):
+        if not self.closed:
+            self.content = self.getvalue()
+        io.BytesIO.close(self)
+        return
+
+def deferred_open(name, mode="r", *args):
+    """
+    Replacement for `open` used by the dip library, which defers writes to
+    files being updated in a transaction (see DipTransaction), and reads
+    their deferred content.  Other files are opened as usual.
+    """
+    filename = os.path.abspath(name)
+    with _deferred_files_lock:
+        if filename in _deferred_files:
+            if "w" in mode:
+                _deferred_files[filename] = DeferredFile()
+                return _deferred_files[filename]
+            if _deferred_files[filename] is not None:
+                return DeferredFile(_deferred_files[filename].value())
+    return __builtin__.open(name, mode, *args)
+
+def defer_writes(filename):
+    """
+    Start deferring writes to a file by the dip library, installing
+    deferred_open in the dip library if no other file is being deferred.
+    """
+    dipmodule = sys.modules[dip.DIP.__module__]
+    with _deferred_files_lock:
+        if not _deferred_files:
+            _deferred_saved_open[:] = [dipmodule.open] if "open" in dipmodule.__dict__ else []
+            dipmodule.open = deferred_open
+        _deferred_files[os.path.abspath(filename)] = None
+    return
+
+def deferred_content(filename):
+    """
+    Stop deferring writes to a file by the dip library, and return the
+    content last written to it, or None if it was not written.  The dip
+    library's `open` is restored when no other file is being deferred.
+    """
+    dipmodule = sys.modules[dip.DIP.__module__]
+    with _deferred_files_lock:
+        f = _deferred_files.pop(os.path.abspath(filename), None)
+        if not _deferred_files:
+            if _deferred_saved_open:
+                dipmodule.open = _deferred_saved_open.pop()
+            else:
+                dipmodule.__dict__.pop("open", None)
+    return f and f.value()
+
+class DipTransaction(object):
+    """
+    Context handler class that makes a group of changes to a DIP atomic.
+
+    On entry, an exclusive lock is taken on the DIP, and held until the
+    changes are complete, so that other processes' transactions wait.  Then
+    any interrupted transaction is recovered (see dip_recover), and the DIP's
+    deposit.json is copied to a journal file alongside it, with the process
+    id of the transaction.
+
+    While the transaction is active, the dip library's `open` is replaced
+    (see defer_writes), so that its saves of deposit.json are kept in memory, and the last is written once, replacing deposit.json,
+    when the changes are complete; the journal is then removed.  If the
+    changes fail, deposit.json is unchanged (or, if the dip library wrote it
+    directly, is restored from the journal).  If the process is interrupted,
+    the journal is left in place, and is used to restore the DIP by the next
+    transaction.
+    """
+
+    def __init__(self, dipdir):
+        self._dipdir      = dipdir
+        self._dipfile     = os.path.join(dipdir, DIPFILE)
+        self._journalfile = os.path.join(dipdir, JOURNALFILE)
+        self._lockfile    = os.path.join(dipdir, LOCKFILE)
+        self._lock        = None
+        return
+
+    def __enter__(self):
+        self._lock = open(self._lockfile, "a")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            dip_recover(self._dipdir)
+            with open(self._dipfile, "rb") as dipfile:
+                journal = { 'pid': os.getpid(), 'deposit': dipfile.read() }
+            tmpname = self._journalfile+".tmp"
+            with open(tmpname, "wb") as journalfile:
+                json.dump(journal, journalfile)
+            os.rename(tmpname, self._journalfile)
+        except:
+            self._unlock()
+            raise
+        defer_writes(self._dipfile)
+        return
+
+    def __exit__(self, exctype, excval, exctraceback):
+        try:
+            content = deferred_content(self._dipfile)
+            if exctype is None:
+                if content is not None:
+                    with open(self._dipfile+".tmp", "wb") as dipfile:
+                        dipfile.write(content)
+                    os.rename(self._dipfile+".tmp", self._dipfile)
+                os.remove(self._journalfile)
+            else:
+                restore_journal(self._dipdir)
+        finally:
+            self._unlock()
+        return False
+
+    def _unlock(self):
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+        self._lock = None
+        return
+
+def restore_journal(dipdir):
+    """
+    Restore a DIP's deposit.json from its journal, and remove the journal.
+    """
+    journalfile = os.path.join(dipdir, JOURNALFILE)
+    with open(journalfile, "rb") as f:
+        journal = json.load(f)
+    dipfile = os.path.join(dipdir, DIPFILE)
+    with open(dipfile+".tmp", "wb") as f:
+        f.write(journal['deposit'].encode("utf-8"))
+    os.rename(dipfile+".tmp", dipfile)
+    os.remove(journalfile)
+    forget_dip(dipdir)
+    return
+
+def dip_recover(dipdir):
+    """
+    Restore a DIP whose last update was interrupted, if necessary.  This is
+    called by DipTransaction while holding the DIP's lock, so a journal that
+    is present was left by a transaction that did not complete, and is
+    always used.
+
+    dipdir  is a fully qualified directory name where a DIP is expected.
+
+    returns True if the DIP was restored, otherwise False.
+    """
+    journalfile = os.path.join(dipdir, JOURNALFILE)
+    if not os.path.isfile(journalfile):
+        return False
+    try:
+        restore_journal(dipdir)
+    except (ValueError, KeyError, AttributeError):
+        # Journals are complete when renamed into place, so this is not ours
+        log.warning("Ignoring invalid journal in %s"%(dipdir))
+        return False
+    print("Restored deposit information package after interrupted update: %s"%(dipdir), file=sys.stderr)
+    return True
+
+def file_state(p):
+    """
+    Return state of a file recorded in the DIP file index, as a list
+    [size, mtime, inode], or None if the file cannot be accessed.
+    """
+    try:
+        st = os.stat(p)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+def read_file_index(dipdir):
+    """
+    Read the file state index for a DIP, returning a dictionary keyed by
+    absolute file path.  An empty dictionary is returned if there is no index.
+    """
+    try:
+        with open(os.path.join(dipdir, INDEXFILE), "r") as indexfile:
+            return json.load(indexfile)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return {}
+        raise
+    except ValueError:
+        log.warning("Ignoring invalid file index in %s"%(dipdir))
+        return {}
+
+def write_file_index(dipdir, index):
+    """
+    Write the file state index for a DIP, replacing any previous index.
+    """
+    (fd, tmpname) = tempfile.mkstemp(dir=dipdir, prefix=INDEXFILE, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as indexfile:
+            json.dump(index, indexfile)
+        os.rename(tmpname, os.path.join(dipdir, INDEXFILE))
+    except:
+        os.remove(tmpname)
+        raise
+    return
+
+def collect_files(basedir, files, recursive, jobs=1):
+    """
+    Collect the files to be added to or removed from a DIP
+
+    basedir     is a base directory for resolving relative file references
+    files       is a list of files/directories to be visited
+    recursive   True if directories encountered are to be scanned recursively
+    jobs        is the number of directories that may be listed concurrently
+
+    Returns a list of the files visited, without duplicates, in the order
+    they are first visited.
+    """
+    seen  = set()
+    paths = []
+    for f in files:
+        for p in walk_files(basedir, f, True, recursive, jobs=jobs):
+            if p not in seen:
+                seen.add(p)
+                paths.append(p)
+    return paths
+
+def dip_add_files(dipdir, files, recursive=False, basedir=None, jobs=1):
     """
     Add files to a deposit information package.  E.g.
 
         dip [--recursive] [--dip=<directory>] add-file file ...
 
+    The files to be added are collected before the DIP is changed, and then
+    added in a single DipTransaction, so that the DIP is either unchanged or
+    fully updated, and its deposit.json is written once.
+
+    The size, modification time and inode of each file added are recorded in
+    an index in the DIP directory.  Files already in the DIP whose recorded
+    state is unchanged are skipped, and only new or changed files are listed.
+
     dipdir      is a fully qualified DIP directory name
     files       is a list of files/directories to be added
     recursive   True if directories encountered are to be scanned recursively
                 (otherwise) explicitly-mentioned directories are scanned
                 just one level down.
     basedir     is a base directory for resolving relative file references
+    jobs        is the number of directories that may be listed concurrently
 
     returns zero to indicate success, or a non-zero status code.
     """
     status = dip_use(dipdir, report_dir=False)
     if status != diperrors.DIP_SUCCESS:
         return status
-    if not basedir:
-        basedir = os.getcwd()
     print("Adding files to deposit information package at %s ..."%(dipdir))
-    d   = dip.DIP(dipdir)
-    for f in files:
-        # -- visitor function
-        def dip_set_file(p):
-            d.set_file(p)
-            print("  %s"%p)
-            return diperrors.DIP_SUCCESS
-        # --
-        status = dip_visit_files(basedir, f, True, recursive, dip_set_file)
-        if status != diperrors.DIP_SUCCESS:
-            break
+    (added, unchanged) = add_dip_files(dipdir, files, recursive=recursive, basedir=basedir, jobs=jobs)
+    for p in added:
+        print("  %s"%p)
+    if unchanged:
+        print("Unchanged files skipped: %d"%(unchanged))
     if len(files) > 1 or recursive:
         print("Done.")
     return status
 
-def dip_remove_files(dipdir, files, recursive=False, basedir=None):
+def add_dip_files(dipdir, files, recursive=False, basedir=None, jobs=1):
+    """
+    Add files to a deposit information package, as for dip_add_files, without
+    displaying them.
+
+    Returns a pair (added, unchanged), where added is a list of the files
+    added and unchanged is the number of files skipped because they are
+    already in the DIP and unchanged.
+    """
+    paths     = collect_files(basedir or os.getcwd(), files, recursive, jobs=jobs)
+    added     = []
+    unchanged = 0
+    with DipTransaction(dipdir):
+        index = read_file_index(dipdir)
+        d = open_dip(dipdir)
+        dippaths = set(os.path.abspath(df.path) for df in d.get_files())
+        for p in paths:
+            ap    = os.path.abspath(p)
+            state = file_state(ap)
+            if state and ap in dippaths and index.get(ap) == state:
+                unchanged += 1
+                continue
+            d.set_file(p)
+            index[ap] = state
+            added.append(p)
+        write_file_index(dipdir, index)
+    return (added, unchanged)
+
+def dip_remove_files(dipdir, files, recursive=False, basedir=None, jobs=1):
     """
     Remove files from a deposit information package.  E.g.
 
         dip [--recursive] [--dip=<directory>] remove-file file ...
 
+    The files to be removed are collected before the DIP is changed, and then
+    removed in a single DipTransaction.  Files that are not in the DIP are
+    skipped.
+
     dipdir      is a fully qualified DIP directory name
     files       is a list of files/directories to be removed from the DIP
     recursive   True if directories encountered are to be scanned recursively
                 (otherwise) explicitly-mentioned directories are scanned
                 just one level down.
     basedir     is a base directory for resolving relative file references
+    jobs        is the number of directories that may be listed concurrently
 
     returns zero to indicate success, or a non-zero status code.
     """
     status = dip_use(dipdir, report_dir=False)
     if status != diperrors.DIP_SUCCESS:
         return status
-    if not basedir:
-        basedir = os.getcwd()
     print("Removing files from deposit information package at %s ..."%(dipdir))
-    d   = dip.DIP(dipdir)
-    for f in files:
-        # -- visitor function
-        def dip_remove_file(p):
-            d.remove_file(p)
-            print("  %s"%p)
-            return diperrors.DIP_SUCCESS
-        # --
-        status = dip_visit_files(basedir, f, True, recursive, dip_remove_file)
-        if status != diperrors.DIP_SUCCESS:
-            break
+    for p in remove_dip_files(dipdir, files, recursive=recursive, basedir=basedir, jobs=jobs):
+        print("  %s"%p)
     if len(files) > 1 or recursive:
         print("Done.")
     return status
 
+def remove_dip_files(dipdir, files, recursive=False, basedir=None, jobs=1):
+    """
+    Remove files from a deposit information package, as for dip_remove_files,
+    without displaying them.
+
+    Returns a list of the files collected for removal.
+    """
+    paths = collect_files(basedir or os.getcwd(), files, recursive, jobs=jobs)
+    with DipTransaction(dipdir):
+        index = read_file_index(dipdir)
+        d = open_dip(dipdir)
+        dippaths = set(os.path.abspath(df.path) for df in d.get_files())
+        for p in paths:
+            if os.path.abspath(p) in dippaths:
+                d.remove_file(p)
+            index.pop(os.path.abspath(p), None)
+        write_file_index(dipdir, index)
+    return paths
+
 def _check_attribute_name(aname):
     """
     Check attribute name, returning either a properties dictionary or None
@@ -252,7 +732,7 @@ def dip_set_attributes(dipdir, attrs):
     if status != diperrors.DIP_SUCCESS:
         return status
     print("Adding attributes to deposit information package at %s ..."%(dipdir))
-    d = dip.DIP(dipdir)
+    d = open_dip(dipdir)
     for attr in attrs:
         #                            1    2      3 4     5
         attrvalre    = re.compile(r'^(\w+:(\w+))=("(.*)"|(.*))$')
@@ -285,7 +765,7 @@ def dip_show_attributes(dipdir, attrs):
     status = dip_use(dipdir, report_dir=False)
     if status != diperrors.DIP_SUCCESS:
         return status
-    d = dip.DIP(dipdir)
+    d = open_dip(dipdir)
     for attr in attrs:
         #                            1    2
         attrvalre    = re.compile(r'^(\w+:(\w+))$')
@@ -316,7 +796,7 @@ def dip_remove_attributes(dipdir, attrs):
     if status != diperrors.DIP_SUCCESS:
         return status
     print("Removing attributes from deposit information package at %s ..."%(dipdir))
-    d = dip.DIP(dipdir)
+    d = open_dip(dipdir)
     for attr in attrs:
         #                            1    2
         attrvalre    = re.compile(r'^(\w+:(\w+))$')
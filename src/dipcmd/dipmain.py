@@ -14,6 +14,7 @@ import os
 import os.path
 import re
 import argparse
+import shlex
 import logging
 import errno
 
@@ -23,29 +24,31 @@ if __name__ == "__main__":
     p = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     sys.path.insert(0, p)
 
+# Modules that implement sub-commands, and through them the dip and sword2
+# libraries, are imported by the sub-commands that use them (see `run`), so
+# that commands that only use the configuration, and --help and --version,
+# start without loading them.
 from dipcmd             import diperrors
 from dipcmd.dipconfig   import dip_get_dip_dir, dip_set_default_dir
 from dipcmd.dipconfig   import dip_get_service_details, dip_set_service_details, dip_save_service_details
-from dipcmd.dipconfig   import dip_show_config
-from dipcmd.diplocal    import dip_create, dip_use, dip_show, dip_remove
-from dipcmd.diplocal    import dip_add_files, dip_remove_files
-from dipcmd.diplocal    import dip_set_attributes, dip_show_attributes, dip_remove_attributes
-from dipcmd.dipdeposit  import dip_package, dip_deposit, dip_status
+from dipcmd.dipconfig   import dip_show_config, ConfigSession, strip_quotes
 
 VERSION = "0.1"
 
 def progname(args):
     return os.path.basename(args[0])
 
-def parseCommandArgs(argv):
-    """
-    Parse command line arguments
-
-    argv            argument list from command line
+# Command line parser, constructed on first use and then reused for
+# subsequent commands (e.g. in batch mode)
+_command_parser = None
 
-    Returns a pair consisting of options specified as returned by
-    OptionParser, and any remaining unparsed arguments.
+def commandParser():
+    """
+    Return parser for command line arguments, creating it if needed
     """
+    global _command_parser
+    if _command_parser:
+        return _command_parser
     # create a parser for the command line options
     parser = argparse.ArgumentParser(
                 description="Create, manipulate or submit deposit information package",
@@ -62,11 +65,14 @@ def parseCommandArgs(argv):
     parser.add_argument("-p", "--package",
                         dest="package", metavar="PACKAGE",
                         default=None,
-                        help="Package for deposit (or other operation...)")
+                        help="Prebuilt package file for deposit; if not given, the DIP is "+
+                             "packaged unless its current package is up to date")
     parser.add_argument("-c", "--collection_uri",
-                        dest="collection_uri", metavar="COLLECTON_URI",
+                        action="append",
+                        dest="collection_uris", metavar="COLLECTON_URI",
                         default=None,
-                        help="Collection URI for deposit")
+                        help="Collection URI for deposit (may be repeated to deposit "+
+                             "to several collections)")
     parser.add_argument("-s", "--servicedoc_uri",
                         dest="servicedoc_uri", metavar="SERVICEDOC_URI",
                         default=None,
@@ -80,14 +86,93 @@ def parseCommandArgs(argv):
                         default=None,
                         help="Password to use for deposit (saved per-collection)")
     parser.add_argument("-t", "--token",
-                        dest="token", metavar="DEPOSIT_TOKEN",
+                        action="append",
+                        dest="tokens", metavar="DEPOSIT_TOKEN",
+                        default=None,
+                        help="SWORD deposit token (for status and update commands; may be "+
+                             "repeated with status --watch)")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        dest="watch",
+                        default=False,
+                        help="Poll the server until the deposits have completed "+
+                             "(status command; all saved deposits if no token is given)")
+    parser.add_argument("--defer",
+                        action="store_true",
+                        dest="defer",
+                        default=False,
+                        help="Package the DIP and add the deposit to the outbox, to be sent "+
+                             "by the drain command (deposit command)")
+    parser.add_argument("--retry_delay",
+                        dest="retry_delay", metavar="SECONDS",
+                        type=float, default=None,
+                        help="Delay before first retry of a failed deposit, doubled for each "+
+                             "later retry (drain command)")
+    parser.add_argument("--max_attempts",
+                        dest="max_attempts", metavar="ATTEMPTS",
+                        type=int, default=None,
+                        help="Number of attempts before a deposit is dead-lettered (drain command)")
+    parser.add_argument("--requeue",
+                        action="store_true",
+                        dest="requeue",
+                        default=False,
+                        help="Retry dead-lettered deposits (drain command)")
+    parser.add_argument("--stop",
+                        action="store_true",
+                        dest="stop",
+                        default=False,
+                        help="Stop the running dip serve process (serve command)")
+    parser.add_argument("--list",
+                        action="store_true",
+                        dest="list",
+                        default=False,
+                        help="List saved deposits (status command; may be selected by "+
+                             "--collection_uri, --dip, --since, --until and --http_status)")
+    parser.add_argument("--since",
+                        dest="since", metavar="DATE",
+                        default=None,
+                        help="List deposits made on or after this date (YYYY-MM-DD, UTC)")
+    parser.add_argument("--until",
+                        dest="until", metavar="DATE",
                         default=None,
-                        help="SWORD deposit token (for status command)")
+                        help="List deposits made on or before this date (YYYY-MM-DD, UTC)")
+    parser.add_argument("--http_status",
+                        dest="http_status", metavar="STATUS",
+                        type=int, default=None,
+                        help="List deposits whose response had this HTTP status code")
+    parser.add_argument("--poll_interval",
+                        dest="poll_interval", metavar="SECONDS",
+                        type=float, default=None,
+                        help="Initial interval between polls of each deposit (status --watch)")
+    parser.add_argument("--timeout",
+                        dest="timeout", metavar="SECONDS",
+                        type=float, default=None,
+                        help="Maximum time to watch deposits (status --watch)")
     parser.add_argument("-r", "--recursive",
                         action="store_true", 
                         dest="recursive", 
                         default=False,
                         help="Add or remove files recursively (i.e. scan subdirectories)")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs", metavar="JOBS",
+                        type=int, default=1,
+                        help="Number of concurrent jobs (e.g. directories listed by add-files, "+
+                             "DIPs deposited by deposit-all, deposits sent by drain, "+
+                             "deposits polled by status --watch)")
+    parser.add_argument("-a", "--algorithm",
+                        dest="algorithm", metavar="ALGORITHM",
+                        choices=["md5", "sha256"], default="sha256",
+                        help="Checksum algorithm to report (for checksum command: md5 or sha256)")
+    parser.add_argument("--segment_size",
+                        dest="segment_size", metavar="MB",
+                        type=int, default=None,
+                        help="Deposit package in segments of this many megabytes; "+
+                             "an interrupted deposit can then be resumed by running it again")
+    parser.add_argument("--server_jobs",
+                        dest="server_jobs", metavar="JOBS",
+                        type=int, default=None,
+                        help="Maximum number of concurrent uploads to any one server "+
+                             "(deposit-all command)")
     parser.add_argument("--debug",
                         action="store_true", 
                         dest="debug", 
@@ -99,7 +184,7 @@ def parseCommandArgs(argv):
                              "create, use, show, remove-dip, "+
                              "add-files, add-metadata, remove-file, "+
                              "add-attribute, show-attribute, remove-attribute, "+
-                             "package, deposit, status"
+                             "checksum, package, deposit, deposit-all, drain, update, status, batch, serve"
                        )
     parser.add_argument("files", metavar="FILES_OR_ATTRIBUTES",
                         nargs="*",
@@ -108,16 +193,55 @@ def parseCommandArgs(argv):
                              "Zero, one or more attribute-value pairs that are added to a DIP "+
                              "(add-attributes sub-command only).\n"+
                              "Zero, one or more attribute names that are displayed or removed from a DIP "+
-                             "(show-attributes or remove-attributes sub-commands only)."
+                             "(show-attributes or remove-attributes sub-commands only).\n"+
+                             "Zero, one or more files of commands to run, or '-' for standard input "+
+                             "(batch sub-command only)."
                         )
+    _command_parser = parser
+    return parser
+
+def parseCommandArgs(argv):
+    """
+    Parse command line arguments
+
+    argv            argument list from command line
+
+    Returns a pair consisting of options specified as returned by
+    OptionParser, and any remaining unparsed arguments.
+    """
+    parser  = commandParser()
     # parse command line now
     options = parser.parse_args(argv)
+    # Commands other than deposit use the last collection URI given
+    options.collection_uri = options.collection_uris[-1] if options.collection_uris else None
+    options.token          = options.tokens[-1] if options.tokens else None
     if options and options.command:
         return options
     print("No valid usage option given.", file=sys.stderr)
     parser.print_usage()
     return None
 
+def get_services(configbase, filebase, options):
+    """
+    Return details of the SWORD services for each (distinct) collection URI
+    given in the command options.
+
+    Returns a pair (status, services), where status is zero to indicate
+    success or a non-zero status code, and services is a list of
+    SwordService values.
+    """
+    services = []
+    for collection_uri in (options.collection_uris or [None]):
+        if collection_uri in [ ss.collection_uri for ss in services ]:
+            continue
+        options.collection_uri = collection_uri
+        (status, ss) = dip_get_service_details(configbase, filebase, options)
+        log.info("ss: %r"%([ss]))
+        if status != diperrors.DIP_SUCCESS:
+            return (status, None)
+        services.append(ss)
+    return (diperrors.DIP_SUCCESS, services)
+
 def run(configbase, filebase, options, progname):
     """
     Command line tool to create and submit deposit information packages
@@ -137,6 +261,7 @@ def run(configbase, filebase, options, progname):
             status = dip_set_default_dir(configbase, filebase, dipdir, display=True)
 
     elif options.command == "create":
+        from dipcmd.diplocal import dip_create
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options)
         if status == 0:
             status = dip_create(dipdir)
@@ -144,6 +269,7 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command == "use":
+        from dipcmd.diplocal import dip_use
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             status = dip_use(dipdir)
@@ -151,6 +277,7 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command == "show":
+        from dipcmd.diplocal import dip_show
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             status = dip_show(dipdir)
@@ -158,6 +285,7 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command == "remove":
+        from dipcmd.diplocal import dip_remove
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=False)
         if status == 0:
             status = dip_remove(dipdir)
@@ -165,13 +293,16 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, None)
 
     elif options.command in ["add-file","add-files"]:
+        from dipcmd.diplocal import dip_add_files
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             if not options.files:
                 print("No files specified for add_files to %s"%dipdir, file=sys.stderr)
                 status = diperrors.DIP_NOFILES
             else:
-                status = dip_add_files(dipdir, options.files, recursive=options.recursive)
+                status = dip_add_files(
+                    dipdir, options.files, recursive=options.recursive, jobs=options.jobs
+                    )
         if status == 0:
             dip_set_default_dir(configbase, filebase, dipdir)
 
@@ -179,17 +310,21 @@ def run(configbase, filebase, options, progname):
         raise NotImplementedError("@@TODO add-metadata")
 
     elif options.command in  ["remove-file", "remove-files", "remove-metadata"]:
+        from dipcmd.diplocal import dip_remove_files
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             if not options.files:
                 print("No files specified for remove-file from %s"%dipdir, file=sys.stderr)
                 status = diperrors.DIP_NOFILES
             else:
-                status = dip_remove_files(dipdir, options.files, recursive=options.recursive)
+                status = dip_remove_files(
+                    dipdir, options.files, recursive=options.recursive, jobs=options.jobs
+                    )
         if status == 0:
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command in ["add-attribute", "add-attributes"]:
+        from dipcmd.diplocal import dip_set_attributes
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             if not options.files:
@@ -201,6 +336,7 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command in ["show-attribute", "show-attributes"]:
+        from dipcmd.diplocal import dip_show_attributes
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             if not options.files:
@@ -212,6 +348,7 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command in ["remove-attribute", "remove-attributes"]:
+        from dipcmd.diplocal import dip_remove_attributes
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             if not options.files:
@@ -222,32 +359,123 @@ def run(configbase, filebase, options, progname):
         if status == 0:
             dip_set_default_dir(configbase, filebase, dipdir)
 
+    elif options.command == "checksum":
+        from dipcmd.dipchecksum import dip_checksum
+        (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
+        if status == 0:
+            status = dip_checksum(dipdir, algorithm=options.algorithm, jobs=options.jobs)
+        if status == 0:
+            dip_set_default_dir(configbase, filebase, dipdir)
+
     elif options.command == "package":
+        from dipcmd.dipdeposit import dip_package
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             # @@TODO: add format option
-            status = dip_package(dipdir, basedir=os.getcwd())
+            status = dip_package(dipdir, basedir=os.getcwd(), jobs=options.jobs)
         if status == 0:
             dip_set_default_dir(configbase, filebase, dipdir)
 
     elif options.command == "deposit":
+        from dipcmd.dipdeposit import dip_deposit, dip_deposit_multiple
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
-            (status, ss) = dip_get_service_details(configbase, filebase, options)
-            log.info("ss: %r"%([ss]))
+            (status, services) = get_services(configbase, filebase, options)
         if status == 0:
             # @@TODO: add format option
-            status = dip_deposit(
-                configbase, dipdir, 
-                collection_uri=ss.collection_uri, servicedoc_uri=ss.servicedoc_uri, 
-                username=ss.username, password=ss.password,
-                basedir=os.getcwd()
+            package      = strip_quotes(options.package)
+            package      = package and os.path.abspath(package)
+            segment_size = options.segment_size and options.segment_size*1024*1024
+            if options.defer:
+                from dipcmd.dipoutbox import dip_deposit_defer
+                status = dip_deposit_defer(
+                    configbase, dipdir, services,
+                    basedir=os.getcwd(), package=package,
+                    jobs=options.jobs, segment_size=segment_size
+                    )
+            elif len(services) == 1:
+                ss     = services[0]
+                status = dip_deposit(
+                    configbase, dipdir, 
+                    collection_uri=ss.collection_uri, servicedoc_uri=ss.servicedoc_uri, 
+                    username=ss.username, password=ss.password,
+                    basedir=os.getcwd(), package=package,
+                    jobs=options.jobs, segment_size=segment_size
+                    )
+            else:
+                status = dip_deposit_multiple(
+                    configbase, dipdir, services,
+                    basedir=os.getcwd(), package=package,
+                    jobs=options.jobs, segment_size=segment_size
+                    )
+        if status == 0:
+            dip_set_default_dir(configbase, filebase, dipdir)
+            for ss in services:
+                dip_save_service_details(configbase, filebase, ss)
+
+    elif options.command == "deposit-all":
+        from dipcmd.dipdeposit import dip_deposit_all
+        basedir  = os.path.join(filebase, strip_quotes(options.dip)) if options.dip else filebase
+        (status, services) = get_services(configbase, filebase, options)
+        if status == 0:
+            status = dip_deposit_all(
+                configbase, basedir, services,
+                jobs=options.jobs, server_jobs=options.server_jobs,
+                segment_size=options.segment_size and options.segment_size*1024*1024
+                )
+        if status == 0:
+            for ss in services:
+                dip_save_service_details(configbase, filebase, ss)
+
+    elif options.command == "drain":
+        from dipcmd.dipoutbox import dip_drain, RETRYDELAY, MAXATTEMPTS
+        status = dip_drain(
+            configbase, jobs=options.jobs,
+            retry_delay=options.retry_delay or RETRYDELAY,
+            max_attempts=options.max_attempts or MAXATTEMPTS,
+            requeue=options.requeue
+            )
+
+    elif options.command == "update":
+        from dipcmd.dipupdate import dip_update
+        (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
+        if status == 0:
+            token = options.token
+            if not token:
+                print("No token specified for update %s"%dipdir, file=sys.stderr)
+                status = diperrors.DIP_NOTOKEN
+        if status == 0:
+            status = dip_update(
+                configbase, dipdir, token,
+                username=strip_quotes(options.username), password=strip_quotes(options.password),
+                basedir=os.getcwd(), jobs=options.jobs
                 )
         if status == 0:
             dip_set_default_dir(configbase, filebase, dipdir)
-            dip_save_service_details(configbase, filebase, ss)
+
+    elif options.command == "status" and options.list:
+        from dipcmd.dipstatus import dip_status_list
+        dipdir = None
+        if options.dip:
+            dipdir = os.path.abspath(os.path.join(filebase, strip_quotes(options.dip)))
+        status = dip_status_list(
+            configbase, collection_uris=[ strip_quotes(c) for c in options.collection_uris or [] ],
+            dipdir=dipdir, since=options.since, until=options.until,
+            http_status=options.http_status
+            )
+
+    elif options.command == "status" and options.watch:
+        from dipcmd.dipwatch import dip_status_watch, WATCHJOBS, POLLINTERVAL
+        status = dip_status_watch(
+            configbase, tokens=options.tokens,
+            username=strip_quotes(options.username), password=strip_quotes(options.password),
+            jobs=options.jobs if options.jobs > 1 else WATCHJOBS,
+            interval=options.poll_interval or POLLINTERVAL,
+            timeout=options.timeout
+            )
 
     elif options.command == "status":
+        from dipcmd.dipdeposit import dip_status
         (status, dipdir) = dip_get_dip_dir(configbase, filebase, options, default=True)
         if status == 0:
             (status, ss) = dip_get_service_details(configbase, filebase, options)
@@ -265,6 +493,16 @@ def run(configbase, filebase, options, progname):
             dip_set_default_dir(configbase, filebase, dipdir)
             dip_save_service_details(configbase, filebase, ss)
 
+    elif options.command == "batch":
+        status = dip_batch(configbase, filebase, options.files, progname)
+
+    elif options.command == "serve":
+        from dipcmd.dipserve import dip_serve, dip_serve_stop
+        if options.stop:
+            status = dip_serve_stop(configbase)
+        else:
+            status = dip_serve(configbase)
+
     else:
         print("Un-recognised sub-command: %s"%(options.command), file=sys.stderr)
         print("Use '%s --help' to see usage summary"%(progname), file=sys.stderr)        
@@ -272,6 +510,76 @@ def run(configbase, filebase, options, progname):
     # Exit
     return status
 
+def batch_lines(batchfiles):
+    """
+    Generator returns (line reference, command line) for each line of the
+    indicated batch files, or of standard input if no files are given.
+    """
+    for batchfile in (batchfiles or ["-"]):
+        if batchfile == "-":
+            batchname, batchstream = ("-", sys.stdin)
+        else:
+            batchname, batchstream = (batchfile, open(batchfile, "r"))
+        try:
+            for lineno, line in enumerate(batchstream, 1):
+                yield ("%s:%d"%(batchname, lineno), line)
+        finally:
+            if batchstream is not sys.stdin:
+                batchstream.close()
+    return
+
+def dip_batch(configbase, filebase, batchfiles, progname):
+    """
+    Run a sequence of dip sub-commands in a single process.
+
+    batchfiles  is a list of files from which commands are read, one per line,
+                using shell-style quoting.  If empty, or "-", commands are
+                read from standard input.  Blank lines and lines starting with
+                '#' are ignored, and a leading program name is optional.
+
+    The configuration is read once, shared by all commands in the batch, and
+    written back when the batch is complete.  After each command, a line of
+    the form:
+
+        exit_status=<status> line=<file>:<line number>
+
+    is written to standard output.
+
+    returns zero if all commands succeed, or the status of the first command
+    that fails.
+    """
+    batchstatus = diperrors.DIP_SUCCESS
+    with ConfigSession(configbase):
+        for (lineref, line) in batch_lines(batchfiles):
+            try:
+                argv = shlex.split(line, comments=True)
+            except ValueError:
+                # E.g. unbalanced quotes
+                argv = None
+            if argv and argv[0] in [progname, "dip"]:
+                argv = argv[1:]
+            if argv == []:
+                continue
+            try:
+                options = argv and parseCommandArgs(argv)
+            except SystemExit:
+                options = None
+            if not options or options.command in ["batch", "serve"]:
+                print("Invalid command in batch (%s): %s"%(lineref, line.strip()), file=sys.stderr)
+                status = diperrors.DIP_BADCMD
+            else:
+                try:
+                    status = run(configbase, filebase, options, progname)
+                except Exception as exc:
+                    log.exception("Batch command failed (%s)"%(lineref))
+                    print("Command failed (%s): %s"%(lineref, exc), file=sys.stderr)
+                    status = diperrors.DIP_CMDFAIL
+            print("exit_status=%d line=%s"%(status, lineref))
+            sys.stdout.flush()
+            if batchstatus == diperrors.DIP_SUCCESS:
+                batchstatus = status
+    return batchstatus
+
 def runCommand(configbase, filebase, argv):
     """
     Run program with supplied configuration base directory, Base directory
@@ -282,26 +590,86 @@ def runCommand(configbase, filebase, argv):
     Returns exit status.
     """
     options = parseCommandArgs(argv[1:])
-    if options and options.debug:
-        logging.basicConfig(level=logging.DEBUG)
     # log.debug("runCommand: configbase %s, filebase %s, argv %s"%(configbase, filebase, repr(argv)))
     # log.debug("Options: %s"%(repr(options)))
     # else:
     #     logging.basicConfig()
     if options:
         progname = os.path.basename(argv[0])
-        status   = run(configbase, filebase, options, progname)
+        with DebugLogging(options.debug):
+            if options.command == "serve":
+                # Commands served are each run in their own configuration session
+                status = run(configbase, filebase, options, progname)
+            else:
+                # Configuration changes are written back once, when the command completes
+                with ConfigSession(configbase):
+                    status = run(configbase, filebase, options, progname)
+            log_http_stats()
     else:
         status = diperrors.DIP_BADCMD
     return status
 
+class DebugLogging(object):
+    """
+    Context handler class that logs debug messages to stderr (as
+    logging.basicConfig does) while a command runs, if `enabled` is True.
+    The previous logging configuration is restored on exit, so that a
+    command run by `dip serve` does not change the server's logging.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.handler = None
+        return
+
+    def __enter__(self):
+        if self.enabled:
+            root = logging.getLogger()
+            self.level   = root.level
+            self.handler = logging.StreamHandler(sys.stderr)
+            self.handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            root.addHandler(self.handler)
+            root.setLevel(logging.DEBUG)
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        if self.handler:
+            root = logging.getLogger()
+            root.removeHandler(self.handler)
+            root.setLevel(self.level)
+            self.handler = None
+        return False
+
+def log_http_stats():
+    """
+    Log statistics of the HTTP connection pool shared by SWORD operations,
+    if any requests have been made.
+    """
+    diphttp = sys.modules.get("dipcmd.diphttp")
+    if diphttp is None:
+        return      # No SWORD operations
+    stats = diphttp.connection_pool().stats()
+    if stats['requests']:
+        log.info(
+            "HTTP connections: requests %(requests)d, created %(created)d, "
+            "reused %(reused)d, discarded %(discarded)d, idle %(idle)d"%stats
+            )
+    return
+
 def runMain():
     """
     Main program transfer function for setup.py console script
+
+    If a `dip serve` process is running, the command is sent to it to be
+    run; otherwise it is run in this process.
     """
     userhome = os.path.join(os.path.expanduser("~"), ".dip_ui")
     filebase = os.getcwd()
-    return runCommand(userhome, filebase, sys.argv)
+    from dipcmd.dipserve import run_in_server
+    status = run_in_server(userhome, sys.argv)
+    if status is None:
+        status = runCommand(userhome, filebase, sys.argv)
+    return status
 
 if __name__ == "__main__":
     """
@@ -0,0 +1,422 @@
+# !/usr/bin/env python
+
+"""
+dipoutbox.py - durable queue of deposits waiting to be sent to a server
+
+`dip deposit --defer` packages a DIP and adds an entry for each collection
+to an outbox held in an SQLite database in the configuration directory,
+with a link to (or copy of) the package file, so that later changes to the
+DIP do not affect the queued deposit.  `dip drain` sends queued deposits
+using a number of worker threads.  A deposit that fails because the server
+cannot be reached, or responds with a server error, is retried after a
+delay that doubles with each attempt; a deposit that is refused by the
+server, or that has failed too many times, is kept in the outbox as a
+dead letter until it is requeued.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import time
+import errno
+import shutil
+import socket
+import sqlite3
+import httplib
+import threading
+import contextlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import SwordService, ensure_config_dir
+from dipcmd.diplocal    import open_dip
+from dipcmd.dippackage  import (
+    SIMPLEZIP, INDEXSUFFIX, read_package_index, write_package_index
+    )
+from dipcmd.dipdeposit  import (
+    check_deposit_details, deposit_endpoint, current_package,
+    deposit_to_collection, save_deposit_receipt
+    )
+
+OUTBOXDB        = "deposit_outbox.db"
+OUTBOXDIR       = "outbox/"         # Directory of queued package files
+OUTBOXTIMEOUT   = 30.0              # Time to wait for a database lock held by another process
+RETRYDELAY      = 30.0              # Delay (seconds) before first retry of a failed deposit
+MAXRETRYDELAY   = 3600.0            # Maximum delay before retrying a failed deposit
+MAXATTEMPTS     = 8                 # Attempts before a deposit is dead-lettered
+IDLEWAIT        = 1.0               # Maximum time a worker waits before checking for new entries
+
+# Entry states
+PENDING         = "pending"
+ACTIVE          = "active"
+DONE            = "done"
+DEAD            = "dead"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS outbox
+        ( id                INTEGER PRIMARY KEY AUTOINCREMENT
+        , dipdir            TEXT NOT NULL
+        , package           TEXT NOT NULL
+        , format            TEXT NOT NULL
+        , collection_uri    TEXT NOT NULL
+        , servicedoc_uri    TEXT
+        , username          TEXT
+        , password          TEXT
+        , segment_size      INTEGER
+        , state             TEXT NOT NULL
+        , attempts          INTEGER NOT NULL DEFAULT 0
+        , queued            REAL NOT NULL
+        , next_attempt      REAL NOT NULL
+        , worker            TEXT
+        , last_error        TEXT
+        , token             TEXT
+        )""",
+    "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt)",
+    ]
+
+# Retryable HTTP response codes
+RETRYCODES = [408, 429, 500, 502, 503, 504]
+
+class Outbox(object):
+    """
+    Queue of deposits saved in the indicated configuration directory.
+
+    Entries are dictionaries with the columns of the outbox table.  Each
+    operation uses its own database connection, so an outbox may be used
+    by several threads or processes; an entry is claimed by one worker at
+    a time.
+    """
+
+    def __init__(self, configbase):
+        self._configbase = configbase
+        self._dbname     = os.path.abspath(os.path.join(configbase, OUTBOXDB))
+        self._pkgdir     = os.path.abspath(os.path.join(configbase, OUTBOXDIR))
+        return
+
+    @contextlib.contextmanager
+    def _connect(self):
+        ensure_config_dir(self._configbase)
+        conn = sqlite3.connect(self._dbname, timeout=OUTBOXTIMEOUT)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+        return
+
+    def add(self, dipdir, package, ss, format=SIMPLEZIP, segment_size=None):
+        """
+        Add a deposit of a package file to the outbox.  The package is linked
+        (or, if that is not possible, copied) into the outbox directory,
+        with a copy of its index.
+
+        Returns the id of the new entry.
+        """
+        ensure_config_dir(self._pkgdir)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO outbox "+
+                "(dipdir, package, format, collection_uri, servicedoc_uri, username, password, "+
+                " segment_size, state, queued, next_attempt) "+
+                "VALUES (?, '', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ( dipdir, format, ss.collection_uri, ss.servicedoc_uri, ss.username, ss.password
+                , segment_size, PENDING, time.time(), time.time()
+                ))
+            entry_id = cursor.lastrowid
+            pkgname  = os.path.join(self._pkgdir, "%d-%s"%(entry_id, os.path.basename(package)))
+            try:
+                os.link(package, pkgname)
+            except OSError:
+                shutil.copy2(package, pkgname)
+            index = read_package_index(package)
+            if index:
+                write_package_index(pkgname, index)
+            conn.execute("UPDATE outbox SET package = ? WHERE id = ?", (pkgname, entry_id))
+        return entry_id
+
+    def claim(self, worker):
+        """
+        Claim the next entry that is due to be sent, returning the entry or
+        None if there is no entry due.
+        """
+        with self._connect() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM outbox WHERE state = ? AND next_attempt <= ? "+
+                    "ORDER BY next_attempt, id LIMIT 1",
+                    (PENDING, time.time())
+                    ).fetchone()
+                if row is None:
+                    return None
+                claimed = conn.execute(
+                    "UPDATE outbox SET state = ?, worker = ? WHERE id = ? AND state = ?",
+                    (ACTIVE, worker, row['id'], PENDING)
+                    ).rowcount
+                conn.commit()
+                if claimed:
+                    return dict(row)
+
+    def complete(self, entry, token):
+        """
+        Record successful deposit of an entry, and remove its package file.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET state = ?, attempts = attempts+1, token = ?, worker = NULL "+
+                "WHERE id = ?",
+                (DONE, token, entry['id'])
+                )
+        remove_file(entry['package'])
+        remove_file(entry['package']+INDEXSUFFIX)
+        return
+
+    def fail(self, entry, message, retry, retry_delay=RETRYDELAY, max_attempts=MAXATTEMPTS):
+        """
+        Record failure of an attempt to deposit an entry.  If `retry` is True
+        and the entry has not had `max_attempts` attempts, it is scheduled
+        to be retried after a delay that doubles with each attempt; otherwise
+        it is dead-lettered.
+
+        Returns True if the deposit will be retried.
+        """
+        attempts = entry['attempts'] + 1
+        retry    = retry and attempts < max_attempts
+        delay    = min(retry_delay * 2**(attempts-1), MAXRETRYDELAY)
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET state = ?, attempts = ?, next_attempt = ?, "+
+                "last_error = ?, worker = NULL WHERE id = ?",
+                (PENDING if retry else DEAD, attempts, time.time()+delay, message, entry['id'])
+                )
+        return retry
+
+    def recover(self, worker_alive):
+        """
+        Return entries claimed by workers that are no longer running to the
+        queue.  `worker_alive` is called with the worker name of each
+        claimed entry, and returns False if the worker has stopped.
+        """
+        with self._connect() as conn:
+            for row in conn.execute("SELECT id, worker FROM outbox WHERE state = ?", (ACTIVE,)).fetchall():
+                if not worker_alive(row['worker']):
+                    log.info("Requeue outbox entry %d claimed by %s"%(row['id'], row['worker']))
+                    conn.execute(
+                        "UPDATE outbox SET state = ?, worker = NULL WHERE id = ? AND worker = ?",
+                        (PENDING, row['id'], row['worker'])
+                        )
+        return
+
+    def requeue_dead(self):
+        """
+        Return dead-lettered entries to the queue, to be sent immediately.
+
+        Returns the number of entries requeued.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE outbox SET state = ?, attempts = 0, next_attempt = ? WHERE state = ?",
+                (PENDING, time.time(), DEAD)
+                ).rowcount
+
+    def next_due(self):
+        """
+        Return the time at which the next pending entry is due, or None if
+        there are no pending entries.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE state = ?", (PENDING,)
+                ).fetchone()[0]
+
+    def entries(self, state=None):
+        """
+        Return list of entries, optionally selected by state, in order of queueing.
+        """
+        with self._connect() as conn:
+            if state:
+                rows = conn.execute("SELECT * FROM outbox WHERE state = ? ORDER BY id", (state,))
+            else:
+                rows = conn.execute("SELECT * FROM outbox ORDER BY id")
+            return [ dict(row) for row in rows ]
+
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return
+
+def worker_name():
+    """
+    Return name identifying the current process, recorded with claimed entries.
+    """
+    return "%s:%d"%(socket.gethostname(), os.getpid())
+
+def local_worker_alive(worker):
+    """
+    Return False if the named worker is a process on this host that is no
+    longer running.  Workers on other hosts are assumed to be running.
+    """
+    (host, sep, pid) = (worker or "").rpartition(":")
+    if host != socket.gethostname():
+        return bool(worker)
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def dip_deposit_defer(
+            configbase, dipdir, services,
+            basedir=None, format=SIMPLEZIP, package=None, jobs=1, segment_size=None
+            ):
+    """
+    Package a DIP (unless a package file is supplied) and add its deposit
+    to each of the indicated collections to the outbox, to be sent by
+    `dip_drain`.  For each collection, a line of the form:
+
+        queued=<outbox-id> collection_uri=<collection-uri>
+
+    is written to stdout.
+
+    Parameters are as for dipdeposit.dip_deposit_multiple.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    status = check_deposit_details(configbase, services, package, format)
+    if status != diperrors.DIP_SUCCESS:
+        return status
+    d = open_dip(dipdir)
+    for ss in services:
+        deposit_endpoint(d, ss, format)
+    if not package:
+        package = current_package(d, dipdir, basedir=basedir, format=format, jobs=jobs)
+    outbox = Outbox(configbase)
+    for ss in services:
+        entry_id = outbox.add(
+            os.path.abspath(dipdir), package, ss, format=format, segment_size=segment_size
+            )
+        print("queued=%d collection_uri=%s"%(entry_id, ss.collection_uri))
+    return diperrors.DIP_SUCCESS
+
+def send_entry(configbase, entry):
+    """
+    Attempt to deposit an outbox entry.
+
+    Returns a triple (status, result, retry), where status is zero to
+    indicate success or a non-zero status code, result is the deposit token
+    or a failure message, and retry is True if a failed deposit may succeed
+    if it is retried.
+    """
+    ss = SwordService(
+        collection_uri=entry['collection_uri'], servicedoc_uri=entry['servicedoc_uri'],
+        username=entry['username'], password=entry['password']
+        )
+    try:
+        (status, dr, message) = deposit_to_collection(
+            configbase, ss, entry['package'],
+            format=entry['format'], segment_size=entry['segment_size']
+            )
+    except (IOError, httplib.HTTPException) as e:
+        return (diperrors.DIP_INTERRUPTED, "Deposit interrupted (%s)"%(e), True)
+    if status == diperrors.DIP_SUCCESS:
+        token = save_deposit_receipt(
+            configbase, dr, collection_uri=ss.collection_uri, dipdir=entry['dipdir'],
+            files=read_package_index(entry['package']) or None
+            )
+        return (status, token, False)
+    retry = status == diperrors.DIP_INTERRUPTED or (dr is not None and dr.code in RETRYCODES)
+    return (status, message, retry)
+
+def dip_drain(
+            configbase, jobs=1, retry_delay=RETRYDELAY, max_attempts=MAXATTEMPTS,
+            requeue=False
+            ):
+    """
+    Send the deposits queued in the outbox, using `jobs` worker threads,
+    until no deposits are waiting to be sent (or retried).  For each
+    deposit attempt, a line of one of the forms:
+
+        queued=<outbox-id> collection_uri=<collection-uri> token=<deposit-token>
+        queued=<outbox-id> collection_uri=<collection-uri> exit_status=<status> retry=<yes|no>
+
+    is written to stdout.
+
+    jobs         is the number of deposits sent concurrently.
+    retry_delay  is the delay in seconds before the first retry of a failed
+                 deposit, doubled for each later retry.
+    max_attempts is the number of attempts made before a deposit is
+                 dead-lettered.
+    requeue      is True if dead-lettered deposits are to be retried.
+
+    returns zero if all deposits attempted succeed, or the status code of a
+    deposit that was dead-lettered.
+    """
+    outbox = Outbox(configbase)
+    outbox.recover(local_worker_alive)
+    if requeue:
+        log.info("Requeued %d dead-lettered deposits"%(outbox.requeue_dead()))
+    worker = worker_name()
+    lock   = threading.Lock()
+    state  = { 'active': 0, 'status': diperrors.DIP_SUCCESS }
+    def report(entry, line):
+        with lock:
+            print("queued=%d collection_uri=%s %s"%(entry['id'], entry['collection_uri'], line))
+            sys.stdout.flush()
+        return
+    def drain():
+        while True:
+            with lock:
+                entry = outbox.claim(worker)
+                if entry is None:
+                    due = outbox.next_due()
+                    if due is None and state['active'] == 0:
+                        return
+                else:
+                    state['active'] += 1
+            if entry is None:
+                wait = IDLEWAIT if due is None else due - time.time()
+                time.sleep(min(IDLEWAIT, max(wait, 0.01)))
+                continue
+            try:
+                (status, result, retry) = send_entry(configbase, entry)
+            except Exception as e:
+                log.exception("Deposit of outbox entry %d failed"%(entry['id']))
+                (status, result, retry) = (diperrors.DIP_DEPOSITFAIL, str(e), True)
+            if status == diperrors.DIP_SUCCESS:
+                outbox.complete(entry, result)
+                report(entry, "token=%s"%(result))
+            else:
+                retry = outbox.fail(
+                    entry, result, retry, retry_delay=retry_delay, max_attempts=max_attempts
+                    )
+                print("queued=%d: %s"%(entry['id'], result), file=sys.stderr)
+                report(entry, "exit_status=%d retry=%s"%(status, "yes" if retry else "no"))
+                if not retry:
+                    with lock:
+                        state['status'] = state['status'] or status
+            with lock:
+                state['active'] -= 1
+    workers = [ threading.Thread(target=drain) for i in range(max(1, jobs)) ]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        while w.is_alive():
+            w.join(IDLEWAIT)
+    return state['status']
+
+# End.
@@ -0,0 +1,448 @@
+# !/usr/bin/env python
+
+"""
+dippackage.py - streaming zip packager for deposit information packages
+
+Builds the SimpleZip package for a DIP without holding the package in
+memory.  File content is compressed by a pool of worker processes, and
+the compressed entries are streamed into the zip file in order, followed
+by the central directory.  ZIP64 extensions are used for entries and
+archives that exceed the limits of the original zip format.
+
+When a package is rebuilt, entries for files that are unchanged since
+the previous build are copied from the previous package still compressed.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import time
+import errno
+import json
+import zlib
+import zipfile
+import struct
+import base64
+import shutil
+import tempfile
+import logging
+
+from multiprocessing    import Pool
+
+log = logging.getLogger(__name__)
+
+from dipcmd.diplocal    import file_state
+
+SIMPLEZIP       = "http://purl.org/net/sword/package/SimpleZip"
+PACKAGEFILE     = "SimpleZip.zip"
+INDEXSUFFIX     = ".index.json"     # Suffix for index of files used to build package
+READBUFFERSIZE  = 1024*1024
+SPOOLTHRESHOLD  = 4*1024*1024   # Larger compressed entries are spooled to disk
+ZIP64LIMIT      = 0xFFFFFFFF    # Sizes and offsets from here need ZIP64 fields
+ZIP64COUNTLIMIT = 0xFFFF        # Entry counts from here need ZIP64 records
+
+ZIP_STORED      = 0
+ZIP_DEFLATED    = 8
+
+def package_dir(dipdir, format=SIMPLEZIP):
+    """
+    Return directory in which packages of the indicated format are saved.
+    """
+    return os.path.join(dipdir, "packages", base64.urlsafe_b64encode(format))
+
+def package_filename(dipdir, format=SIMPLEZIP):
+    """
+    Return name of package file for the indicated format.
+    """
+    return os.path.join(package_dir(dipdir, format), PACKAGEFILE)
+
+def package_members(d, basedir=None):
+    """
+    Return list of (path, arcname) for the content of a SimpleZip package of
+    a DIP: the DIP's metadata files, followed by the files it references.
+
+    d       is a dip.DIP object
+    basedir is a base directory used for calculation of relative paths within
+            the package.  Files outside this directory are stored using just
+            their file name.
+    """
+    members = [ (mf.path, os.path.basename(mf.path)) for mf in d.get_metadata_files() ]
+    for df in d.get_files():
+        path = os.path.abspath(df.path)
+        if basedir and path.startswith(os.path.join(os.path.abspath(basedir), "")):
+            arcname = os.path.relpath(path, basedir)
+        else:
+            arcname = os.path.basename(path)
+        members.append((path, arcname.replace(os.sep, "/")))
+    return members
+
+def compress_member(args):
+    """
+    Compress a file for inclusion in a zip package.  This function is run
+    by the worker processes.
+
+    args    is a tuple (path, level, spooldir).
+
+    Returns a dictionary describing the entry, with keys:
+        path, mtime, mode, size, crc, compsize, method
+    and either "data" (compressed content) or "spool" (name of a temporary
+    file containing the compressed content).  Content that does not shrink
+    when compressed is stored uncompressed, in which case "spool" may be
+    None, meaning the content is copied from the original file.
+    """
+    (path, level, spooldir) = args
+    st       = os.stat(path)
+    comp     = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc      = 0
+    size     = 0
+    chunks   = []
+    compsize = 0
+    spool    = None
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(READBUFFERSIZE)
+            if not buf:
+                break
+            size += len(buf)
+            crc   = zlib.crc32(buf, crc)
+            cbuf  = comp.compress(buf)
+            if cbuf:
+                chunks.append(cbuf)
+                compsize += len(cbuf)
+            if spool is None and compsize > SPOOLTHRESHOLD:
+                (fd, spoolname) = tempfile.mkstemp(dir=spooldir, suffix=".spool")
+                spool = os.fdopen(fd, "wb")
+            if spool is not None and chunks:
+                spool.writelines(chunks)
+                chunks = []
+        cbuf = comp.flush()
+        chunks.append(cbuf)
+        compsize += len(cbuf)
+    entry = (
+        { 'path':       path
+        , 'mtime':      st.st_mtime
+        , 'mode':       st.st_mode
+        , 'size':       size
+        , 'crc':        crc & 0xFFFFFFFF
+        , 'compsize':   compsize
+        , 'method':     ZIP_DEFLATED
+        })
+    if spool is not None:
+        spool.writelines(chunks)
+        spool.close()
+        entry['spool'] = spoolname
+    else:
+        entry['data'] = b"".join(chunks)
+    if compsize >= size:
+        # Compression does not help: store content instead
+        if spool is not None:
+            os.remove(spoolname)
+            entry['spool'] = None
+        else:
+            with open(path, "rb") as f:
+                entry['data'] = f.read()
+        entry['method']   = ZIP_STORED
+        entry['compsize'] = size
+    return entry
+
+def copied_entry(prevzip, info, path, state):
+    """
+    Return a dictionary describing an entry whose compressed content is to
+    be copied from a previous package (see `compress_member`).
+
+    prevzip is an open binary stream for the previous package.
+    info    is the zipfile.ZipInfo value for the entry in the previous package.
+    path    is the file from which the entry was built.
+    state   is the file state (see diplocal.file_state) of that file.
+    """
+    return (
+        { 'path':       path
+        , 'mtime':      state[1]
+        , 'mode':       info.external_attr >> 16
+        , 'size':       info.file_size
+        , 'crc':        info.CRC
+        , 'compsize':   info.compress_size
+        , 'method':     info.compress_type
+        , 'copy':       (prevzip, info.header_offset)
+        })
+
+def dos_datetime(mtime):
+    """
+    Return (time, date) values in MS-DOS format for a file modification time.
+    """
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        t = time.localtime(time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1)))
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        )
+
+class StreamingZipWriter(object):
+    """
+    Writes zip file entries sequentially to a stream, using pre-computed
+    CRC and sizes so that no seeking back is needed, and records just the
+    information needed for the central directory, which is written by
+    `close`.
+    """
+
+    def __init__(self, stream):
+        self._stream  = stream
+        self._offset  = 0
+        self._central = []
+        return
+
+    def _write(self, data):
+        self._stream.write(data)
+        self._offset += len(data)
+        return
+
+    def write_entry(self, arcname, entry):
+        """
+        Write an entry returned by `compress_member` to the zip file.
+        """
+        if isinstance(arcname, unicode):
+            (name, flags) = (arcname.encode("utf-8"), 0x800)
+        else:
+            (name, flags) = (arcname, 0)
+        (dostime, dosdate) = dos_datetime(entry['mtime'])
+        header_offset = self._offset
+        zip64  = entry['size'] >= ZIP64LIMIT or entry['compsize'] >= ZIP64LIMIT
+        extra  = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 0x0001, 16, entry['size'], entry['compsize'])
+        version = 45 if zip64 else 20
+        self._write(struct.pack("<IHHHHHIIIHH",
+            0x04034b50, version, flags, entry['method'], dostime, dosdate, entry['crc'],
+            0xFFFFFFFF if zip64 else entry['compsize'],
+            0xFFFFFFFF if zip64 else entry['size'],
+            len(name), len(extra)
+            ))
+        self._write(name)
+        self._write(extra)
+        self._write_content(entry)
+        self._central.append(
+            ( name, flags, version, dostime, dosdate, header_offset
+            , entry['crc'], entry['size'], entry['compsize'], entry['method'], entry['mode']
+            ))
+        return
+
+    def _write_content(self, entry):
+        if 'data' in entry:
+            self._write(entry['data'])
+            return
+        if 'copy' in entry:
+            (src, header_offset) = entry['copy']
+            src.seek(header_offset)
+            header = src.read(30)
+            (namelen, extralen) = struct.unpack("<HH", header[26:30])
+            src.seek(header_offset + 30 + namelen + extralen)
+            remaining = entry['compsize']
+            while remaining > 0:
+                buf = src.read(min(remaining, READBUFFERSIZE))
+                if not buf:
+                    raise IOError("Previous package truncated: %s"%(src.name))
+                self._write(buf)
+                remaining -= len(buf)
+            return
+        if entry['spool']:
+            (srcname, delete) = (entry['spool'], True)
+        else:
+            (srcname, delete) = (entry['path'], False)
+        with open(srcname, "rb") as src:
+            while True:
+                buf = src.read(READBUFFERSIZE)
+                if not buf:
+                    break
+                self._write(buf)
+        if delete:
+            os.remove(srcname)
+        return
+
+    def close(self):
+        """
+        Write central directory and end of central directory records.
+        """
+        cd_offset = self._offset
+        for ( name, flags, version, dostime, dosdate, header_offset
+            , crc, size, compsize, method, mode
+            ) in self._central:
+            fields64 = []
+            if size >= ZIP64LIMIT:
+                fields64.append(size)
+                size = 0xFFFFFFFF
+            if compsize >= ZIP64LIMIT:
+                fields64.append(compsize)
+                compsize = 0xFFFFFFFF
+            if header_offset >= ZIP64LIMIT:
+                fields64.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = b""
+            if fields64:
+                extra = struct.pack("<HH"+"Q"*len(fields64), 0x0001, 8*len(fields64), *fields64)
+                version = 45
+            self._write(struct.pack("<IHHHHHHIIIHHHHHII",
+                0x02014b50, (3 << 8) | version, version, flags, method,
+                dostime, dosdate, crc, compsize, size,
+                len(name), len(extra), 0, 0, 0,
+                (mode & 0xFFFF) << 16, header_offset
+                ))
+            self._write(name)
+            self._write(extra)
+        cd_size = self._offset - cd_offset
+        count   = len(self._central)
+        if count >= ZIP64COUNTLIMIT or cd_size >= ZIP64LIMIT or cd_offset >= ZIP64LIMIT:
+            eocd64_offset = self._offset
+            self._write(struct.pack("<IQHHIIQQQQ",
+                0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset
+                ))
+            self._write(struct.pack("<IIQI", 0x07064b50, 0, eocd64_offset, 1))
+            (count, cd_size, cd_offset) = (0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+        self._write(struct.pack("<IHHHHIIH",
+            0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0
+            ))
+        return
+
+def read_package_index(pkgname):
+    """
+    Read the index saved with a package, returning a dictionary keyed by
+    entry name, each value being a dictionary with the path and file state
+    (see diplocal.file_state) of the file from which the entry was built.
+    An empty dictionary is returned if there is no index.
+    """
+    try:
+        with open(pkgname+INDEXSUFFIX, "r") as indexfile:
+            return json.load(indexfile)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return {}
+        raise
+    except ValueError:
+        log.warning("Ignoring invalid package index for %s"%(pkgname))
+        return {}
+
+def write_package_index(pkgname, index):
+    """
+    Write the index for a package, replacing any previous index.
+    """
+    with open(pkgname+INDEXSUFFIX+".tmp", "w") as indexfile:
+        json.dump(index, indexfile)
+    os.rename(pkgname+INDEXSUFFIX+".tmp", pkgname+INDEXSUFFIX)
+    return
+
+def package_fresh(pkgname, members):
+    """
+    Return True if a package exists that was built from exactly the indicated
+    members, none of which has changed since (according to the index saved
+    with the package), so it need not be rebuilt.
+
+    pkgname     is the name of the package file.
+    members     is a list of (path, arcname) pairs for the package content.
+    """
+    if not os.path.isfile(pkgname):
+        return False
+    index = read_package_index(pkgname)
+    if len(index) != len(members):
+        return False
+    for (path, arcname) in members:
+        state = file_state(path)
+        if state is None or index.get(arcname) != { 'path': path, 'state': state }:
+            return False
+    return True
+
+def previous_entries(pkgname):
+    """
+    Return a dictionary of zipfile.ZipInfo values for the entries of an
+    existing package, keyed by entry name, or an empty dictionary if the
+    package does not exist or cannot be read.
+    """
+    if not os.path.isfile(pkgname):
+        return {}
+    try:
+        z = zipfile.ZipFile(pkgname)
+    except (zipfile.BadZipfile, IOError) as exc:
+        log.warning("Cannot read previous package %s: %s"%(pkgname, exc))
+        return {}
+    try:
+        return dict( (info.filename, info) for info in z.infolist() )
+    finally:
+        z.close()
+
+def build_zip_package(pkgname, members, jobs=1, level=6, incremental=True):
+    """
+    Build a zip package containing the indicated files.
+
+    If `incremental` is True and a previous package exists, entries for
+    files that are unchanged since that package was built (according to the
+    index saved with it) are copied across still compressed; only new or
+    modified files are compressed, and entries for files no longer in the
+    package are dropped.
+
+    pkgname     is the name of the package file to create.  The package is
+                written to a temporary file which replaces any existing
+                package when complete.
+    members     is a list of (path, arcname) pairs for the package content.
+    jobs        is the number of worker processes used to compress content.
+    level       is the zlib compression level.
+    incremental is True if unchanged entries of a previous package may be
+                reused.
+
+    Returns the name of the package file.
+    """
+    pkgdir = os.path.dirname(pkgname)
+    if not os.path.isdir(pkgdir):
+        os.makedirs(pkgdir)
+    previndex = read_package_index(pkgname) if incremental else {}
+    previnfos = previous_entries(pkgname) if previndex else {}
+    prevzip   = open(pkgname, "rb") if previnfos else None
+    index     = {}
+    reused    = 0
+    spooldir  = tempfile.mkdtemp(dir=pkgdir, prefix=".spool")
+    tmpname   = pkgname+".tmp"
+    pool      = Pool(jobs) if jobs > 1 else None
+    # Limit the number of compressed entries waiting to be written
+    window    = max(1, jobs)*8
+    try:
+        with open(tmpname, "wb") as stream:
+            zw = StreamingZipWriter(stream)
+            for start in range(0, len(members), window):
+                batch   = members[start:start+window]
+                entries = []
+                tasks   = []
+                for (path, arcname) in batch:
+                    state = file_state(path)
+                    index[arcname] = { 'path': path, 'state': state }
+                    if ( arcname in previnfos and state is not None and
+                         previndex.get(arcname) == index[arcname] ):
+                        entries.append(copied_entry(prevzip, previnfos[arcname], path, state))
+                        reused += 1
+                    else:
+                        entries.append(None)
+                        tasks.append((path, level, spooldir))
+                if pool:
+                    compressed = pool.imap(compress_member, tasks)
+                else:
+                    compressed = (compress_member(t) for t in tasks)
+                for (i, entry) in enumerate(entries):
+                    zw.write_entry(batch[i][1], entry or next(compressed))
+            zw.close()
+        os.rename(tmpname, pkgname)
+        write_package_index(pkgname, index)
+    finally:
+        if prevzip:
+            prevzip.close()
+        if pool:
+            pool.terminate()
+        shutil.rmtree(spooldir, ignore_errors=True)
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    log.info("Package %s: %d entries reused, %d compressed"%(pkgname, reused, len(members)-reused))
+    return pkgname
+
+# End.
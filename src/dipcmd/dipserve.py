@@ -0,0 +1,245 @@
+# !/usr/bin/env python
+
+"""
+dipserve.py - long-running dip process serving commands over a Unix socket
+
+`dip serve` keeps a process running that accepts dip commands from
+clients over a Unix-domain socket in the configuration directory, so
+that each command does not pay for starting an interpreter and loading
+the dip and SWORD libraries.  The process keeps the parsed configuration
+(see dipconfig), opened DIPs (see diplocal.open_dip) and pooled HTTP
+connections (see diphttp) between commands.
+
+Each connection carries one request, a line of JSON:
+
+    {"argv": [...], "cwd": <directory>}
+
+to which the server replies with a line of JSON:
+
+    {"status": <exit status>, "stdout": <output>, "stderr": <error output>}
+
+or, for the request {"stop": true}, stops after replying {"status": 0}.
+Commands are run one at a time, in the client's current directory, as
+they share the process's current directory and standard output.  Commands
+that can run for a long time are run by the client (see CLIENTCOMMANDS).
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import json
+import errno
+import socket
+import StringIO
+import logging
+
+log = logging.getLogger(__name__)
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import ensure_config_dir
+
+SERVESOCKET     = "dip.sock"
+SERVEBACKLOG    = 16
+
+# Commands that are always run by the client: batch reads commands from
+# the client's standard input, and already runs them in a single process;
+# drain, deposit-all and status --watch can run for a long time, during
+# which they would hold up other clients and their progress would not be
+# seen, as the server runs one command at a time and returns its output
+# when it completes
+CLIENTCOMMANDS  = ["serve", "batch", "drain", "deposit-all", "--watch"]
+
+def serve_socket(configbase):
+    """
+    Return name of the socket used by `dip serve` for the indicated
+    configuration directory.
+    """
+    return os.path.abspath(os.path.join(configbase, SERVESOCKET))
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message)+"\n")
+    return
+
+def read_message(sock):
+    """
+    Read a line of JSON from a socket, returning the decoded value or None
+    if the connection is closed first.
+    """
+    buf = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return None
+        buf.append(data)
+        if data.endswith("\n"):
+            return json.loads("".join(buf))
+
+def error_response(message):
+    return { 'status': diperrors.DIP_CMDFAIL, 'stdout': "", 'stderr': message+"\n" }
+
+def run_request(configbase, request):
+    """
+    Run a command requested by a client, returning the response.
+
+    Output written to stdout and stderr by the command is captured and
+    returned in the response.  A request that is not valid, or whose
+    directory cannot be used, receives an error response.
+    """
+    from dipcmd.dipmain import runCommand
+    if ( not isinstance(request, dict) or
+         not isinstance(request.get('cwd'), basestring) or
+         not isinstance(request.get('argv'), list) or
+         not all( isinstance(arg, basestring) for arg in request['argv'] ) ):
+        return error_response("Invalid dip serve request")
+    (stdout, stderr, stdin) = (sys.stdout, sys.stderr, sys.stdin)
+    (outstr, errstr)        = (StringIO.StringIO(), StringIO.StringIO())
+    cwd = os.getcwd()
+    try:
+        os.chdir(request['cwd'])
+    except OSError as e:
+        return error_response("Cannot use directory %s: %s"%(request['cwd'], e.strerror))
+    try:
+        (sys.stdout, sys.stderr, sys.stdin) = (outstr, errstr, StringIO.StringIO())
+        try:
+            status = runCommand(configbase, request['cwd'], request['argv'])
+        except SystemExit as e:     # --help, --version and usage errors
+            status = e.code if isinstance(e.code, int) else diperrors.DIP_BADCMD
+        except Exception as e:
+            log.exception("Command failed: %r"%(request['argv']))
+            print("Command failed: %s"%(e), file=sys.stderr)
+            status = diperrors.DIP_CMDFAIL
+    finally:
+        (sys.stdout, sys.stderr, sys.stdin) = (stdout, stderr, stdin)
+        os.chdir(cwd)
+    return { 'status': status, 'stdout': outstr.getvalue(), 'stderr': errstr.getvalue() }
+
+def listen_socket(sockname):
+    """
+    Return a socket listening on the indicated name, or None if another
+    process is already serving on it.  A socket file left by a process that
+    has stopped is replaced.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(sockname):
+        try:
+            sock.connect(sockname)
+        except socket.error:
+            os.remove(sockname)
+        else:
+            sock.close()
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        sock.bind(sockname)
+    finally:
+        os.umask(umask)
+    sock.listen(SERVEBACKLOG)
+    return sock
+
+def dip_serve(configbase, sockname=None):
+    """
+    Serve dip commands on a Unix-domain socket until stopped by a client
+    (see dip_serve_stop) or interrupted.  A line of the form:
+
+        serving=<socket-name>
+
+    is written to stdout when the server is ready.
+
+    sockname    is the name of the socket, or None to use the default
+                socket for the configuration directory.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    sockname = sockname or serve_socket(configbase)
+    ensure_config_dir(configbase)
+    sock = listen_socket(sockname)
+    if sock is None:
+        print("dip serve is already running on %s"%(sockname), file=sys.stderr)
+        return diperrors.DIP_SERVING
+    print("serving=%s"%(sockname))
+    sys.stdout.flush()
+    stopped = False
+    try:
+        while not stopped:
+            (conn, addr) = sock.accept()
+            try:
+                request = read_message(conn)
+                if request is None:
+                    continue
+                if isinstance(request, dict) and request.get('stop'):
+                    response = { 'status': diperrors.DIP_SUCCESS }
+                    stopped  = True
+                else:
+                    response = run_request(configbase, request)
+                send_message(conn, response)
+            except Exception as e:
+                # A failed request must not stop the server
+                log.warning("Request failed: %s"%(e))
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(sockname)
+    return diperrors.DIP_SUCCESS
+
+def server_request(configbase, request, sockname=None):
+    """
+    Send a request to a `dip serve` process, returning the response, or
+    None if no server is running.
+    """
+    sockname = sockname or serve_socket(configbase)
+    if not os.path.exists(sockname):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(sockname)
+        except socket.error as e:
+            if e.errno in [errno.ENOENT, errno.ECONNREFUSED]:
+                return None
+            raise
+        send_message(sock, request)
+        return read_message(sock)
+    finally:
+        sock.close()
+
+def run_in_server(configbase, argv, sockname=None):
+    """
+    Run a command in a `dip serve` process if one is running, copying its
+    output to stdout and stderr.
+
+    Returns the exit status of the command, or None if it was not run
+    because no server is running or the command is run only by clients
+    (see CLIENTCOMMANDS).
+    """
+    if any( arg in CLIENTCOMMANDS for arg in argv[1:] ):
+        return None
+    response = server_request(configbase, { 'argv': argv, 'cwd': os.getcwd() }, sockname=sockname)
+    if response is None:
+        return None
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+def dip_serve_stop(configbase, sockname=None):
+    """
+    Stop a running `dip serve` process.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    response = server_request(configbase, { 'stop': True }, sockname=sockname)
+    if response is None:
+        print("dip serve is not running", file=sys.stderr)
+        return diperrors.DIP_NOTSERVING
+    return response['status']
+
+# End.
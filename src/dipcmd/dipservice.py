@@ -0,0 +1,170 @@
+# !/usr/bin/env python
+
+"""
+dipservice.py - cached SWORD service document information
+
+The capabilities of collections described by a SWORD service document
+(accepted content types and packaging formats, etc.) are saved in the
+configuration directory, keyed by service document URI.  Saved information
+is used without contacting the server until its time-to-live expires,
+after which the service document is revalidated with a conditional request
+(using the ETag and Last-Modified values from when it was fetched).
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import time
+import json
+import errno
+import hashlib
+import httplib
+import logging
+
+log = logging.getLogger(__name__)
+
+from sword2             import ServiceDocument
+
+from dipcmd.dipconfig   import readconfig, ensure_config_dir
+from dipcmd.diphttp     import StreamingHttpLayer
+
+SERVICEDOCDIR   = "servicedocs/"
+SERVICEDOCTTL   = 3600          # Default time-to-live (seconds) of saved information
+
+def servicedoc_filename(configbase, servicedoc_uri):
+    """
+    Returns filename for saving information from a service document
+    """
+    key = hashlib.sha1(servicedoc_uri).hexdigest()
+    return os.path.abspath(os.path.join(configbase, SERVICEDOCDIR, key+".json"))
+
+def servicedoc_ttl(configbase):
+    """
+    Returns time-to-live of saved service document information, from the
+    "servicedoc_ttl" configuration value if present.
+    """
+    return readconfig(configbase).get('servicedoc_ttl', SERVICEDOCTTL)
+
+def read_servicedoc_cache(configbase, servicedoc_uri):
+    """
+    Return saved information for a service document, or None.
+    """
+    try:
+        with open(servicedoc_filename(configbase, servicedoc_uri), "r") as sdf:
+            return json.load(sdf)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        log.warning("Ignoring invalid saved service document for %s"%(servicedoc_uri))
+        return None
+
+def write_servicedoc_cache(configbase, servicedoc_uri, info):
+    """
+    Save information for a service document, replacing any previous information.
+    """
+    sdname = servicedoc_filename(configbase, servicedoc_uri)
+    ensure_config_dir(os.path.dirname(sdname))
+    with open(sdname+".tmp", "w") as sdf:
+        json.dump(info, sdf, indent=2, separators=(',', ': '))
+    os.rename(sdname+".tmp", sdname)
+    return
+
+def parse_service_document(servicedoc_uri, content):
+    """
+    Parse a service document, returning a dictionary of the capabilities of
+    each collection, keyed by collection URI, or None if the document is
+    not a valid SWORD v2 service document.
+    """
+    sd = ServiceDocument(xml_response=content, sd_uri=servicedoc_uri)
+    if not sd.valid:
+        return None
+    collections = {}
+    for (workspace_title, workspace_collections) in sd.workspaces:
+        for c in workspace_collections:
+            collections[c.href] = (
+                { 'title':              c.title
+                , 'accept':             c.accept or []
+                , 'accept_multipart':   c.accept_multipart or []
+                , 'accept_packaging':   c.acceptPackaging or []
+                , 'mediation':          c.mediation
+                })
+    return collections
+
+def service_capabilities(configbase, ss, ttl=None, http=None):
+    """
+    Return capabilities of the collections offered by a SWORD service, using
+    saved information if it has not expired.
+
+    configbase  is the configuration directory, where information is saved.
+    ss          is a SwordService value for the service.
+    ttl         is the time-to-live of saved information in seconds; if not
+                given, the configured or default value is used.
+    http        is the sword2 HTTP layer used to fetch the service document;
+                if not given, a streaming HTTP layer using the shared
+                connection pool is used.
+
+    Returns a dictionary of collection capabilities keyed by collection URI
+    (see `parse_service_document`), or None if the service document cannot
+    be obtained.
+    """
+    if ttl is None:
+        ttl = servicedoc_ttl(configbase)
+    info = read_servicedoc_cache(configbase, ss.servicedoc_uri)
+    now  = time.time()
+    if info and now < info['fetched'] + ttl:
+        return info['collections']
+    if http is None:
+        http = StreamingHttpLayer()
+        if ss.username:
+            http.add_credentials(ss.username, ss.password)
+    headers = {}
+    if info and info.get('etag'):
+        headers['If-None-Match'] = info['etag']
+    if info and info.get('last_modified'):
+        headers['If-Modified-Since'] = info['last_modified']
+    try:
+        (resp, content) = http.request(ss.servicedoc_uri, "GET", headers=headers)
+    except (IOError, httplib.HTTPException) as e:
+        log.warning("Cannot fetch service document %s: %s"%(ss.servicedoc_uri, e))
+        return info and info['collections']
+    if resp['status'] == 304 and info:
+        log.debug("Service document not modified: %s"%(ss.servicedoc_uri))
+    elif resp['status'] == 200:
+        collections = parse_service_document(ss.servicedoc_uri, content)
+        if collections is None:
+            log.warning("Invalid service document %s"%(ss.servicedoc_uri))
+            return None
+        info = (
+            { 'servicedoc_uri': ss.servicedoc_uri
+            , 'etag':           resp.get('etag')
+            , 'last_modified':  resp.get('last-modified')
+            , 'collections':    collections
+            })
+    else:
+        log.warning("Cannot fetch service document %s: %d"%(ss.servicedoc_uri, resp['status']))
+        return None
+    info['fetched'] = now
+    write_servicedoc_cache(configbase, ss.servicedoc_uri, info)
+    return info['collections']
+
+def collection_accepts_packaging(collections, collection_uri, packaging):
+    """
+    Return False if service document information shows that the indicated
+    collection does not accept the indicated packaging format, otherwise True.
+    A collection that does not list any packaging formats, or that is not
+    described, is assumed to accept any packaging.
+    """
+    caps = (collections or {}).get(collection_uri)
+    if not caps or not caps['accept_packaging']:
+        return True
+    return packaging in caps['accept_packaging']
+
+# End.
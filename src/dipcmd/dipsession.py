@@ -0,0 +1,242 @@
+# !/usr/bin/env python
+
+"""
+dipsession.py - Python interface to dip operations
+
+A DipSession provides the operations of the dip command line tool to
+Python programs, without parsing command lines or writing results to
+stdout: each operation returns its result (e.g. a DIP directory, a list
+of files, a package file name or a deposit token), and failures are
+raised as DipError exceptions carrying the status code that the
+corresponding command would return.  E.g.
+
+    session = DipSession()
+    with session:
+        session.create("mydip")
+        session.add_files(["data"], recursive=True)
+        token = session.deposit("http://example.org/sword/collection")
+
+The configuration and opened DIPs are kept between operations.  Within a
+`with` block, configuration changes are written back once, at the end of
+the block (see dipconfig.ConfigSession).
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import os
+import os.path
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+from collections        import namedtuple
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import (
+    SwordService, ConfigSession, readconfig,
+    dip_set_default_dir, dip_save_service_details, service_details
+    )
+from dipcmd.diplocal    import (
+    dip_check, create_dip, open_dip, forget_dip, add_dip_files, remove_dip_files
+    )
+from dipcmd.dippackage  import SIMPLEZIP
+from dipcmd.dipdeposit  import current_package, deposit_dip_to, read_deposit_status
+
+DipContents = namedtuple('DipContents', ['dipdir', 'files', 'metadata_files', 'dublin_core', 'endpoints'])
+
+class DipError(Exception):
+    """
+    Exception raised when a DipSession operation fails.  `status` is the
+    status code (see diperrors) returned by the corresponding dip command.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        return
+
+class DipSession(object):
+    """
+    Session for dip operations using the configuration in `configbase`
+    (by default, that used by the dip command).  DIP directories are
+    resolved relative to `filebase` (by default, the current directory),
+    and the default DIP for operations is the last one used, as for the
+    dip command.
+    """
+
+    def __init__(self, configbase=None, filebase=None):
+        self.configbase = configbase or os.path.join(os.path.expanduser("~"), ".dip_ui")
+        self.filebase   = filebase or os.getcwd()
+        self._session   = ConfigSession(self.configbase)
+        return
+
+    def __enter__(self):
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        return self._session.__exit__(exctype, excval, exctraceback)
+
+    @property
+    def config(self):
+        """
+        The configuration dictionary (re-read only if the file has changed).
+        """
+        return readconfig(self.configbase)
+
+    def dip_dir(self, dip=None):
+        """
+        Return the directory of the indicated DIP, or of the default DIP if
+        none is given.
+        """
+        dipref = dip or self.config.get('dipdir')
+        if not dipref:
+            raise DipError(diperrors.DIP_NODIPGIVEN, "No directory specified for DIP")
+        return os.path.join(self.filebase, dipref)
+
+    def use(self, dip=None):
+        """
+        Make the indicated DIP the default for later operations, and return
+        its directory.
+        """
+        dipdir = self.dip_dir(dip)
+        (status, message) = dip_check(dipdir)
+        if status != diperrors.DIP_SUCCESS:
+            raise DipError(status, message)
+        dip_set_default_dir(self.configbase, self.filebase, dipdir)
+        return dipdir
+
+    def create(self, dip):
+        """
+        Create an empty DIP, make it the default, and return its directory.
+        """
+        dipdir = os.path.join(self.filebase, dip)
+        (status, message) = create_dip(dipdir)
+        if status != diperrors.DIP_SUCCESS:
+            raise DipError(status, message)
+        dip_set_default_dir(self.configbase, self.filebase, dipdir)
+        return dipdir
+
+    def remove(self, dip):
+        """
+        Remove a DIP (but not the files it refers to), and return its directory.
+        """
+        dipdir = os.path.join(self.filebase, dip)
+        (status, message) = dip_check(dipdir)
+        if status != diperrors.DIP_SUCCESS:
+            raise DipError(status, message)
+        shutil.rmtree(dipdir)
+        forget_dip(dipdir)
+        dip_set_default_dir(self.configbase, self.filebase, None)
+        return dipdir
+
+    def show(self, dip=None):
+        """
+        Return a DipContents value describing a DIP: its directory, and the
+        files, metadata files, Dublin Core values and endpoints (as returned
+        by the dip library).
+        """
+        dipdir = self.use(dip)
+        d = open_dip(dipdir)
+        return DipContents(
+            dipdir, d.get_files(), d.get_metadata_files(), d.get_dublin_core(), d.get_endpoints()
+            )
+
+    def files(self, dip=None):
+        """
+        Return a list of the paths of files in a DIP.
+        """
+        return [ df.path for df in open_dip(self.use(dip)).get_files() ]
+
+    def add_files(self, files, dip=None, recursive=False, jobs=1):
+        """
+        Add files to a DIP (see diplocal.dip_add_files), and return a list of
+        the files added; files already in the DIP and unchanged are skipped.
+        """
+        dipdir = self.use(dip)
+        (added, unchanged) = add_dip_files(
+            dipdir, files, recursive=recursive, basedir=self.filebase, jobs=jobs
+            )
+        return added
+
+    def remove_files(self, files, dip=None, recursive=False, jobs=1):
+        """
+        Remove files from a DIP (see diplocal.dip_remove_files), and return a
+        list of the files removed.
+        """
+        dipdir = self.use(dip)
+        return remove_dip_files(dipdir, files, recursive=recursive, basedir=self.filebase, jobs=jobs)
+
+    def package(self, dip=None, jobs=1):
+        """
+        Build a SimpleZip package of a DIP, if it is not up to date, and
+        return the name of the package file.
+        """
+        dipdir = self.use(dip)
+        return current_package(open_dip(dipdir), dipdir, basedir=self.filebase, jobs=jobs)
+
+    def configure_collection(self, collection_uri, servicedoc_uri=None, username=None, password=None):
+        """
+        Configure a SWORD collection for deposits, as `dip config` does.
+        Details not given are unchanged if the collection is already
+        configured.
+        """
+        ss = SwordService(
+            collection_uri=collection_uri, servicedoc_uri=servicedoc_uri,
+            username=username, password=password
+            )
+        dip_save_service_details(self.configbase, self.filebase, ss)
+        return
+
+    def service(self, collection_uri, servicedoc_uri=None, username=None, password=None):
+        """
+        Return SWORD service details for a configured collection, using any
+        details given in place of those configured.
+        """
+        (status, ss) = service_details(
+            self.configbase, collection_uri,
+            servicedoc_uri=servicedoc_uri, username=username, password=password
+            )
+        if status == diperrors.DIP_NOCOLLECTION:
+            raise DipError(status, "No SWORD collection specified for deposit")
+        if status != diperrors.DIP_SUCCESS:
+            raise DipError(status,
+                "Unknown SWORD collection specified for deposit: %s"%(collection_uri))
+        return ss
+
+    def deposit(self, collection_uri, dip=None, package=None,
+                servicedoc_uri=None, username=None, password=None,
+                format=SIMPLEZIP, jobs=1, segment_size=None):
+        """
+        Deposit a DIP (or a prebuilt package) to a SWORD collection, and
+        return the deposit token (see dipdeposit.dip_deposit).  The
+        collection must be configured (see `service`); details given are
+        saved with its configuration, as for the dip deposit command.
+        """
+        dipdir = self.use(dip)
+        ss     = self.service(collection_uri, servicedoc_uri, username, password)
+        (status, token, message) = deposit_dip_to(
+            self.configbase, dipdir, ss, basedir=self.filebase, format=format,
+            package=package, jobs=jobs, segment_size=segment_size
+            )
+        if status != diperrors.DIP_SUCCESS:
+            raise DipError(status, message)
+        dip_save_service_details(self.configbase, self.filebase, ss)
+        return token
+
+    def status(self, token):
+        """
+        Return the saved status information for a deposit (see
+        dipdeposit.status_info).
+        """
+        deposit_status = read_deposit_status(self.configbase, token)
+        if deposit_status is None:
+            raise DipError(diperrors.DIP_UNKNOWNTOKEN, "Unknown deposit token: %s"%(token))
+        return deposit_status
+
+# End.
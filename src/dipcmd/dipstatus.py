@@ -0,0 +1,282 @@
+# !/usr/bin/env python
+
+"""
+dipstatus.py - indexed store of deposit status information
+
+Status information for each deposit (the fields saved from its deposit
+receipt, and any states later read from the server) is kept in an SQLite
+database in the configuration directory.  The collection, DIP directory,
+deposit time and HTTP status of each deposit are held in indexed columns,
+so that deposits can be listed and selected without reading every record.
+
+Earlier versions saved a JSON file per deposit in the deposit status
+directory.  These are imported into the database, and removed, when the
+database is first opened.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import re
+import time
+import json
+import errno
+import sqlite3
+import calendar
+import contextlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import ensure_config_dir
+
+STATUSDB        = "deposit_status.db"
+STATUSDIR       = "deposit_status/"     # Directory of JSON status files used by earlier versions
+STATUSTIMEOUT   = 30.0                  # Time to wait for a database lock held by another process
+SCHEMAVERSION   = 1
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS deposit
+        ( token             TEXT PRIMARY KEY
+        , collection_uri    TEXT
+        , dipdir            TEXT
+        , deposited         REAL
+        , http_status       INTEGER
+        , status            TEXT NOT NULL
+        )""",
+    "CREATE INDEX IF NOT EXISTS deposit_collection ON deposit (collection_uri, deposited)",
+    "CREATE INDEX IF NOT EXISTS deposit_dipdir ON deposit (dipdir, deposited)",
+    "CREATE INDEX IF NOT EXISTS deposit_deposited ON deposit (deposited)",
+    "CREATE INDEX IF NOT EXISTS deposit_http_status ON deposit (http_status, deposited)",
+    ]
+
+class StatusStore(object):
+    """
+    Deposit status information saved in the indicated configuration directory.
+
+    Status information for a deposit is a dictionary with the fields saved
+    from its deposit receipt (see dipdeposit.status_info).  Each operation
+    uses its own database connection, so a store may be used by several
+    threads or processes.
+    """
+
+    def __init__(self, configbase):
+        self._configbase = configbase
+        self._dbname     = os.path.abspath(os.path.join(configbase, STATUSDB))
+        return
+
+    @contextlib.contextmanager
+    def _connect(self):
+        ensure_config_dir(self._configbase)
+        conn = sqlite3.connect(self._dbname, timeout=STATUSTIMEOUT)
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMAVERSION:
+                with conn:
+                    self._initialize(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+        return
+
+    def _initialize(self, conn):
+        """
+        Create the database tables, and import any status files saved by
+        earlier versions.
+        """
+        for statement in SCHEMA:
+            conn.execute(statement)
+        imported = self._import_files(conn)
+        conn.execute("PRAGMA user_version = %d"%(SCHEMAVERSION))
+        conn.commit()
+        for filename in imported:
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if imported:
+            log.info("Imported %d deposit status files into %s"%(len(imported), self._dbname))
+        return
+
+    def _import_files(self, conn):
+        statusdir = os.path.abspath(os.path.join(self._configbase, STATUSDIR))
+        if not os.path.isdir(statusdir):
+            return []
+        imported = []
+        for token in os.listdir(statusdir):
+            filename = os.path.join(statusdir, token)
+            if token.endswith((".checkpoint", ".tmp")) or not os.path.isfile(filename):
+                continue
+            try:
+                with open(filename) as drf:
+                    deposit_status = json.load(drf)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue    # Imported by another process
+            except ValueError:
+                log.warning("Ignoring invalid deposit status file %s"%(filename))
+                continue
+            deposit_status.setdefault('deposited', os.path.getmtime(filename))
+            self._put(conn, token, deposit_status)
+            imported.append(filename)
+        return imported
+
+    def _put(self, conn, token, deposit_status):
+        conn.execute(
+            "INSERT OR REPLACE INTO deposit "+
+            "(token, collection_uri, dipdir, deposited, http_status, status) "+
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ( token
+            , deposit_status.get('collection_uri')
+            , deposit_status.get('dipdir')
+            , deposit_status.get('deposited')
+            , deposit_status['response_headers'].get('status')
+            , json.dumps(deposit_status)
+            ))
+        return
+
+    def put(self, token, deposit_status):
+        """
+        Save status information for a deposit, replacing any previous information.
+        """
+        with self._connect() as conn:
+            self._put(conn, token, deposit_status)
+        return
+
+    def get(self, token):
+        """
+        Return status information for a deposit, or None if the token is not known.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM deposit WHERE token = ?", (token,)).fetchone()
+        return row and json.loads(row[0])
+
+    def select(self, collection_uris=None, dipdir=None, since=None, until=None, http_status=None):
+        """
+        Return a list of status information for deposits selected by the
+        given values, in order of deposit.
+
+        collection_uris is a list of collections to which the deposits were made.
+        dipdir          is the DIP directory from which the deposits were made.
+        since           is the earliest time of deposit (seconds since the epoch).
+        until           is the time (seconds since the epoch) before which
+                        the deposits were made.
+        http_status     is the HTTP status code of the deposit responses.
+        """
+        (where, values) = ([], [])
+        if collection_uris:
+            where.append("collection_uri IN (%s)"%(",".join("?"*len(collection_uris))))
+            values.extend(collection_uris)
+        if dipdir:
+            where.append("dipdir = ?")
+            values.append(dipdir)
+        if since is not None:
+            where.append("deposited >= ?")
+            values.append(since)
+        if until is not None:
+            where.append("deposited < ?")
+            values.append(until)
+        if http_status is not None:
+            where.append("http_status = ?")
+            values.append(http_status)
+        query = "SELECT status FROM deposit"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY deposited, token"
+        with self._connect() as conn:
+            return [ json.loads(row[0]) for row in conn.execute(query, values) ]
+
+    def tokens(self):
+        """
+        Return list of tokens of all deposits for which status information is saved.
+        """
+        with self._connect() as conn:
+            return [ row[0] for row in conn.execute("SELECT token FROM deposit ORDER BY token") ]
+
+def state_name(term):
+    """
+    Return the name of a deposit state: the last segment of the state URI.
+    """
+    return re.split(r"[/#]", term.rstrip("/#"))[-1]
+
+def deposit_state(deposit_status):
+    """
+    Return a string describing the state of a deposit from its saved status.
+    """
+    if deposit_status['response_headers']['status'] not in [200, 201]:
+        return "failed"
+    states = deposit_status.get('states')
+    if not states:
+        return "unknown"
+    return " ".join( state_name(term) for (term, description) in states )
+
+def parse_date(date, end=False):
+    """
+    Return time (seconds since the epoch) for a date given as YYYY-MM-DD or
+    YYYY-MM-DDTHH:MM:SS (UTC).  If `end` is True and only a date is given,
+    the time returned is the end of that day.
+
+    Raises ValueError if the date is not in one of these forms.
+    """
+    try:
+        t = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        t = calendar.timegm(time.strptime(date, "%Y-%m-%d"))
+        if end:
+            t += 24*60*60
+    return t
+
+def format_date(t):
+    if t is None:
+        return "-"
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+def dip_status_list(
+            configbase, collection_uris=None, dipdir=None,
+            since=None, until=None, http_status=None
+            ):
+    """
+    List saved deposits, selected by collection, DIP directory, date of
+    deposit and HTTP status of the deposit response.  A table with a line for
+    each deposit, giving its token, time of deposit, HTTP status, last known
+    state, collection and DIP directory, is written to stdout.
+
+    since   is the earliest date of deposit (see parse_date), or None.
+    until   is the latest date of deposit (see parse_date), or None.
+    Other parameters are as for StatusStore.select.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    try:
+        since = parse_date(since) if since else None
+        until = parse_date(until, end=True) if until else None
+    except ValueError as e:
+        print("Invalid date for status list: %s"%(e), file=sys.stderr)
+        return diperrors.DIP_BADCMD
+    deposits = StatusStore(configbase).select(
+        collection_uris=collection_uris, dipdir=dipdir,
+        since=since, until=until, http_status=http_status
+        )
+    rows = [("TOKEN", "DEPOSITED", "STATUS", "STATE", "COLLECTION", "DIP")]
+    for ds in deposits:
+        rows.append(
+            ( ds['token'], format_date(ds.get('deposited'))
+            , str(ds['response_headers']['status']), deposit_state(ds)
+            , ds.get('collection_uri') or "-", ds.get('dipdir') or "-"
+            ))
+    widths = [ max(len(r[i]) for r in rows) for i in range(5) ]
+    for r in rows:
+        print("%-*s  %-*s  %*s  %-*s  %-*s  %s"%
+            (widths[0], r[0], widths[1], r[1], widths[2], r[2], widths[3], r[3], widths[4], r[4], r[5]))
+    return diperrors.DIP_SUCCESS
+
+# End.
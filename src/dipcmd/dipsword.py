@@ -0,0 +1,192 @@
+# !/usr/bin/env python
+
+"""
+dipsword.py - SWORD v2 protocol operations used for deposit of packages
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import logging
+
+log = logging.getLogger(__name__)
+
+import sword2
+
+from dipcmd.dippackage  import SIMPLEZIP
+from dipcmd.diphttp     import StreamingHttpLayer
+
+PACKAGEMIMETYPE = "application/zip"
+SEGMENTMIMETYPE = "application/octet-stream"
+BINARY          = "http://purl.org/net/sword/package/Binary"
+ACKNOWLEDGED    = [200, 201, 204]
+
+class PackageSegment(object):
+    """
+    Read-only file-like view of a segment (byte range) of a package file.
+
+    Only the `read` and `seek` operations used when sending a payload are
+    supported.
+    """
+
+    def __init__(self, pkgfile, offset, length):
+        self._file   = pkgfile
+        self._offset = offset
+        self._length = length
+        self._pos    = 0
+        return
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        remaining = self._length - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ""
+        self._file.seek(self._offset + self._pos)
+        buf = self._file.read(size)
+        self._pos += len(buf)
+        return buf
+
+def sword_connection(servicedoc_uri, username, password, throttle=None):
+    """
+    Return a SWORD v2 connection for the indicated service.
+
+    Error responses from the server are returned as sword2.Error_Document
+    values rather than raised as exceptions, so that the response code can
+    be reported in the same way as for other failures.  Package content is
+    streamed to the server (see diphttp), within the limits of `throttle`
+    if given (see dipthrottle).
+    """
+    return sword2.Connection(
+        servicedoc_uri, user_name=username, user_pass=password,
+        error_response_raises_exceptions=False,
+        http_impl=StreamingHttpLayer(throttle=throttle)
+        )
+
+def deposit_package(conn, collection_uri, pkgname, format=SIMPLEZIP, in_progress=False):
+    """
+    Deposit a package file to a SWORD v2 collection, creating a new resource.
+
+    conn            is a SWORD v2 connection (see sword_connection).
+    collection_uri  is the URI of the collection to which the package is deposited.
+    pkgname         is the name of the package file.
+    format          is the SWORD packaging format of the package.
+    in_progress     is True if further content will be added to the deposit.
+
+    Returns the deposit receipt (a sword2.Deposit_Receipt, or a
+    sword2.Error_Document if the deposit failed); the HTTP response code is
+    available as the `code` attribute.
+    """
+    log.info("Deposit %s to %s"%(pkgname, collection_uri))
+    with open(pkgname, "rb") as payload:
+        return conn.create(
+            col_iri=collection_uri,
+            payload=payload,
+            mimetype=PACKAGEMIMETYPE,
+            filename=os.path.basename(pkgname),
+            packaging=format,
+            in_progress=in_progress
+            )
+
+def segment_count(pkgname, segment_size):
+    """
+    Return the number of segments of the indicated size in a package file.
+    """
+    return max(1, (os.path.getsize(pkgname) + segment_size - 1) // segment_size)
+
+def segment_filename(pkgname, index):
+    """
+    Return file name used for a segment of a package.
+    """
+    return "%s.%03d"%(os.path.basename(pkgname), index)
+
+def deposit_segments(conn, collection_uri, pkgname, checkpoint, save_checkpoint):
+    """
+    Deposit a package file to a SWORD v2 collection as a series of segments,
+    resuming a previously interrupted deposit where possible.
+
+    The first segment creates the container with In-Progress set; the
+    remaining segments are added to its media resource through the
+    Edit-Media IRI (or the SE-IRI if there is none) from the deposit
+    receipt, and the deposit is then completed by a POST to the SE-IRI
+    without In-Progress.  Segments are sent as Binary content, named by
+    `segment_filename`, to be reassembled by the server.
+
+    conn            is a SWORD v2 connection (see sword_connection).
+    collection_uri  is the URI of the collection to which the package is deposited.
+    pkgname         is the name of the package file.
+    checkpoint      is a dictionary recording progress of the deposit, with
+                    keys "segment_size" and "acknowledged" (a list of indexes
+                    of segments acknowledged by the server), and after the
+                    container is created, "edit", "edit_media" and "se_iri".
+                    It is updated as segments are acknowledged.
+    save_checkpoint is a function called with the checkpoint dictionary
+                    each time it is updated.
+
+    Returns the final deposit receipt, or the response for the first
+    request that was not successful.  Network failures are raised as
+    exceptions, after which the deposit can be resumed from the saved
+    checkpoint.
+    """
+    segsize  = checkpoint['segment_size']
+    segments = segment_count(pkgname, segsize)
+    acked    = set(checkpoint['acknowledged'])
+    with open(pkgname, "rb") as pkgfile:
+        for i in range(segments):
+            if i in acked:
+                continue
+            payload  = PackageSegment(pkgfile, i*segsize, segsize)
+            filename = segment_filename(pkgname, i)
+            log.info("Deposit segment %d of %d: %s"%(i+1, segments, filename))
+            if not checkpoint.get('edit'):
+                dr = conn.create(
+                    col_iri=collection_uri, payload=payload,
+                    mimetype=SEGMENTMIMETYPE, filename=filename, packaging=BINARY,
+                    in_progress=True
+                    )
+                if dr.code in ACKNOWLEDGED:
+                    checkpoint.update(
+                        { 'edit':       dr.edit
+                        , 'edit_media': dr.edit_media
+                        , 'se_iri':     dr.se_iri
+                        })
+            elif checkpoint.get('edit_media'):
+                dr = conn.add_file_to_resource(
+                    checkpoint['edit_media'], payload, filename,
+                    mimetype=SEGMENTMIMETYPE, packaging=BINARY, in_progress=True
+                    )
+            else:
+                dr = conn.append(
+                    se_iri=checkpoint['se_iri'], payload=payload,
+                    mimetype=SEGMENTMIMETYPE, filename=filename, packaging=BINARY,
+                    in_progress=True
+                    )
+            if dr.code not in ACKNOWLEDGED:
+                return dr
+            checkpoint['acknowledged'].append(i)
+            save_checkpoint(checkpoint)
+    dr = conn.complete_deposit(se_iri=checkpoint['se_iri'] or checkpoint['edit'])
+    if dr.code not in ACKNOWLEDGED:
+        return dr
+    if not dr.id:
+        dr = conn.get_deposit_receipt(checkpoint['edit'])
+    return dr
+
+# End.
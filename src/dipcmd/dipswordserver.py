@@ -0,0 +1,459 @@
+# !/usr/bin/env python
+
+"""
+dipswordserver.py - minimal SWORD v2 server for testing and benchmarking
+
+Runs a SWORD v2 server in a background thread of the current process (or,
+from the command line, in a process of its own), so that deposit operations
+can be tested and measured without a separate SWORD server.
+
+Each collection POST creates a container, whose deposit receipt provides
+Edit, Edit-Media and SE-IRI links.  Files sent to the collection or added
+to a container are recorded, along with the headers of each request.
+Each statement request for a container returns the next of the states
+listed for it in `states` (staying at the last), by default "inProgress".
+A service document describing collections "/col" (accepting SimpleZip
+and Binary packages) and "/colbinary" (accepting Binary packages only)
+is served at "/sd", with an ETag for conditional requests.
+The files of SimpleZip packages sent to a container are unpacked into
+`files`, listed in its statement, and can be deleted through their URIs.
+
+Network conditions can be simulated by a delay before each response, a
+limit on the rate at which request and response bodies are transferred,
+and failure of a proportion of deposits.  E.g., to serve on port 8080 with
+50ms latency, 1MB/s bandwidth, and one deposit in ten refused with 503:
+
+    python -m dipcmd.dipswordserver --port 8080 --latency 0.05 \\
+        --bandwidth 1048576 --fail_rate 0.1 --fail_status 503
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2011-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import re
+import time
+import random
+import socket
+import zipfile
+import tempfile
+import argparse
+import StringIO
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from dipcmd.dipthrottle import TokenBucket
+
+RECEIPT = """<?xml version="1.0" encoding="utf-8"?>
+<entry xmlns="http://www.w3.org/2005/Atom" xmlns:sword="http://purl.org/net/sword/terms/">
+  <title>Deposit %(cid)s</title>
+  <id>tag:container@test/%(cid)s/token%(cid)s</id>
+  <updated>2014-01-01T00:00:00Z</updated>
+  <content type="application/zip" src="%(base)s/cont/%(cid)s"/>
+  <link rel="edit" href="%(base)s/edit/%(cid)s"/>
+  <link rel="edit-media" href="%(base)s/em/%(cid)s"/>
+  <link rel="http://purl.org/net/sword/terms/add" href="%(base)s/se/%(cid)s"/>
+  <link rel="http://purl.org/net/sword/terms/statement" type="application/atom+xml;type=feed"
+        href="%(base)s/state/%(cid)s"/>
+  <sword:packaging>http://purl.org/net/sword/package/SimpleZip</sword:packaging>
+</entry>
+"""
+
+SERVICEDOC = """<?xml version="1.0" encoding="utf-8"?>
+<service xmlns="http://www.w3.org/2007/app" xmlns:atom="http://www.w3.org/2005/Atom"
+    xmlns:sword="http://purl.org/net/sword/terms/">
+  <sword:version>2.0</sword:version>
+  <workspace>
+    <atom:title>Test</atom:title>
+    <collection href="%(base)s/col">
+      <atom:title>Collection</atom:title>
+      <accept>*/*</accept>
+      <accept alternate="multipart-related">*/*</accept>
+      <sword:mediation>false</sword:mediation>
+      <sword:acceptPackaging>http://purl.org/net/sword/package/SimpleZip</sword:acceptPackaging>
+      <sword:acceptPackaging>http://purl.org/net/sword/package/Binary</sword:acceptPackaging>
+    </collection>
+    <collection href="%(base)s/colbinary">
+      <atom:title>Binary collection</atom:title>
+      <accept>*/*</accept>
+      <accept alternate="multipart-related">*/*</accept>
+      <sword:mediation>false</sword:mediation>
+      <sword:acceptPackaging>http://purl.org/net/sword/package/Binary</sword:acceptPackaging>
+    </collection>
+  </workspace>
+</service>
+"""
+
+SERVICEDOCETAG = '"sd1"'
+
+STATEMENT = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <id>%(base)s/state/%(cid)s</id>
+  <title>Deposit %(cid)s</title>
+  <updated>2014-01-01T00:00:00Z</updated>
+  <category scheme="http://purl.org/net/sword/terms/state" term="%(state)s">State</category>
+%(entries)s</feed>
+"""
+
+STATEMENTENTRY = """  <entry>
+    <id>%(base)s/cont/%(cid)s/%(name)s</id>
+    <title>%(name)s</title>
+    <updated>2014-01-01T00:00:00Z</updated>
+    <content type="application/octet-stream" src="%(base)s/cont/%(cid)s/%(name)s"/>
+  </entry>
+"""
+
+SIMPLEZIP  = "http://purl.org/net/sword/package/SimpleZip"
+
+INPROGRESS = "http://localhost/state/inProgress"
+ARCHIVED   = "http://localhost/state/archived"
+
+READSIZE   = 65536          # Size of blocks in which request bodies are read
+
+class SwordRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_data(self, size, body):
+        received = 0
+        while size > 0:
+            data = self.rfile.read(min(size, READSIZE))
+            if not data:
+                break
+            self.server.transfer(len(data))
+            if body is not None:
+                body.write(data)
+            received += len(data)
+            size     -= len(data)
+        return received
+
+    def read_body(self):
+        """
+        Read a request body, returning a pair (body, size).  The body is
+        kept in memory if the server keeps content; otherwise a SimpleZip
+        package is written to a temporary file (so that its file names can
+        be read), and any other content is discarded, with body None.
+        """
+        if self.server.keep_content:
+            body = StringIO.StringIO()
+        elif self.headers.get("packaging") == SIMPLEZIP:
+            body = tempfile.TemporaryFile()
+        else:
+            body = None
+        size = 0
+        if self.headers.get("transfer-encoding", "") == "chunked":
+            while True:
+                chunksize = int(self.rfile.readline().strip(), 16)
+                size += self.read_data(chunksize, body)
+                self.rfile.readline()
+                if chunksize == 0:
+                    break
+        else:
+            size = self.read_data(int(self.headers.get("content-length", "0")), body)
+        self.server.received += size
+        return (body, size)
+
+    def send(self, status, body="", headers={}):
+        self.server.delay()
+        self.server.transfer(len(body))
+        self.send_response(status)
+        for (h, v) in headers.items():
+            self.send_header(h, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def send_receipt(self, status, cid):
+        base = "http://%s:%d"%self.server.server_address
+        self.send(status, RECEIPT%{'cid': cid, 'base': base},
+            { 'Content-Type': "application/atom+xml;type=entry"
+            , 'Location':     "%s/edit/%s"%(base, cid)
+            })
+        return
+
+    def do_GET(self):
+        self.server.record("GET", self.path, dict(self.headers.items()))
+        if self.path == "/sd":
+            if self.headers.get("if-none-match") == SERVICEDOCETAG:
+                self.send(304, headers={ 'ETag': SERVICEDOCETAG })
+            else:
+                base = "http://%s:%d"%self.server.server_address
+                self.send(200, SERVICEDOC%{'base': base},
+                    { 'Content-Type': "application/atomsvc+xml"
+                    , 'ETag':         SERVICEDOCETAG
+                    })
+            return
+        m = re.match(r"^/edit/(\d+)$", self.path)
+        if m and m.group(1) in self.server.containers:
+            self.send_receipt(200, m.group(1))
+            return
+        m = re.match(r"^/state/(\d+)$", self.path)
+        if m and m.group(1) in self.server.containers:
+            with self.server.lock:
+                states = self.server.states.setdefault(m.group(1), [INPROGRESS])
+                state  = states.pop(0) if len(states) > 1 else states[0]
+            etag = '"%s"'%(state)
+            if self.headers.get("if-none-match") == etag:
+                self.send(304, headers={ 'ETag': etag })
+            else:
+                base    = "http://%s:%d"%self.server.server_address
+                entries = "".join(
+                    STATEMENTENTRY%{'cid': m.group(1), 'base': base, 'name': name}
+                    for name in sorted(self.server.files.get(m.group(1), {}))
+                    )
+                self.send(200,
+                    STATEMENT%{'cid': m.group(1), 'base': base, 'state': state, 'entries': entries},
+                    { 'Content-Type': "application/atom+xml;type=feed"
+                    , 'ETag':         etag
+                    })
+        else:
+            self.send(404)
+        return
+
+    def do_POST(self):
+        headers = dict(self.headers.items())
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            (body, size) = self.read_body()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+        try:
+            self.post(headers, body, size)
+        finally:
+            if body is not None:
+                body.close()
+        return
+
+    def post(self, headers, body, size):
+        self.server.record("POST", self.path, headers)
+        if self.server.fail(self.path, headers):
+            if self.server.fail_status:
+                self.send(self.server.fail_status)
+            else:
+                # Drop connection without response
+                self.close_connection = 1
+            return
+        stored = body.getvalue() if self.server.keep_content else ""
+        filename = None
+        m = re.search(r"filename=(.*)$", headers.get("content-disposition", ""))
+        if m:
+            filename = m.group(1)
+        if self.path.startswith("/col"):
+            with self.server.lock:
+                cid = str(len(self.server.containers)+1)
+                self.server.containers[cid]  = [(filename, stored)]
+                self.server.collections[cid] = self.path
+                self.unpack(cid, headers, body)
+            self.send_receipt(201, cid)
+            return
+        m = re.match(r"^/(em|se)/(\d+)$", self.path)
+        if m and m.group(2) in self.server.containers:
+            if size:
+                with self.server.lock:
+                    self.server.containers[m.group(2)].append((filename, stored))
+                    self.unpack(m.group(2), headers, body)
+            self.send_receipt(200 if m.group(1) == "se" else 201, m.group(2))
+            return
+        self.send(404)
+        return
+
+    def do_DELETE(self):
+        self.server.record("DELETE", self.path, dict(self.headers.items()))
+        m = re.match(r"^/cont/(\d+)/(.+)$", self.path)
+        with self.server.lock:
+            files = self.server.files.get(m.group(1), {}) if m else {}
+            if m and m.group(2) in files:
+                del files[m.group(2)]
+                self.send(204)
+            else:
+                self.send(404)
+        return
+
+    def unpack(self, cid, headers, body):
+        """
+        Record the files of a SimpleZip package sent to a container,
+        replacing any existing files of the same name.
+        """
+        if headers.get("packaging") != SIMPLEZIP or body is None:
+            return
+        body.seek(0)
+        z = zipfile.ZipFile(body)
+        files = self.server.files.setdefault(cid, {})
+        for name in z.namelist():
+            files[name] = z.read(name) if self.server.keep_content else ""
+        return
+
+class SwordServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    SWORD v2 server, run in a background thread.  Each connection is
+    handled by a separate thread, and connections are kept alive between
+    requests until the server is stopped.
+
+    Use as a context manager: the server is started on entry and stopped
+    on exit.  Any path starting "/col" is treated as a collection.
+    `containers` is a dictionary of (filename, content) lists keyed by
+    container id, `collections` the collection path for each container,
+    `states` a list of deposit states for each container (see above),
+    `files` a dictionary of unpacked file content for each container,
+    `requests` a list of (method, path, headers) for requests received,
+    `received` the number of bytes of request bodies received, and
+    `max_active` the largest number of POST request bodies that were
+    being received at the same time.  If `keep_content` is False, content
+    is recorded as empty strings and request bodies are not kept in memory
+    (e.g. to benchmark large deposits), and if `record_requests` is False,
+    `requests` is left empty (e.g. for a long-running server).
+
+    `latency` is a delay in seconds before each response, and `bandwidth`
+    a limit in bytes per second on the rate at which request and response
+    bodies are transferred, shared by all connections.
+    A request can be made to fail by supplying a function that is called
+    with the request path and headers and returns True to fail the request,
+    and a proportion `fail_rate` of deposits (chosen at random, using
+    `seed`) fail.  A failed deposit receives a response with status
+    `fail_status`, or if that is None, the connection is dropped without a
+    response.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, fail=None, host="localhost", port=0,
+                 latency=0.0, bandwidth=None, fail_rate=0.0, fail_status=None,
+                 keep_content=True, record_requests=True, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), SwordRequestHandler)
+        self.lock         = threading.Lock()
+        self.containers   = {}
+        self.collections  = {}
+        self.states       = {}
+        self.files        = {}
+        self.requests     = []
+        self.received     = 0
+        self.active       = 0
+        self.max_active   = 0
+        self.latency      = latency
+        self.fail_rate    = fail_rate
+        self.fail_status  = fail_status
+        self.keep_content = keep_content
+        self.record_requests = record_requests
+        self._fail        = fail
+        self._random      = random.Random(seed)
+        self._bandwidth   = bandwidth and TokenBucket(bandwidth)
+        self._thread      = None
+        self._connections = set()
+        return
+
+    def record(self, method, path, headers):
+        if self.record_requests:
+            with self.lock:
+                self.requests.append((method, path, headers))
+        return
+
+    def fail(self, path, headers):
+        if self._fail and self._fail(path, headers):
+            return True
+        with self.lock:
+            return self._random.random() < self.fail_rate
+
+    def delay(self):
+        """
+        Wait for the configured latency before responding to a request.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        return
+
+    def transfer(self, nbytes):
+        """
+        Wait until `nbytes` may be transferred within the configured bandwidth.
+        """
+        if self._bandwidth:
+            self._bandwidth.take(nbytes)
+        return
+
+    def uri(self, path):
+        return "http://%s:%d%s"%(self.server_address[0], self.server_address[1], path)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        return
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+        return
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        # Close kept-alive connections, so that their handler threads end
+        with self.lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        return False
+
+def runServer(argv):
+    """
+    Run a SWORD server as specified by command line arguments (not
+    including the program name), until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Run a minimal SWORD v2 server")
+    parser.add_argument("--host", default="localhost",
+                        help="Host name or address on which to listen")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port on which to listen (0 for any free port)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay in seconds before each response")
+    parser.add_argument("--bandwidth", type=int, default=None,
+                        help="Limit in bytes per second on transfer of request and response bodies")
+    parser.add_argument("--fail_rate", type=float, default=0.0,
+                        help="Proportion of deposits that fail")
+    parser.add_argument("--fail_status", type=int, default=None,
+                        help="HTTP status returned for failed deposits (default: drop connection)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for random choice of failed deposits")
+    options = parser.parse_args(argv)
+    server  = SwordServer(
+        host=options.host, port=options.port,
+        latency=options.latency, bandwidth=options.bandwidth,
+        fail_rate=options.fail_rate, fail_status=options.fail_status,
+        keep_content=False, record_requests=False, seed=options.seed
+        )
+    print("servicedoc_uri=%s"%(server.uri("/sd")))
+    print("collection_uri=%s"%(server.uri("/col")))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(runServer(sys.argv[1:]))
+
+# End.
@@ -0,0 +1,201 @@
+# !/usr/bin/env python
+
+"""
+dipthrottle.py - limits on the rate of requests and uploads to servers
+
+Limits are configured in the "throttle" section of the configuration file,
+keyed by collection URI or by server host (with port, if not the default):
+
+    "throttle": {
+        "repository.example.org": {
+            "max_uploads":          2,
+            "bytes_per_second":     1048576,
+            "requests_per_second":  5
+        }
+    }
+
+The limits for a deposit are those for its collection URI if configured,
+otherwise those for the host of its collection URI or of its service
+document URI.  Limits are shared by all deposits in a process that use the
+same configuration entry, so concurrent deposits together stay within them.
+Request and byte rates are enforced by token buckets that allow bursts of
+up to one second's worth of requests or data.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import time
+import urlparse
+import threading
+import contextlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from dipcmd.dipconfig   import readconfig
+
+RETRYAFTER      = 1.0       # Pause (seconds) after 429 or 503 response with no Retry-After
+
+# Throttles shared by deposits in this process, keyed by configuration entry
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+class TokenBucket(object):
+    """
+    Token bucket that is refilled at `rate` tokens per second, up to
+    `capacity` tokens.  `take` waits until the requested number of tokens
+    is available; a request for more than the capacity waits until the
+    bucket is full, and leaves it in debt.  A bucket may be used by several
+    threads.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self._rate     = float(rate)
+        self._capacity = float(capacity or rate)
+        self._tokens   = self._capacity
+        self._clock    = clock
+        self._sleep    = sleep
+        self._updated  = clock()
+        self._lock     = threading.Lock()
+        return
+
+    def _refill(self, now):
+        self._tokens  = min(self._capacity, self._tokens + (now - self._updated)*self._rate)
+        self._updated = now
+        return
+
+    def take(self, n=1):
+        """
+        Take `n` tokens from the bucket, waiting until they are available.
+
+        Returns the time spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                needed = min(n, self._capacity)
+                if self._tokens >= needed - self._capacity*1e-9:    # Allow for rounding
+                    self._tokens -= n
+                    return waited
+                wait = (needed - self._tokens)/self._rate
+            self._sleep(wait)
+            waited += wait
+
+class HostThrottle(object):
+    """
+    Limits on concurrent uploads, bytes per second sent, and requests per
+    second to a server.  Any limit may be None, meaning no limit.
+    """
+
+    def __init__(self, max_uploads=None, bytes_per_second=None, requests_per_second=None):
+        self.limits    = (max_uploads, bytes_per_second, requests_per_second)
+        self._uploads  = max_uploads and threading.BoundedSemaphore(max_uploads)
+        self._bytes    = bytes_per_second and TokenBucket(bytes_per_second)
+        self._requests = requests_per_second and TokenBucket(requests_per_second)
+        self._paused   = 0.0
+        self._lock     = threading.Lock()
+        return
+
+    @contextlib.contextmanager
+    def request(self, upload=False):
+        """
+        Context manager for a request to the server.  Waits for the request
+        rate limit and any pause requested by the server, and for uploads,
+        holds one of the available upload slots while active.
+        """
+        if self._uploads and upload:
+            self._uploads.acquire()
+        try:
+            with self._lock:
+                wait = self._paused - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if self._requests:
+                self._requests.take()
+            yield self
+        finally:
+            if self._uploads and upload:
+                self._uploads.release()
+        return
+
+    def transfer(self, nbytes):
+        """
+        Wait until `nbytes` may be sent within the bytes per second limit.
+        """
+        if self._bytes:
+            self._bytes.take(nbytes)
+        return
+
+    def pause(self, seconds):
+        """
+        Delay further requests to the server by the indicated time (e.g. as
+        requested by a Retry-After header).
+        """
+        log.info("Pausing requests for %.1f seconds"%(seconds))
+        with self._lock:
+            self._paused = max(self._paused, time.time()+seconds)
+        return
+
+def retry_after(value):
+    """
+    Return delay in seconds from a Retry-After header value, or the default
+    if the value is missing or is not a number of seconds.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return RETRYAFTER
+
+def throttle_key(throttle_config, collection_uri, servicedoc_uri=None):
+    """
+    Return the key of the configured limits that apply to a collection, or
+    None if there are none.
+    """
+    if collection_uri in throttle_config:
+        return collection_uri
+    for uri in [collection_uri, servicedoc_uri]:
+        host = uri and urlparse.urlsplit(uri).netloc
+        if host and host in throttle_config:
+            return host
+    return None
+
+def host_throttle(configbase, collection_uri, servicedoc_uri=None, max_uploads=None):
+    """
+    Return the HostThrottle for deposits to a collection, or None if no
+    limits are configured for it.  The same HostThrottle is returned for
+    all collections that use the same configured limits, unless the limits
+    are changed.
+
+    If `max_uploads` is given (e.g. by the --server_jobs option), it further
+    limits concurrent uploads; if no limits are configured for the
+    collection, its limits are shared by all collections on the same host.
+    """
+    throttle_config = readconfig(configbase).get('throttle') or {}
+    key = throttle_key(throttle_config, collection_uri, servicedoc_uri)
+    if key is None and max_uploads:
+        key = urlparse.urlsplit(collection_uri).netloc
+    if key is None:
+        return None
+    limits = throttle_config.get(key) or {}
+    uploads = limits.get('max_uploads')
+    if max_uploads:
+        uploads = min(uploads or max_uploads, max_uploads)
+    limits = ( uploads
+             , limits.get('bytes_per_second')
+             , limits.get('requests_per_second')
+             )
+    with _throttles_lock:
+        throttle = _throttles.get(key)
+        if throttle is None or throttle.limits != limits:
+            throttle = HostThrottle(*limits)
+            _throttles[key] = throttle
+    return throttle
+
+# End.
@@ -0,0 +1,190 @@
+# !/usr/bin/env python
+
+"""
+dipupdate.py - update a deposited DIP with the changes made since its deposit
+
+The index of the package sent with a deposit (see dippackage) is saved with
+the deposit status.  An update compares the DIP's current files against
+that index, and changes the existing container on the server rather than
+depositing the whole DIP again: new and modified files are sent as a
+SimpleZip package added to the container's media resource (through its
+Edit-Media IRI, or the SE-IRI if there is none), and files that are no
+longer in the DIP are deleted using the resource IRIs listed in the
+deposit's SWORD statement.  Servers are expected to replace existing files
+of the same name when unpacking the added package.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import urllib
+import urlparse
+import httplib
+import logging
+
+log = logging.getLogger(__name__)
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import readconfig
+from dipcmd.diplocal    import dip_use, file_state, open_dip
+from dipcmd.dippackage  import (
+    SIMPLEZIP, INDEXSUFFIX, package_dir, package_members, build_zip_package
+    )
+from dipcmd.dipdeposit  import read_deposit_status, write_deposit_status
+from dipcmd.dipthrottle import host_throttle
+from dipcmd.dipsword    import sword_connection, PACKAGEMIMETYPE, ACKNOWLEDGED
+from dipcmd.dipwatch    import watch_credentials
+
+UPDATEFILE = "update.zip"
+
+def package_changes(files, members):
+    """
+    Compare the current content of a package with the index saved when it
+    was deposited.
+
+    files       is the saved package index (see dippackage.read_package_index).
+    members     is a list of (path, arcname) pairs for the current package content.
+
+    Returns a triple (added, changed, removed), where added and changed are
+    lists of (path, arcname) pairs for new and modified files, and removed
+    is a list of the entry names of files no longer in the package.
+    """
+    (added, changed) = ([], [])
+    for (path, arcname) in members:
+        previous = files.get(arcname)
+        if previous is None:
+            added.append((path, arcname))
+        elif previous['state'] != file_state(path):
+            changed.append((path, arcname))
+    arcnames = set( arcname for (path, arcname) in members )
+    removed  = sorted( arcname for arcname in files if arcname not in arcnames )
+    return (added, changed, removed)
+
+def uri_path(uri):
+    return urllib.unquote(urlparse.urlsplit(uri).path)
+
+def resource_uris(conn, deposit_status):
+    """
+    Return a dictionary of the URIs of files in a deposited container, read
+    from the deposit's SWORD statement and keyed by the unquoted path of each
+    file relative to the container's content URI (i.e. its package entry
+    name), or None if the statement or content URI cannot be read.
+    """
+    (statement_iri, cont_iri) = (deposit_status.get('statement'), deposit_status.get('cont_iri'))
+    if not (statement_iri and cont_iri):
+        dr = conn.get_deposit_receipt(deposit_status['edit'])
+        statement_iri = statement_iri or getattr(dr, "atom_statement_iri", None)
+        cont_iri      = cont_iri or getattr(dr, "cont_iri", None)
+        if not (statement_iri and cont_iri):
+            return None
+    statement = conn.get_atom_sword_statement(statement_iri)
+    if statement is None:
+        return None
+    prefix = uri_path(cont_iri).rstrip("/")+"/"
+    return dict( (uri_path(r.uri)[len(prefix):], r.uri)
+                 for r in statement.resources if r.uri and uri_path(r.uri).startswith(prefix) )
+
+def dip_update(configbase, dipdir, token, username=None, password=None, basedir=None, jobs=1):
+    """
+    Update a deposit with the changes made to a DIP since it was deposited
+    (or last updated).  A line of the form:
+
+        token=<deposit-token> added=<count> changed=<count> removed=<count> bytes=<size>
+
+    is written to stdout, where size is the size of the package of new and
+    modified files sent to the server.  The saved index of the deposit is
+    then replaced by the index of the DIP's current files.
+
+    dipdir      is a fully qualified directory name of the deposited DIP.
+    token       is the token of the deposit to update.
+    username    is a username used for the update, or None to use the
+                username configured for the deposit's collection.
+    password    is the password for `username`.
+    basedir     is a base directory used for calculation of relative paths
+                within the package, as used when the DIP was deposited.
+    jobs        is the number of worker processes used to compress files.
+
+    returns zero to indicate success, or a non-zero status code.
+    """
+    deposit_status = read_deposit_status(configbase, token)
+    if deposit_status is None:
+        print("Unknown deposit token: %s"%token, file=sys.stderr)
+        return diperrors.DIP_UNKNOWNTOKEN
+    files = deposit_status.get('files')
+    if not files or not (deposit_status.get('edit_media') or deposit_status.get('se_iri')):
+        print("Deposit %s cannot be updated (no saved file list or Edit-Media IRI); "%(token)+
+              "deposit the DIP again", file=sys.stderr)
+        return diperrors.DIP_NOUPDATE
+    status = dip_use(dipdir, report_dir=False)
+    if status != diperrors.DIP_SUCCESS:
+        return status
+    d       = open_dip(dipdir)
+    members = package_members(d, basedir=basedir)
+    for (path, arcname) in members:
+        if file_state(path) is None:
+            print("File in DIP is missing or cannot be read: %s"%(path), file=sys.stderr)
+            return diperrors.DIP_FILEMISSING
+    (added, changed, removed) = package_changes(files, members)
+    collection_uri = deposit_status.get('collection_uri')
+    svcinfo        = readconfig(configbase).get('collections', {}).get(collection_uri, {})
+    (username, password) = watch_credentials(configbase, deposit_status, username, password)
+    throttle = host_throttle(configbase, collection_uri, svcinfo.get('servicedoc_uri'))
+    conn     = sword_connection(svcinfo.get('servicedoc_uri'), username, password, throttle=throttle)
+    pkgname  = os.path.join(package_dir(dipdir, SIMPLEZIP), UPDATEFILE)
+    size     = 0
+    try:
+        if added or changed:
+            build_zip_package(pkgname, added+changed, jobs=jobs, incremental=False)
+            size = os.path.getsize(pkgname)
+            log.info("Update %s: sending %d files (%d bytes)"%(token, len(added+changed), size))
+            with open(pkgname, "rb") as payload:
+                if deposit_status.get('edit_media'):
+                    dr = conn.add_file_to_resource(
+                        deposit_status['edit_media'], payload, UPDATEFILE,
+                        mimetype=PACKAGEMIMETYPE, packaging=SIMPLEZIP, in_progress=False
+                        )
+                else:
+                    dr = conn.append(
+                        se_iri=deposit_status['se_iri'], payload=payload,
+                        mimetype=PACKAGEMIMETYPE, filename=UPDATEFILE, packaging=SIMPLEZIP,
+                        in_progress=False
+                        )
+            if dr.code not in ACKNOWLEDGED:
+                print("SWORD update failed: %d"%dr.code, file=sys.stderr)
+                return diperrors.DIP_DEPOSITFAIL
+        if removed:
+            resources = resource_uris(conn, deposit_status)
+            if resources is None:
+                print("Cannot read statement for deposit %s to remove files"%(token), file=sys.stderr)
+                return diperrors.DIP_DEPOSITFAIL
+            for arcname in removed:
+                uri = resources.get(arcname)
+                if uri is None:
+                    log.warning("File %s not found in deposit %s"%(arcname, token))
+                    continue
+                dr = conn.delete_file(uri)
+                if dr.code not in ACKNOWLEDGED + [404, 410]:
+                    print("SWORD delete of %s failed: %d"%(uri, dr.code), file=sys.stderr)
+                    return diperrors.DIP_DEPOSITFAIL
+    except (IOError, httplib.HTTPException) as e:
+        print("Update interrupted (%s); run the update again"%(e), file=sys.stderr)
+        return diperrors.DIP_INTERRUPTED
+    finally:
+        for filename in [pkgname, pkgname+INDEXSUFFIX]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    deposit_status['files'] = dict(
+        (arcname, { 'path': path, 'state': file_state(path) }) for (path, arcname) in members
+        )
+    write_deposit_status(configbase, token, deposit_status)
+    print("token=%s added=%d changed=%d removed=%d bytes=%d"%
+          (token, len(added), len(changed), len(removed), size))
+    return diperrors.DIP_SUCCESS
+
+# End.
@@ -0,0 +1,250 @@
+# !/usr/bin/env python
+
+"""
+dipwatch.py - watch the state of SWORD deposits until they are complete
+
+The SWORD statement of each deposit (found from the saved deposit receipt)
+is polled by a pool of worker threads.  Each deposit is polled at its own
+interval, which is doubled each time its state is found unchanged (up to a
+maximum) and reset when it changes, so that deposits that are progressing
+are checked often while those that are waiting on the server cost little.
+A deposit is no longer watched after several consecutive failed polls, and
+watching can be limited to a given time.  Statements are fetched with conditional requests where the server provides
+an ETag, over pooled persistent connections (see diphttp).
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2013-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import time
+import heapq
+import httplib
+import logging
+
+log = logging.getLogger(__name__)
+
+from multiprocessing.pool import ThreadPool
+
+from sword2             import Deposit_Receipt, Atom_Sword_Statement
+
+from dipcmd             import diperrors
+from dipcmd.dipconfig   import readconfig
+from dipcmd.diphttp     import StreamingHttpLayer
+from dipcmd.dipdeposit  import read_deposit_status, write_deposit_status, saved_tokens
+from dipcmd.dipstatus   import state_name, deposit_state
+
+WATCHJOBS       = 16            # Default number of statements polled concurrently
+POLLINTERVAL    = 5.0           # Initial interval (seconds) between polls of a deposit
+MAXINTERVAL     = 300.0         # Maximum interval between polls of a deposit
+MAXFAILURES     = 5             # Consecutive failed polls before a deposit is no longer watched
+
+# Deposit states after which the state is not expected to change.  These are
+# matched against the last segment of a state URI, as the URIs used for
+# states are defined by each repository (e.g. EPrints uses "archive" and
+# "deletion").
+TERMINALSTATES  = [
+    "archived", "published", "withdrawn", "rejected", "deleted", "failed",
+    "archive", "deletion"
+    ]
+
+STATEMENTTYPE   = "application/atom+xml;type=feed"
+RECEIPTTYPE     = "application/atom+xml;type=entry"
+
+def deposit_finished(deposit_status):
+    """
+    Return True if a deposit has reached a state after which it is not
+    expected to change.
+    """
+    if deposit_status['response_headers']['status'] not in [200, 201]:
+        return True
+    return any( state_name(term).lower() in TERMINALSTATES
+                for (term, description) in deposit_status.get('states') or [] )
+
+class PollError(Exception):
+    """
+    Exception raised when the server does not provide the state of a deposit.
+    """
+    pass
+
+class DepositWatch(object):
+    """
+    Polling state for a watched deposit.  Watches are ordered by the time at
+    which they are next due to be polled.
+    """
+
+    def __init__(self, token, deposit_status, http, interval):
+        self.token    = token
+        self.status   = deposit_status
+        self.http     = http
+        self.interval = interval
+        self.due      = 0
+        self.failures = 0
+        return
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+def poll_deposit(http, deposit_status):
+    """
+    Fetch the SWORD statement for a deposit, and update its saved status
+    (in memory) with the deposit states.
+
+    If the statement IRI is not known, it is first found from the deposit
+    receipt obtained from the Edit-IRI.  A deposit whose receipt or
+    statement no longer exists is given the state "deleted".
+
+    Returns True if the deposit states have changed, otherwise False.
+    Raises PollError if the receipt or statement cannot be read.
+    """
+    if not deposit_status.get('statement'):
+        (resp, content) = http.request(deposit_status['edit'], "GET", headers={'Accept': RECEIPTTYPE})
+        if resp['status'] in [404, 410]:
+            return set_deposit_gone(deposit_status, resp['status'])
+        if resp['status'] != 200:
+            raise PollError("Cannot read deposit receipt %s: %d"%(deposit_status['edit'], resp['status']))
+        dr = Deposit_Receipt(xml_deposit_receipt=content)
+        if not dr.atom_statement_iri:
+            raise PollError("No statement for deposit %s"%(deposit_status['token']))
+        deposit_status['statement'] = dr.atom_statement_iri
+    headers = {'Accept': STATEMENTTYPE}
+    if deposit_status.get('statement_etag'):
+        headers['If-None-Match'] = deposit_status['statement_etag']
+    (resp, content) = http.request(deposit_status['statement'], "GET", headers=headers)
+    if resp['status'] == 304:
+        return False
+    if resp['status'] in [404, 410]:
+        return set_deposit_gone(deposit_status, resp['status'])
+    if resp['status'] != 200:
+        raise PollError("Cannot read statement %s: %d"%(deposit_status['statement'], resp['status']))
+    deposit_status['statement_etag'] = resp.get('etag')
+    states = [ [term, description] for (term, description) in Atom_Sword_Statement(content).states ]
+    if states == deposit_status.get('states'):
+        return False
+    deposit_status['states'] = states
+    return True
+
+def set_deposit_gone(deposit_status, code):
+    """
+    Record that a deposit no longer exists on the server.
+    """
+    deposit_status['states'] = [["deleted", "Deposit no longer available (%d)"%(code)]]
+    return True
+
+def watch_credentials(configbase, deposit_status, username, password):
+    """
+    Return (username, password) for polling a deposit: those given, or
+    those configured for the collection to which it was deposited.
+    """
+    if username:
+        return (username, password)
+    collections = readconfig(configbase).get('collections', {})
+    svcinfo     = collections.get(deposit_status.get('collection_uri'), {})
+    return (svcinfo.get('username'), svcinfo.get('password'))
+
+def dip_status_watch(
+            configbase, tokens=None, username=None, password=None,
+            jobs=WATCHJOBS, interval=POLLINTERVAL, maxinterval=MAXINTERVAL,
+            timeout=None, maxfailures=MAXFAILURES
+            ):
+    """
+    Poll the server for the state of deposits until they have all reached a
+    terminal state (see TERMINALSTATES).  A deposit is no longer watched
+    after `maxfailures` consecutive polls fail, and watching stops after
+    `timeout` seconds; either is reported on stderr.
+
+    The state of each deposit is written to stdout when watching starts and
+    whenever it changes, in the form:
+
+        token=<deposit-token> state=<state>
+
+    and the saved status of the deposit is updated with the new state.
+
+    tokens      is a list of deposit tokens, or None to watch all deposits
+                for which status information is saved.
+    username    is a username used to read deposit statements, or None to
+                use the username configured for each deposit's collection.
+    password    is the password for `username`.
+    jobs        is the number of statements polled concurrently.
+    interval    is the initial interval in seconds between polls of a deposit.
+    maxinterval is the maximum interval between polls of a deposit.
+    timeout     is the maximum time in seconds to watch deposits, or None.
+    maxfailures is the number of consecutive failed polls after which a
+                deposit is no longer watched.
+
+    returns zero to indicate success, or a non-zero status code
+    (DIP_WATCHINCOMPLETE if any deposit was still unfinished when watching
+    stopped).
+    """
+    if tokens is None:
+        tokens = saved_tokens(configbase)
+    deadline   = timeout is not None and time.time() + timeout
+    incomplete = []
+    watches    = []
+    http    = {}    # HTTP layers, keyed by credentials
+    for token in tokens:
+        deposit_status = read_deposit_status(configbase, token)
+        if deposit_status is None:
+            print("Unknown deposit token: %s"%token, file=sys.stderr)
+            return diperrors.DIP_UNKNOWNTOKEN
+        print("token=%s state=%s"%(token, deposit_state(deposit_status)))
+        if not deposit_finished(deposit_status):
+            credentials = watch_credentials(configbase, deposit_status, username, password)
+            if credentials not in http:
+                http[credentials] = StreamingHttpLayer()
+                if credentials[0]:
+                    http[credentials].add_credentials(*credentials)
+            watches.append(DepositWatch(token, deposit_status, http[credentials], interval))
+    def poll(watch):
+        try:
+            return poll_deposit(watch.http, watch.status)
+        except (PollError, IOError, httplib.HTTPException) as e:
+            log.warning("Cannot poll deposit %s: %s"%(watch.token, e))
+            return None
+    heapq.heapify(watches)
+    pool = ThreadPool(max(1, jobs))
+    try:
+        while watches:
+            now = time.time()
+            if deadline and now >= deadline:
+                print("Timed out watching deposits: %s"%
+                      (" ".join(sorted( w.token for w in watches ))), file=sys.stderr)
+                incomplete.extend( w.token for w in watches )
+                break
+            if watches[0].due > now:
+                time.sleep(min(watches[0].due, deadline or watches[0].due) - now)
+                continue
+            due = []
+            while watches and watches[0].due <= now:
+                due.append(heapq.heappop(watches))
+            log.debug("Polling %d deposits (%d waiting)"%(len(due), len(watches)))
+            for (watch, changed) in zip(due, pool.map(poll, due)):
+                if changed is None:
+                    watch.failures += 1
+                    if watch.failures >= maxfailures:
+                        print("Stopped watching deposit %s after %d failed polls"%
+                              (watch.token, watch.failures), file=sys.stderr)
+                        incomplete.append(watch.token)
+                        continue
+                else:
+                    watch.failures = 0
+                if changed:
+                    write_deposit_status(configbase, watch.token, watch.status)
+                    print("token=%s state=%s"%(watch.token, deposit_state(watch.status)))
+                    watch.interval = interval
+                else:
+                    watch.interval = min(watch.interval*2, maxinterval)
+                if not deposit_finished(watch.status):
+                    watch.due = time.time() + watch.interval
+                    heapq.heappush(watches, watch)
+    finally:
+        pool.terminate()
+    if incomplete:
+        return diperrors.DIP_WATCHINCOMPLETE
+    return diperrors.DIP_SUCCESS
+
+# End.
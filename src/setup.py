@@ -30,7 +30,7 @@ dio-ui - Command line tool for deposit to SWORDv2-enabled repository""",
     packages=find_packages(exclude=['tests']),
     include_package_data=True,
     zip_safe=False,
-    install_requires=["sword2", "lxml", "dip"],
+    install_requires=["sword2", "lxml", "dip", "scandir"],
     entry_points =
         {
         'console_scripts':
@@ -0,0 +1,393 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for dip commands on large directory trees.
+
+Generates synthetic trees of files and times the stages of preparing and
+depositing a DIP for each: `dip add-files`, `dip show`, `dip package` and
+`dip deposit` (to an in-process SWORD server, see dipcmd.dipswordserver,
+with optional simulated latency, bandwidth limit and deposit failures).
+Tree shapes are:
+
+    wide    directories of up to 10000 files of 1 KiB each
+    deep    chains of 32 nested directories, with 4 files of 1 KiB in each
+    tiny    a balanced tree of directories of 100 entries, with files of a
+            few bytes each
+    huge    a few large files of incompressible data (the number and size of
+            files are set by --huge_files and --huge_mb rather than --sizes)
+
+Each stage is run as a `dip` command in a separate process, which reports
+the elapsed time, user and system CPU time, peak resident set size (of the
+command process or any worker process it waited for), and the read and
+write system calls counted by Linux in /proc/self/io.  With --strace, each
+stage is run under `strace -c -f`, and the number of calls of each system
+call is also recorded.  Results are written as JSON, e.g.:
+
+    cd src
+    python -m tests.benchmark_dip --workdir /tmp/dipbench --sizes 1000,10000,100000,1000000 \\
+        --output results-0.1.json
+    python -m tests.benchmark_dip --workdir /tmp/dipbench --compare results-0.1.json
+
+Generated trees are kept in the working directory and reused by later runs.
+"""
+
+from __future__ import print_function
+
+__author__      = "Graham Klyne (GK@ACM.ORG)"
+__copyright__   = "Copyright 2011-2014, University of Oxford"
+__license__     = "MIT (http://opensource.org/licenses/MIT)"
+
+import sys
+import os
+import os.path
+import re
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+SHAPES          = ["wide", "deep", "tiny", "huge"]
+STAGES          = ["add", "show", "package", "deposit"]
+SIZES           = [1000, 10000]
+
+WIDEFILES       = 10000         # Files per directory in "wide" trees
+DEEPLEVELS      = 32            # Directory nesting in "deep" trees
+DEEPFILES       = 4             # Files per directory in "deep" trees
+TINYENTRIES     = 100           # Entries per directory in "tiny" trees
+FILESIZE        = 1024          # Size of files in "wide" and "deep" trees
+BLOCKSIZE       = 1024*1024     # Block of random data repeated in "huge" files
+
+TREECOMPLETE    = ".complete"   # Suffix of file marking a generated tree as complete
+
+COLLECTION      = "/col"
+SERVICEDOC      = "/sd"
+
+# Script run in a separate process for each stage
+STAGE_SCRIPT = """
+import sys, os, time, json, resource
+sys.path[0:0] = %(path)r
+from dipcmd.dipmain import runCommand
+from tests.benchmark_dip import proc_io
+with open(os.devnull, "w") as devnull:
+    stdout = sys.stdout
+    sys.stdout = devnull
+    start  = time.time()
+    status = runCommand(%(configbase)r, %(filebase)r, %(argv)r)
+    sys.stdout = stdout
+elapsed = time.time() - start
+(ruself, ruchild) = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+print(json.dumps(
+    { 'status':         status
+    , 'seconds':        elapsed
+    , 'user_seconds':   ruself.ru_utime + ruchild.ru_utime
+    , 'system_seconds': ruself.ru_stime + ruchild.ru_stime
+    , 'max_rss_kb':     max(ruself.ru_maxrss, ruchild.ru_maxrss)
+    , 'io':             proc_io()
+    }))
+"""
+
+def proc_io():
+    """
+    Return a dictionary of I/O counts for the current process from
+    /proc/self/io (Linux only), or None if they are not available.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            return dict( (k.strip(), int(v)) for (k, v) in (l.split(":") for l in f if ":" in l) )
+    except IOError:
+        return None
+
+def file_content(i, size):
+    line = "%08d\n"%(i)
+    return (line*(size//len(line)+1))[:size]
+
+def write_file(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return len(content)
+
+def generate_wide(treedir, count):
+    size = 0
+    for i in range(count):
+        subdir = os.path.join(treedir, "w%04d"%(i//WIDEFILES))
+        if i%WIDEFILES == 0:
+            os.makedirs(subdir)
+        size += write_file(os.path.join(subdir, "f%07d.dat"%(i)), file_content(i, FILESIZE))
+    return size
+
+def generate_deep(treedir, count):
+    size   = 0
+    subdir = treedir
+    for i in range(count):
+        if i%DEEPFILES == 0:
+            level  = (i//DEEPFILES)%DEEPLEVELS
+            chain  = i//(DEEPFILES*DEEPLEVELS)
+            subdir = os.path.join(subdir if level else os.path.join(treedir, "c%05d"%(chain)), "d%02d"%(level))
+            os.makedirs(subdir)
+        size += write_file(os.path.join(subdir, "f%07d.dat"%(i)), file_content(i, FILESIZE))
+    return size
+
+def generate_tiny(treedir, count):
+    levels = 1
+    while TINYENTRIES**levels < count:
+        levels += 1
+    size = 0
+    for i in range(count):
+        digits = []
+        n = i
+        for l in range(levels):
+            digits.insert(0, n%TINYENTRIES)
+            n //= TINYENTRIES
+        subdir = os.path.join(treedir, *[ "t%02d"%(d) for d in digits[:-1] ])
+        if digits[-1] == 0 and not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        size += write_file(os.path.join(subdir, "f%07d.txt"%(i)), "%d\n"%(i))
+    return size
+
+def generate_huge(treedir, count, huge_mb=256):
+    block = os.urandom(BLOCKSIZE)
+    size  = 0
+    for i in range(count):
+        with open(os.path.join(treedir, "huge%02d.dat"%(i)), "wb") as f:
+            for b in range(huge_mb*1024*1024//BLOCKSIZE):
+                f.write(block)
+                size += len(block)
+    return size
+
+GENERATORS = (
+    { 'wide': generate_wide
+    , 'deep': generate_deep
+    , 'tiny': generate_tiny
+    , 'huge': generate_huge
+    })
+
+def make_tree(workdir, shape, count, huge_mb=256):
+    """
+    Generate a tree of files of the indicated shape, or reuse one generated
+    by an earlier run.
+
+    Returns a triple (treedir, count, size), where size is the total size
+    of the files in bytes.
+    """
+    treename = "%s-%d"%(shape, count) + ("-%dmb"%(huge_mb) if shape == "huge" else "")
+    treedir  = os.path.join(workdir, "trees", treename)
+    complete = treedir+TREECOMPLETE
+    if os.path.isfile(complete):
+        with open(complete) as f:
+            return (treedir, count, int(f.read()))
+    if os.path.isdir(treedir):
+        shutil.rmtree(treedir)
+    os.makedirs(treedir)
+    if shape == "huge":
+        size = generate_huge(treedir, count, huge_mb=huge_mb)
+    else:
+        size = GENERATORS[shape](treedir, count)
+    with open(complete, "w") as f:
+        f.write(str(size))
+    return (treedir, count, size)
+
+def strace_counts(filename):
+    """
+    Return a dictionary of the number of calls of each system call from a
+    summary written by `strace -c`.
+    """
+    counts = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 5 and re.match(r"^\d+$", fields[3]) and not fields[0].startswith("-"):
+                counts[fields[-1]] = int(fields[3])
+    return counts
+
+def run_stage(configbase, filebase, argv, use_strace=False):
+    """
+    Run a dip command in a separate process, and return its measurements.
+    """
+    script = STAGE_SCRIPT%(
+        { 'path':       [ os.path.abspath(p) for p in sys.path if p ]
+        , 'configbase': configbase
+        , 'filebase':   filebase
+        , 'argv':       argv
+        })
+    cmd = [sys.executable, "-c", script]
+    if use_strace:
+        stracefile = os.path.join(filebase, "strace.txt")
+        cmd = ["strace", "-c", "-f", "-o", stracefile] + cmd
+    output = subprocess.check_output(cmd, cwd=filebase)
+    result = json.loads(output.strip().splitlines()[-1])
+    if use_strace:
+        result['syscalls'] = strace_counts(stracefile)
+    return result
+
+def benchmark_tree(workdir, shape, count, stages=STAGES, jobs=1, huge_mb=256, use_strace=False,
+                   server_options={}, log=None):
+    """
+    Run the benchmark stages for one tree, returning a list of results.
+    `server_options` are keyword arguments for the SWORD server (see
+    dipcmd.dipswordserver.SwordServer).
+    """
+    (treedir, count, size) = make_tree(workdir, shape, count, huge_mb=huge_mb)
+    rundir     = os.path.join(workdir, "runs", os.path.basename(treedir))
+    configbase = os.path.join(rundir, "config")
+    if os.path.isdir(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    stage_argv = (
+        { 'add':     ["dip", "--recursive", "--jobs=%d"%(jobs), "add-files", treedir]
+        , 'show':    ["dip", "show"]
+        , 'package': ["dip", "--jobs=%d"%(jobs), "package"]
+        })
+    results = []
+    # Imported here so that it is not loaded by processes running stages
+    from dipcmd.dipswordserver import SwordServer
+    with SwordServer(keep_content=False, **server_options) as server:
+        stage_argv['deposit'] = (
+            [ "dip", "--jobs=%d"%(jobs), "deposit"
+            , "--collection_uri=%s"%(server.uri(COLLECTION))
+            , "--servicedoc_uri=%s"%(server.uri(SERVICEDOC))
+            , "--username=bench", "--password=bench"
+            ])
+        run_stage(configbase, rundir, ["dip", "create", "--dip", "dip"])
+        run_stage(configbase, rundir, ["dip", "config", "--collection_uri=%s"%(server.uri(COLLECTION))])
+        for stage in stages:
+            result = run_stage(configbase, rundir, stage_argv[stage], use_strace=use_strace)
+            result.update({ 'shape': shape, 'files': count, 'bytes': size, 'stage': stage })
+            results.append(result)
+            if log:
+                print("%(shape)s files=%(files)d stage=%(stage)s status=%(status)d "%result+
+                      "seconds=%(seconds).3f max_rss_kb=%(max_rss_kb)d"%result, file=log)
+            if result['status'] != 0:
+                break
+    shutil.rmtree(rundir)
+    return results
+
+def run_benchmark(workdir, sizes=SIZES, shapes=SHAPES, stages=STAGES, jobs=1,
+                  huge_files=4, huge_mb=256, use_strace=False, server_options={}, log=None):
+    """
+    Run the benchmark stages for trees of each shape and size, and return
+    a dictionary of results.
+    """
+    from dipcmd.dipmain import VERSION
+    results = []
+    for shape in shapes:
+        counts = [huge_files] if shape == "huge" else sizes
+        for count in counts:
+            results.extend(benchmark_tree(
+                workdir, shape, count, stages=stages, jobs=jobs, huge_mb=huge_mb,
+                use_strace=use_strace, server_options=server_options, log=log
+                ))
+    return (
+        { 'benchmark':  "dip"
+        , 'version':    VERSION
+        , 'python':     platform.python_version()
+        , 'platform':   platform.platform()
+        , 'started':    time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        , 'jobs':       jobs
+        , 'server':     server_options
+        , 'results':    results
+        })
+
+def compare_results(previous, current, out=sys.stdout):
+    """
+    Display the elapsed time and peak RSS of each stage in two sets of
+    results, with the ratio of current to previous times.
+    """
+    def key(r):
+        return (r['shape'], r['files'], r['stage'])
+    before = dict( (key(r), r) for r in previous['results'] )
+    print("%-6s %8s %-8s %10s %10s %7s %10s %10s"%
+          ("shape", "files", "stage", "seconds", "was", "ratio", "rss_kb", "was"), file=out)
+    for r in current['results']:
+        p = before.get(key(r))
+        if p is None:
+            continue
+        ratio = r['seconds']/p['seconds'] if p['seconds'] else float("inf")
+        print("%-6s %8d %-8s %10.3f %10.3f %7.2f %10d %10d"%
+              (r['shape'], r['files'], r['stage'], r['seconds'], p['seconds'], ratio,
+               r['max_rss_kb'], p['max_rss_kb']), file=out)
+    return
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+                description="Benchmark dip commands on synthetic directory trees",
+                formatter_class=argparse.ArgumentDefaultsHelpFormatter
+                )
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "dipbench"),
+                        help="Directory for generated trees and DIPs")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="Comma-separated numbers of files in generated trees")
+    parser.add_argument("--shapes", default=",".join(SHAPES),
+                        help="Comma-separated tree shapes: "+", ".join(SHAPES))
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="Comma-separated stages, run in order: "+", ".join(STAGES))
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Value of --jobs for add-files, package and deposit")
+    parser.add_argument("--huge_files", type=int, default=4,
+                        help="Number of files in huge trees")
+    parser.add_argument("--huge_mb", type=int, default=256,
+                        help="Size of each file in huge trees (megabytes)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay in seconds before each response from the SWORD server")
+    parser.add_argument("--bandwidth", type=int, default=None,
+                        help="Limit in bytes per second on transfers to and from the SWORD server")
+    parser.add_argument("--fail_rate", type=float, default=0.0,
+                        help="Proportion of deposits that fail")
+    parser.add_argument("--fail_status", type=int, default=None,
+                        help="HTTP status returned for failed deposits (default: drop connection)")
+    parser.add_argument("--strace", action="store_true", default=False,
+                        help="Count all system calls using strace")
+    parser.add_argument("--output", default=None,
+                        help="File to which JSON results are written (default stdout)")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+def runBenchmark(argv):
+    """
+    Run benchmarks as specified by command line arguments (not including
+    the program name), and return zero to indicate success, or a non-zero
+    status code.
+    """
+    options = parseArgs(argv)
+    shapes  = options.shapes.split(",")
+    stages  = options.stages.split(",")
+    for (name, values, allowed) in [("shape", shapes, SHAPES), ("stage", stages, STAGES)]:
+        for v in values:
+            if v not in allowed:
+                print("Unknown %s: %s"%(name, v), file=sys.stderr)
+                return 2
+    results = run_benchmark(
+        os.path.abspath(options.workdir),
+        sizes=[ int(s) for s in options.sizes.split(",") ],
+        shapes=shapes, stages=stages, jobs=options.jobs,
+        huge_files=options.huge_files, huge_mb=options.huge_mb,
+        use_strace=options.strace, log=sys.stderr,
+        server_options=(
+            { 'latency':     options.latency
+            , 'bandwidth':   options.bandwidth
+            , 'fail_rate':   options.fail_rate
+            , 'fail_status': options.fail_status
+            , 'seed':        0
+            })
+        )
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if options.compare:
+        with open(options.compare) as f:
+            compare_results(json.load(f), results, out=sys.stderr)
+    if any( r['status'] != 0 for r in results['results'] ):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(runBenchmark(sys.argv[1:]))
+
+# End.
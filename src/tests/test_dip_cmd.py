@@ -11,15 +11,24 @@ __copyright__   = "Copyright 2013-2014, University of Oxford"
 __license__     = "MIT (http://opensource.org/licenses/MIT)"
 
 import sys
+import __builtin__
 import os
 import os.path
 import re
 import argparse
 import errno
+import json
+import hashlib
 import StringIO
+import time
 import shutil
+import subprocess
+import threading
+import socket
+import httplib
 import zipfile
 import unittest
+import contextlib
 
 import logging
 log = logging.getLogger(__name__)
@@ -34,10 +43,30 @@ print("sys.path[0]: "+sys.path[0])
 
 from dipcmd                 import diperrors
 from dipcmd.dipmain         import runCommand
-from dipcmd.dipconfig       import SwordService, dip_get_default_dir
+from dipcmd.dipconfig       import SwordService, dip_get_default_dir, readconfig, writeconfig
+from dipcmd.diplocal        import (
+    walk_files, open_dip, forget_dip, dip_check, add_dip_files, DipTransaction
+    )
+from dipcmd                 import dippackage
+from dipcmd.diphttp         import StreamingHttpLayer, ConnectionPool
+from dipcmd.dipdeposit      import dip_deposit, checkpoint_filename
+from dipcmd                 import dipdeposit
+from dipcmd.dipservice      import service_capabilities, servicedoc_filename
+from dipcmd.dipdeposit      import read_deposit_status, write_deposit_status
+from dipcmd.dipoutbox       import Outbox
+from dipcmd.dipthrottle     import TokenBucket, retry_after
+from dipcmd.dipserve        import dip_serve, dip_serve_stop, run_in_server, serve_socket, server_request
+from dipcmd.dipsession      import DipSession, DipError
+from dipcmd.dipsword        import BINARY
 
 from tests.StdoutContext    import SwitchStdout, SwitchStderr
 from tests.SetcwdContext    import ChangeCurrentDir
+from dipcmd.dipswordserver import SwordServer, INPROGRESS, ARCHIVED
+from tests                  import benchmark_dip
+
+# Deposit tests use the bundled SWORD server (dipcmd.dipswordserver), unless
+# DIP_TEST_SSS is set in the environment, when they use a local Simple-Sword-Server.
+USE_SSS = bool(os.environ.get("DIP_TEST_SSS"))
 
 # This may need to be adjusted to reflect a collection URI offered by the local Sword server
 # Browse http://localhost:8080/ or http://localhost:8080/sd-uri for candidates
@@ -60,16 +89,41 @@ BASE_DIR    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test/dat
 BASE_CONFIG = os.path.join(BASE_DIR, "config")
 BASE_DIPDIR = os.path.join(BASE_DIR, "dipdir")
 
+# Time allowed to import the command line tool and run a command that does
+# not use the dip or SWORD libraries (not including interpreter startup)
+STARTUP_BUDGET = 0.5
+
+# Modules that should not be loaded by commands that only use the configuration
+HEAVY_MODULES = ["dip", "sword2", "lxml", "httplib2", "sqlite3", "multiprocessing"]
+
+STARTUP_SCRIPT = """
+import sys, time, json
+start = time.time()
+sys.path.insert(0, %(srcdir)r)
+from dipcmd.dipmain import runCommand
+try:
+    status = runCommand(%(configbase)r, %(filebase)r, %(argv)r)
+except SystemExit as e:
+    status = e.code
+elapsed = time.time() - start
+print(json.dumps({'status': status, 'elapsed': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
 class TestDipCmd(unittest.TestCase):
 
     def setUp(self):
         self._dipdir = BASE_DIPDIR
         self._cnfdir = BASE_CONFIG
         self._stsdir = os.path.join(BASE_CONFIG, "deposit_status")
+        self._stsdb  = os.path.join(BASE_CONFIG, "deposit_status.db")
+        self._outdb  = os.path.join(BASE_CONFIG, "deposit_outbox.db")
         if self._dipdir.startswith(BASE_DIR) and os.path.isdir(self._dipdir):
             shutil.rmtree(self._dipdir)
         if self._stsdir.startswith(BASE_DIR) and os.path.isdir(self._stsdir):
             shutil.rmtree(self._stsdir)
+        for db in [self._stsdb, self._outdb]:
+            if db.startswith(BASE_DIR) and os.path.isfile(db):
+                os.remove(db)
         return
         
     def tearDown(self):
@@ -106,6 +160,24 @@ class TestDipCmd(unittest.TestCase):
         self.assertEqual(status, diperrors.DIP_SUCCESS)
         return dipdir
 
+    @contextlib.contextmanager
+    def deposit_service(self):
+        """
+        Yields a pair (service, content_uri) for deposit tests, where service
+        is the SWORD service used (see USE_SSS), and content_uri a function
+        that returns the content URI of a deposit given its token.
+        """
+        if USE_SSS:
+            yield (SSS, lambda token: "http://localhost:8080/cont-uri/%s/%s"%(SSS_COLL_ID, token))
+        else:
+            with SwordServer() as server:
+                ss = SwordService(
+                    collection_uri=server.uri("/col"), servicedoc_uri=server.uri("/sd"),
+                    username=SSS.username, password=SSS.password
+                    )
+                yield (ss, lambda token: server.uri("/cont/%s"%(token.replace("token", "", 1))))
+        return
+
     def assertFilesInDip(self, filespresent=[], filesabsent=[]):
         argv   = ["dip", "show"]
         outstr = StringIO.StringIO()
@@ -185,6 +257,65 @@ class TestDipCmd(unittest.TestCase):
         # self.assertNotIn('''dipbase="%s"'''%(self._dipdir),   result)
         return
 
+    def test_03_dip_batch(self):
+        dipdir    = os.path.join(self._dipdir, "testdip")
+        filespath = self.fpath("files")
+        file1path = self.fpath("files/file1.txt")
+        os.makedirs(self._dipdir)
+        batchfile = os.path.join(self._dipdir, "batch.txt")
+        with open(batchfile, "w") as bf:
+            bf.write("# Batch test\n")
+            bf.write("dip create --dip testdip\n")
+            bf.write("dip --recursive add-files %s\n"%(filespath))
+            bf.write("dip no-such-command\n")
+            bf.write("show\n")
+            bf.write('config --dip "x\n')
+            bf.write("show\n")
+        argv = ["dip", "batch", batchfile]
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            with SwitchStderr(outstr):
+                status = runCommand(self._cnfdir, self._dipdir, argv)
+        self.assertEqual(status, diperrors.DIP_BADCMD)
+        self.assertEqual(dip_get_default_dir(self._cnfdir), dipdir)
+        result = outstr.getvalue()
+        self.assertIn("Created deposit information package at %s"%(dipdir), result)
+        self.assertIn("exit_status=0 line=%s:2"%(batchfile),  result)
+        self.assertIn("exit_status=0 line=%s:3"%(batchfile),  result)
+        self.assertIn("exit_status=64 line=%s:4"%(batchfile), result)
+        self.assertIn("exit_status=0 line=%s:5"%(batchfile),  result)
+        self.assertIn("Invalid command in batch (%s:6)"%(batchfile), result)
+        self.assertIn("exit_status=64 line=%s:6"%(batchfile), result)
+        self.assertIn("exit_status=0 line=%s:7"%(batchfile),  result)
+        self.assertIn(" %s"%file1path, result)
+        self.assertNotIn("line=%s:1"%(batchfile), result)
+        return
+
+    def test_04_dip_config_cache(self):
+        dipdir     = os.path.join(self._dipdir, "testdip")
+        configfile = os.path.join(self._cnfdir, "dip_config.json")
+        argv = ["dip", "config", "--dip", "testdip"]
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            status = runCommand(self._cnfdir, self._dipdir, argv)
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        configstat = os.stat(configfile)
+        # Unchanged configuration is not written
+        argv = ["dip", "config", "--dip", "testdip"]
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            status = runCommand(self._cnfdir, self._dipdir, argv)
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        self.assertEqual(os.stat(configfile).st_ino, configstat.st_ino)
+        # Changes to the configuration file are picked up
+        with open(configfile, "r") as cf:
+            dip_config = json.load(cf)
+        dip_config['dipdir'] = dipdir+"-changed"
+        with open(configfile, "w") as cf:
+            json.dump(dip_config, cf, indent=4)
+        self.assertEqual(dip_get_default_dir(self._cnfdir), dipdir+"-changed")
+        return
+
     def test_11_dip_create(self):
         dipdir = os.path.join(self._dipdir, "testdip")
         argv = ["dip", "create", "--dip", "testdip"]
@@ -495,6 +626,154 @@ class TestDipCmd(unittest.TestCase):
             )
         return
 
+    def test_26_walk_files(self):
+        filespath = self.fpath("files")
+        allfiles  = (
+            [ "files/file1.txt", "files/file2.txt"
+            , "files/sub1/sub11.txt", "files/sub1/sub12.txt"
+            , "files/sub2/sub21.txt", "files/sub2/sub22.txt"
+            , "files/sub3/sub31/sub311.txt", "files/sub3/sub33/sub331.txt"
+            ])
+        for jobs in [1, 4]:
+            files = list(walk_files(BASE_DIR, "files", True, True, jobs=jobs))
+            self.assertEqual(sorted(files), sorted([self.fpath(f) for f in allfiles]))
+            files = list(walk_files(BASE_DIR, "files", True, False, jobs=jobs))
+            self.assertEqual(sorted(files), sorted([self.fpath(f) for f in allfiles[:2]]))
+        files = list(walk_files(BASE_DIR, "files/file1.txt", True, True))
+        self.assertEqual(files, [self.fpath("files/file1.txt")])
+        # Nesting deeper than the recursion limit
+        deepdir = self._dipdir
+        for i in range(200):
+            deepdir = os.path.join(deepdir, "d")
+        os.makedirs(deepdir)
+        with open(os.path.join(deepdir, "deep.txt"), "w") as f:
+            f.write("deep\n")
+        recursionlimit = sys.getrecursionlimit()
+        sys.setrecursionlimit(150)
+        try:
+            files = list(walk_files(self._dipdir, "d", True, True, jobs=2))
+        finally:
+            sys.setrecursionlimit(recursionlimit)
+        self.assertEqual(files, [os.path.join(deepdir, "deep.txt")])
+        # Symbolic links forming a cycle are followed once
+        linkdir = os.path.join(self._dipdir, "l")
+        os.makedirs(os.path.join(linkdir, "sub"))
+        with open(os.path.join(linkdir, "sub", "l.txt"), "w") as f:
+            f.write("l\n")
+        os.symlink(linkdir, os.path.join(linkdir, "sub", "up"))
+        os.symlink(os.path.join(linkdir, "sub"), os.path.join(linkdir, "down"))
+        for jobs in [1, 2]:
+            files = list(walk_files(self._dipdir, "l", True, True, jobs=jobs))
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].endswith("l.txt"))
+        return
+
+    def test_27_dip_add_files_interrupted(self):
+        # create
+        dipdir = self.create_tst_dip("testdip")
+        self.assertTrue(os.path.isdir(dipdir))
+        # Simulate an add-files that was interrupted part way through, by a
+        # process whose id has since been reused by a running process
+        file1path   = self.fpath("files/file1.txt")
+        file2path   = self.fpath("files/file2.txt")
+        journalfile = os.path.join(dipdir, "deposit.json.journal")
+        with open(os.path.join(dipdir, "deposit.json"), "rb") as f:
+            journal = { 'pid': os.getppid(), 'deposit': f.read() }
+        with open(journalfile, "wb") as f:
+            json.dump(journal, f)
+        DIP(dipdir).set_file(file1path)
+        forget_dip(dipdir)
+        def run(argv):
+            outstr = StringIO.StringIO()
+            with SwitchStdout(outstr):
+                with SwitchStderr(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argv)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            return outstr.getvalue()
+        # Commands that only read the DIP leave it alone
+        result = run(["dip", "show"])
+        self.assertNotIn("Restored deposit information package", result)
+        self.assertTrue(os.path.exists(journalfile))
+        # The next update restores the DIP to its state before the add-files
+        result = run(["dip", "add-files", file2path])
+        self.assertIn("Restored deposit information package after interrupted update", result)
+        self.assertFalse(os.path.exists(journalfile))
+        self.assertFilesInDip(filespresent=["files/file2.txt"], filesabsent=["files/file1.txt"])
+        # A transaction in progress is not disturbed by commands reading the DIP
+        with DipTransaction(dipdir):
+            self.assertEqual(dip_check(dipdir), (diperrors.DIP_SUCCESS, None))
+            result = run(["dip", "show"])
+            self.assertNotIn("Restored deposit information package", result)
+            self.assertTrue(os.path.exists(journalfile))
+            open_dip(dipdir).set_file(file1path)
+        self.assertFalse(os.path.exists(journalfile))
+        self.assertFilesInDip(filespresent=["files/file1.txt", "files/file2.txt"])
+        # The dip library's own file access is restored after the transaction
+        self.assertNotIn("open", sys.modules[DIP.__module__].__dict__)
+        return
+
+    def test_28_dip_add_files_incremental(self):
+        # create
+        dipdir = self.create_tst_dip("testdip")
+        self.assertTrue(os.path.isdir(dipdir))
+        newfiles = self.dpath("newfiles")
+        os.makedirs(newfiles)
+        for f in ["new1.txt", "new2.txt"]:
+            with open(os.path.join(newfiles, f), "w") as nf:
+                nf.write("%s\n"%f)
+        new1path = os.path.join(newfiles, "new1.txt")
+        new2path = os.path.join(newfiles, "new2.txt")
+        argv   = ["dip", "add-files", newfiles]
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            status = runCommand(self._cnfdir, self._dipdir, argv)
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        result = outstr.getvalue()
+        self.assertIn("  %s"%new1path, result)
+        self.assertIn("  %s"%new2path, result)
+        self.assertTrue(os.path.isfile(os.path.join(dipdir, "file_index.json")))
+        # Add again after changing one file
+        with open(new2path, "a") as nf:
+            nf.write("changed\n")
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            status = runCommand(self._cnfdir, self._dipdir, argv)
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        result = outstr.getvalue()
+        self.assertNotIn("  %s"%new1path, result)
+        self.assertIn("  %s"%new2path, result)
+        self.assertIn("Unchanged files skipped: 1", result)
+        return
+
+    def test_29_dip_add_files_single_write(self):
+        # Adding or removing many files writes deposit.json once
+        dipdir  = self.create_tst_dip("testdip")
+        dipfile = os.path.join(dipdir, "deposit.json")
+        writes  = []
+        builtin_open = __builtin__.open
+        def counting_open(name, mode="r", *args):
+            if os.path.abspath(name) in [dipfile, dipfile+".tmp"] and "w" in mode:
+                writes.append(name)
+            return builtin_open(name, mode, *args)
+        def run(argv):
+            outstr = StringIO.StringIO()
+            __builtin__.open = counting_open
+            try:
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argv)
+            finally:
+                __builtin__.open = builtin_open
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            return outstr.getvalue()
+        run(["dip", "--recursive", "add-files", self.fpath("files")])
+        self.assertEqual(len(writes), 1)
+        self.assertFilesInDip(filespresent=["files/file1.txt", "files/file2.txt", "files/sub3/sub31/sub311.txt"])
+        del writes[:]
+        run(["dip", "--recursive", "remove-file", self.fpath("files")])
+        self.assertEqual(len(writes), 1)
+        self.assertFilesInDip(filesabsent=["files/file1.txt", "files/file2.txt", "files/sub3/sub31/sub311.txt"])
+        return
+
     def test_30_dip_add_show_attributes(self):
         # create
         dipdir = self.create_tst_dip("testdip")
@@ -717,6 +996,13 @@ class TestDipCmd(unittest.TestCase):
         self.assertIn("files/sub2/sub22.txt",           ziplist)
         self.assertIn("files/sub3/sub31/sub311.txt",    ziplist)
         self.assertIn("files/sub3/sub33/sub331.txt",    ziplist)
+        # Check checksum manifest
+        with open(os.path.join(os.path.dirname(pathtext), "manifest-sha256.txt")) as mf:
+            manifest = mf.read()
+        with open(self.fpath("files/file1.txt"), "rb") as f:
+            file1sha = hashlib.sha256(f.read()).hexdigest()
+        self.assertIn("%s  files/file1.txt\n"%(file1sha), manifest)
+        self.assertEqual(len(manifest.splitlines()), 8)
         # self.assertIn("file1.txt",      ziplist)
         # self.assertIn("file2.txt",      ziplist)
         # self.assertIn("sub11.txt",      ziplist)
@@ -761,131 +1047,1233 @@ class TestDipCmd(unittest.TestCase):
 
     def test_42_dip_deposit_sss(self):
         # deposit as single operation
+        with self.deposit_service() as (sss, content_uri):
+            dipdir = self.create_populate_tst_dip("testdip")
+            self.assertTrue(os.path.isdir(dipdir))
+            # Configure endpoint
+            argvconfig   = (
+                [ "dip", "config"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                , "--servicedoc_uri=%s"%(sss.servicedoc_uri)
+                , "--username=%s"%(sss.username)
+                , "--password=%s"%(sss.password)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # Create package and deposit
+            argvdeposit   = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            result = outstr.getvalue()
+            log.info(result)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertRegexpMatches(result, r'^token=.*$')
+        return
+
+    def test_43_dip_package_deposit_sss(self):
+        # create package and deposit as separate optarations
+        with self.deposit_service() as (sss, content_uri):
+            dipdir = self.create_populate_tst_dip("testdip")
+            self.assertTrue(os.path.isdir(dipdir))
+            # Configure endpoint
+            argvconfig   = (
+                [ "dip", "config"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                , "--servicedoc_uri=%s"%(sss.servicedoc_uri)
+                , "--username=%s"%(sss.username)
+                , "--password=%s"%(sss.password)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+
+            # Create package
+            argvpackage   = (
+                [ "dip", "package", "--dip", "testdip"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvpackage)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            package = outstr.getvalue().splitlines()[-1]
+            log.info("package: %s"%(package))
+
+            # Deposit package
+            argvdeposit   = (
+                [ "dip", "deposit", "--package", package
+                , "--collection_uri=%s"%(sss.collection_uri)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            result = outstr.getvalue()
+            self.assertRegexpMatches(result, r'^token=.*$')
+        return
+
+    def test_44_dip_deposit_sss_status(self):
+        # deposit as single operation
+        with self.deposit_service() as (sss, content_uri):
+            dipdir = self.create_populate_tst_dip("testdip")
+            self.assertTrue(os.path.isdir(dipdir))
+            # Configure endpoint
+            argvconfig   = (
+                [ "dip", "config"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                , "--servicedoc_uri=%s"%(sss.servicedoc_uri)
+                , "--username=%s"%(sss.username)
+                , "--password=%s"%(sss.password)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # Create package and deposit
+            argvdeposit   = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            result = outstr.getvalue()
+            log.info(result)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+
+            # Get status of deposit
+            result = result.splitlines()[0]
+            matchresult = re.match(r'token=(.*)$', result)
+            self.assertIsNotNone(matchresult)
+            token = matchresult.group(1)
+            argvstatus   = (
+                [ "dip", "status", "--dip", "testdip"
+                , "--collection_uri=%s"%(sss.collection_uri)
+                , "--token=%s"%(token)
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvstatus)
+            result = outstr.getvalue()
+            result = result.splitlines()[0]
+            log.info(result)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            pkguri = content_uri(token)
+            self.assertEqual(result, pkguri)
+        return
+
+    def test_45_dip_checksum(self):
+        # create
         dipdir = self.create_populate_tst_dip("testdip")
         self.assertTrue(os.path.isdir(dipdir))
-        # Configure endpoint
-        argvconfig   = (
-            [ "dip", "config"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            , "--servicedoc_uri=%s"%(SSS.servicedoc_uri)
-            , "--username=%s"%(SSS.username)
-            , "--password=%s"%(SSS.password)
-            ])
-        outstr = StringIO.StringIO()
-        with ChangeCurrentDir(BASE_DIR):
+        file1path = self.fpath("files/file1.txt")
+        with open(file1path, "rb") as f:
+            file1data = f.read()
+        for algorithm in ["md5", "sha256"]:
+            argv   = ["dip", "checksum", "--algorithm", algorithm, "--jobs", "2"]
+            outstr = StringIO.StringIO()
             with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvconfig)
-        self.assertEqual(status, diperrors.DIP_SUCCESS)
-        # Create package and deposit
-        argvdeposit   = (
-            [ "dip", "deposit", "--dip", "testdip"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            ])
+                status = runCommand(self._cnfdir, self._dipdir, argv)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            result = outstr.getvalue()
+            digest = hashlib.new(algorithm, file1data).hexdigest()
+            self.assertIn("%s  %s\n"%(digest, file1path), result)
+            self.assertEqual(len(result.splitlines()), 8)
+        self.assertTrue(os.path.isfile(os.path.join(dipdir, "checksums.json")))
+        return
+
+    def test_46_dip_package_zip64(self):
+        # create
+        dipdir = self.create_populate_tst_dip("testdip")
+        self.assertTrue(os.path.isdir(dipdir))
+        # Create package, with ZIP64 limits lowered to force use of ZIP64 records
+        argvpackage = ["dip", "package", "--dip", "testdip", "--jobs", "2"]
         outstr = StringIO.StringIO()
-        with ChangeCurrentDir(BASE_DIR):
-            with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
-        result = outstr.getvalue()
-        log.info(result)
+        zip64limits = (dippackage.ZIP64LIMIT, dippackage.ZIP64COUNTLIMIT)
+        dippackage.ZIP64LIMIT      = 16
+        dippackage.ZIP64COUNTLIMIT = 4
+        try:
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvpackage)
+        finally:
+            (dippackage.ZIP64LIMIT, dippackage.ZIP64COUNTLIMIT) = zip64limits
         self.assertEqual(status, diperrors.DIP_SUCCESS)
-        self.assertRegexpMatches(result, r'^token=.*$')
+        pathtext = outstr.getvalue().splitlines()[-1]
+        z = zipfile.ZipFile(pathtext)
+        self.assertIsNone(z.testzip())
+        self.assertEqual(len(z.namelist()), 9)
+        with open(self.fpath("files/sub1/sub11.txt"), "rb") as f:
+            self.assertEqual(z.read("files/sub1/sub11.txt"), f.read())
         return
 
-    def test_43_dip_package_deposit_sss(self):
-        # create package and deposit as separate optarations
+    def test_47_dip_package_incremental(self):
+        # create
         dipdir = self.create_populate_tst_dip("testdip")
         self.assertTrue(os.path.isdir(dipdir))
-        # Configure endpoint
-        argvconfig   = (
-            [ "dip", "config"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            , "--servicedoc_uri=%s"%(SSS.servicedoc_uri)
-            , "--username=%s"%(SSS.username)
-            , "--password=%s"%(SSS.password)
-            ])
-        outstr = StringIO.StringIO()
+        # Count files compressed by the packager (no worker processes with --jobs=1)
+        compress_member = dippackage.compress_member
+        compressed = []
+        def counting_compress_member(args):
+            compressed.append(args[0])
+            return compress_member(args)
+        def package():
+            del compressed[:]
+            argvpackage = ["dip", "package", "--dip", "testdip", "--jobs", "1"]
+            outstr = StringIO.StringIO()
+            dippackage.compress_member = counting_compress_member
+            try:
+                with ChangeCurrentDir(BASE_DIR):
+                    with SwitchStdout(outstr):
+                        status = runCommand(self._cnfdir, self._dipdir, argvpackage)
+            finally:
+                dippackage.compress_member = compress_member
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            return outstr.getvalue().splitlines()[-1]
+        def entries(pathtext):
+            z = zipfile.ZipFile(pathtext)
+            self.assertIsNone(z.testzip())
+            infos = dict( (i.filename, (i.CRC, i.compress_size)) for i in z.infolist() )
+            z.close()
+            return infos
+        # Create package: all files are compressed
+        pathtext = package()
+        self.assertTrue(os.path.isfile(pathtext+dippackage.INDEXSUFFIX))
+        infos1 = entries(pathtext)
+        self.assertEqual(len(compressed), len(infos1))
+        # Remove file and re-package: remaining entries are reused
+        argvremove = ["dip", "remove-file", "files/file1.txt"]
         with ChangeCurrentDir(BASE_DIR):
-            with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            with SwitchStdout(StringIO.StringIO()):
+                status = runCommand(self._cnfdir, self._dipdir, argvremove)
         self.assertEqual(status, diperrors.DIP_SUCCESS)
+        self.assertEqual(package(), pathtext)
+        self.assertEqual(compressed, [])
+        infos2 = entries(pathtext)
+        self.assertEqual(len(infos2), len(infos1)-1)
+        self.assertNotIn("files/file1.txt", infos2)
+        for name in infos2:
+            self.assertEqual(infos2[name], infos1[name])
+        # Modify file and re-package: only the modified file is recompressed
+        file2path = self.fpath("files/file2.txt")
+        with open(file2path, "rb") as f:
+            file2data = f.read()
+        file2stat = os.stat(file2path)
+        try:
+            with open(file2path, "wb") as f:
+                f.write(file2data+"Modified\n")
+            self.assertEqual(package(), pathtext)
+            self.assertEqual(compressed, [file2path])
+            infos3 = entries(pathtext)
+            self.assertEqual(sorted(infos3), sorted(infos2))
+            self.assertNotEqual(infos3["files/file2.txt"], infos2["files/file2.txt"])
+            for name in infos3:
+                if name != "files/file2.txt":
+                    self.assertEqual(infos3[name], infos2[name])
+            z = zipfile.ZipFile(pathtext)
+            self.assertEqual(z.read("files/file2.txt"), file2data+"Modified\n")
+            with open(self.fpath("files/sub1/sub11.txt"), "rb") as f:
+                self.assertEqual(z.read("files/sub1/sub11.txt"), f.read())
+            z.close()
+        finally:
+            with open(file2path, "wb") as f:
+                f.write(file2data)
+            os.utime(file2path, (file2stat.st_atime, file2stat.st_mtime))
+        return
 
+    def test_48_dip_package_fresh(self):
+        # create
+        dipdir = self.create_populate_tst_dip("testdip")
+        self.assertTrue(os.path.isdir(dipdir))
         # Create package
-        argvpackage   = (
-            [ "dip", "package", "--dip", "testdip"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            ])
+        argvpackage = ["dip", "package", "--dip", "testdip"]
         outstr = StringIO.StringIO()
         with ChangeCurrentDir(BASE_DIR):
             with SwitchStdout(outstr):
                 status = runCommand(self._cnfdir, self._dipdir, argvpackage)
         self.assertEqual(status, diperrors.DIP_SUCCESS)
-        package = outstr.getvalue()
-        log.info("package: %s"%(package))
-
-        # Deposit package
-        argvdeposit   = (
-            [ "dip", "deposit", "--package", package
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            ])
-        outstr = StringIO.StringIO()
+        pathtext = outstr.getvalue().splitlines()[-1]
+        members  = dippackage.package_members(DIP(dipdir), basedir=BASE_DIR)
+        self.assertTrue(dippackage.package_fresh(pathtext, members))
+        # Package again: package file is not rewritten
+        pkgstat = os.stat(pathtext)
         with ChangeCurrentDir(BASE_DIR):
-            with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            with SwitchStdout(StringIO.StringIO()):
+                status = runCommand(self._cnfdir, self._dipdir, argvpackage)
         self.assertEqual(status, diperrors.DIP_SUCCESS)
-        result = outstr.getvalue()
-        self.assertRegexpMatches(result, r'^token=.*$')
+        self.assertEqual(os.stat(pathtext).st_ino, pkgstat.st_ino)
+        # Remove file: package is no longer fresh
+        argvremove = ["dip", "remove-file", "files/file1.txt"]
+        with ChangeCurrentDir(BASE_DIR):
+            with SwitchStdout(StringIO.StringIO()):
+                status = runCommand(self._cnfdir, self._dipdir, argvremove)
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        members  = dippackage.package_members(DIP(dipdir), basedir=BASE_DIR)
+        self.assertFalse(dippackage.package_fresh(pathtext, members))
         return
 
-    def test_44_dip_deposit_sss_status(self):
-        # deposit as single operation
+    def test_49_http_streaming_upload(self):
+        # Upload file through streaming HTTP layer to a local server
+        filepath = self.fpath("files/sub1/sub11.txt")
+        http = StreamingHttpLayer(chunksize=7)
+        http.add_credentials("user", "pass")
+        with SwordServer() as server:
+            with open(filepath, "rb") as payload:
+                (resp, content) = http.request(
+                    server.uri("/col"), "POST",
+                    headers=
+                        { 'Content-Length': str(os.path.getsize(filepath))
+                        , 'Content-Disposition': "attachment; filename=sub11.txt"
+                        },
+                    payload=payload
+                    )
+        self.assertEqual(resp['status'], 201)
+        self.assertEqual(resp['location'], server.uri("/edit/1"))
+        (method, path, headers) = server.requests[0]
+        self.assertEqual(headers['transfer-encoding'], "chunked")
+        self.assertNotIn('content-length', headers)
+        self.assertTrue(headers['authorization'].startswith("Basic "))
+        with open(filepath, "rb") as f:
+            self.assertEqual(server.containers["1"], [("sub11.txt", f.read())])
+        return
+
+    def test_50_dip_deposit_resumable(self):
+        # create and package
         dipdir = self.create_populate_tst_dip("testdip")
         self.assertTrue(os.path.isdir(dipdir))
-        # Configure endpoint
-        argvconfig   = (
-            [ "dip", "config"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            , "--servicedoc_uri=%s"%(SSS.servicedoc_uri)
-            , "--username=%s"%(SSS.username)
-            , "--password=%s"%(SSS.password)
-            ])
+        argvpackage = ["dip", "package", "--dip", "testdip"]
         outstr = StringIO.StringIO()
         with ChangeCurrentDir(BASE_DIR):
             with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                status = runCommand(self._cnfdir, self._dipdir, argvpackage)
         self.assertEqual(status, diperrors.DIP_SUCCESS)
-        # Create package and deposit
-        argvdeposit   = (
-            [ "dip", "deposit", "--dip", "testdip"
-            , "--collection_uri=%s"%(SSS.collection_uri)
+        package = outstr.getvalue().splitlines()[-1]
+        with open(package, "rb") as f:
+            pkgdata = f.read()
+        segsize = 256
+        self.assertTrue(len(pkgdata) > 4*segsize)
+        # Deposit in segments, with connection dropped on first attempt to send the third
+        failed = []
+        def fail(path, headers):
+            if headers.get('content-disposition', "").endswith(".002") and not failed:
+                failed.append(path)
+                return True
+            return False
+        with SwordServer(fail=fail) as server:
+            def deposit():
+                outstr = StringIO.StringIO()
+                with SwitchStdout(outstr), SwitchStderr(StringIO.StringIO()):
+                    status = dip_deposit(
+                        self._cnfdir, dipdir,
+                        collection_uri=server.uri("/col"), servicedoc_uri=server.uri("/sd"),
+                        username="user", password="pass",
+                        package=package, segment_size=segsize
+                        )
+                return (status, outstr.getvalue())
+            (status, result) = deposit()
+            self.assertEqual(status, diperrors.DIP_INTERRUPTED)
+            cpname = checkpoint_filename(self._cnfdir, server.uri("/col"), package)
+            with open(cpname) as cpf:
+                self.assertEqual(json.load(cpf)['acknowledged'], [0, 1])
+            # Resume: only segments not acknowledged are sent
+            (status, result) = deposit()
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertRegexpMatches(result, r'^token=token1$')
+        self.assertFalse(os.path.exists(cpname))
+        segments = server.containers["1"]
+        self.assertEqual([ n for (n, d) in segments ], 
+            [ "SimpleZip.zip.%03d"%i for i in range((len(pkgdata)+segsize-1)//segsize) ]
+            )
+        self.assertEqual("".join( d for (n, d) in segments ), pkgdata)
+        self.assertEqual(server.requests[-1][1], "/se/1")
+        self.assertEqual(server.requests[-1][2]['in-progress'], "false")
+        return
+
+    def test_51_dip_deposit_multiple(self):
+        # create
+        dipdir = self.create_populate_tst_dip("testdip")
+        self.assertTrue(os.path.isdir(dipdir))
+        with SwordServer() as server:
+            collections = [ server.uri("/col/%d"%i) for i in range(3) ]
+            # Configure collections
+            for c in collections:
+                argvconfig = ["dip", "config", "--collection_uri=%s"%(c)]
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # Deposit to all collections
+            argvdeposit = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ] +
+                [ "--collection_uri=%s"%(c) for c in collections ]
+                )
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+        result = outstr.getvalue().splitlines()
+        self.assertEqual(len(result), 3)
+        for (i, c) in enumerate(collections):
+            self.assertRegexpMatches(result[i], r'^collection_uri=%s token=token\d$'%(c))
+        self.assertEqual(sorted(server.collections.values()), ["/col/0", "/col/1", "/col/2"])
+        package = dippackage.package_filename(dipdir)
+        with open(package, "rb") as f:
+            pkgdata = f.read()
+        for cid in server.containers:
+            self.assertEqual(server.containers[cid], [("SimpleZip.zip", pkgdata)])
+        return
+
+    def test_52_dip_deposit_all(self):
+        # create two DIPs, and a directory that is not a DIP
+        dipdirs = [ self.create_populate_tst_dip(d) for d in ["testdip1", "testdip2"] ]
+        os.makedirs(os.path.join(self._dipdir, "notadip"))
+        with SwordServer() as server:
+            collection_uri = server.uri("/col")
+            argvconfig = ["dip", "config", "--collection_uri=%s"%(collection_uri)]
+            with SwitchStdout(StringIO.StringIO()):
+                status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # Deposit all DIPs
+            argvdeposit = (
+                [ "dip", "deposit-all", "--jobs", "2", "--server_jobs", "1"
+                , "--collection_uri=%s"%(collection_uri)
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ])
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # --server_jobs limits uploads to the server across all workers
+            self.assertEqual(server.max_active, 1)
+        result = outstr.getvalue().splitlines()
+        self.assertEqual(len(result), 4)
+        self.assertRegexpMatches(result[0], r'^DIP +COLLECTION +STATUS +TOKEN$')
+        self.assertRegexpMatches(result[1], r'^testdip1 +%s +0 +token\d$'%(collection_uri))
+        self.assertRegexpMatches(result[2], r'^testdip2 +%s +0 +token\d$'%(collection_uri))
+        self.assertEqual(result[3], "Deposited: 2, failed: 0")
+        self.assertEqual(len(server.containers), 2)
+        for dipdir in dipdirs:
+            self.assertTrue(os.path.isfile(dippackage.package_filename(dipdir)))
+        return
+
+    def test_53_http_connection_pool(self):
+        # Requests to the same server re-use a pooled connection
+        pool = ConnectionPool()
+        http = StreamingHttpLayer(pool=pool)
+        with SwordServer() as server:
+            (resp, content) = http.request(server.uri("/col"), "POST", payload="data")
+            self.assertEqual(resp['status'], 201)
+            for i in range(3):
+                (resp, content) = http.request(server.uri("/edit/1"), "GET")
+                self.assertEqual(resp['status'], 200)
+            (resp, content) = http.request(server.uri("/edit/9"), "GET")
+            self.assertEqual(resp['status'], 404)
+        pool.close()
+        stats = pool.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['idle'], 0)
+        return
+
+    def test_54_dip_servicedoc_cache(self):
+        # Service document information is saved, and revalidated when expired
+        with SwordServer() as server:
+            ss = SwordService(
+                servicedoc_uri=server.uri("/sd"), collection_uri=server.uri("/col"),
+                username="user", password="pass"
+                )
+            collections = service_capabilities(self._cnfdir, ss)
+            self.assertTrue(os.path.isfile(servicedoc_filename(self._cnfdir, ss.servicedoc_uri)))
+            self.assertEqual(
+                collections[server.uri("/colbinary")]['accept_packaging'],
+                ["http://purl.org/net/sword/package/Binary"]
+                )
+            self.assertEqual(service_capabilities(self._cnfdir, ss), collections)
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(service_capabilities(self._cnfdir, ss, ttl=0), collections)
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(server.requests[1][2].get("if-none-match"), '"sd1"')
+            # Deposit to a collection that does not accept SimpleZip is refused
+            dipdir = self.create_populate_tst_dip("testdip")
+            argvconfig = ["dip", "config", "--collection_uri=%s"%(server.uri("/colbinary"))]
+            with SwitchStdout(StringIO.StringIO()):
+                status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            argvdeposit = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(server.uri("/colbinary"))
+                , "--servicedoc_uri=%s"%(ss.servicedoc_uri)
+                , "--username=user", "--password=pass"
+                ])
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(StringIO.StringIO()):
+                    with SwitchStderr(StringIO.StringIO()):
+                        status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_BADPACKAGING)
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(server.containers, {})
+        return
+
+    def test_55_dip_status_watch(self):
+        # Deposit to two collections, then watch until both are archived
+        dipdir = self.create_populate_tst_dip("testdip")
+        with SwordServer() as server:
+            collections = [ server.uri("/col/%d"%i) for i in range(2) ]
+            for c in collections:
+                argvconfig = ["dip", "config", "--collection_uri=%s"%(c)]
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                self.assertEqual(status, diperrors.DIP_SUCCESS)
+            argvdeposit = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ] +
+                [ "--collection_uri=%s"%(c) for c in collections ]
+                )
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            server.states["1"] = [INPROGRESS, INPROGRESS, ARCHIVED]
+            server.states["2"] = [ARCHIVED]
+            argvwatch = (
+                [ "dip", "status", "--watch", "--poll_interval=0.01"
+                , "--username=user", "--password=pass"
+                ])
+            outstr = StringIO.StringIO()
+            with SwitchStdout(outstr):
+                status = runCommand(self._cnfdir, self._dipdir, argvwatch)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            statements = [ r for r in server.requests if r[1].startswith("/state/") ]
+        result = outstr.getvalue().splitlines()
+        self.assertEqual(result[:2], ["token=token1 state=unknown", "token=token2 state=unknown"])
+        self.assertEqual(
+            sorted(result[2:]),
+            [ "token=token1 state=archived", "token=token1 state=inProgress"
+            , "token=token2 state=archived"
             ])
+        self.assertLess(result.index("token=token1 state=inProgress"),
+                        result.index("token=token1 state=archived"))
+        # Unchanged statement is revalidated, and polling stops when archived
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(statements[2][2].get("if-none-match"), '"%s"'%(INPROGRESS))
+        dr = read_deposit_status(self._cnfdir, "token1")
+        self.assertEqual(dr['states'], [[ARCHIVED, "State"]])
+        # Watch with a token that is now complete returns immediately
         outstr = StringIO.StringIO()
-        with ChangeCurrentDir(BASE_DIR):
+        with SwitchStdout(outstr):
+            status = runCommand(self._cnfdir, self._dipdir, ["dip", "status", "--watch", "--token=token2"])
+        self.assertEqual(status, diperrors.DIP_SUCCESS)
+        self.assertEqual(outstr.getvalue(), "token=token2 state=archived\n")
+        return
+
+    def test_56_dip_status_list(self):
+        # Status files saved by earlier versions are imported on first use
+        statusdir = os.path.join(self._cnfdir, "deposit_status")
+        os.makedirs(statusdir)
+        for (token, code, date) in [("oldtoken1", 201, 1370044800), ("oldtoken2", 400, 1372636800)]:
+            with open(os.path.join(statusdir, token), "w") as f:
+                json.dump({'token': token, 'cont_iri': "http://old/"+token,
+                           'response_headers': {'status': code}}, f)
+            os.utime(os.path.join(statusdir, token), (date, date))
+        with open(os.path.join(statusdir, "0123.checkpoint"), "w") as f:
+            f.write("{}")
+        def status_list(*args):
+            outstr = StringIO.StringIO()
             with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
-        result = outstr.getvalue()
-        log.info(result)
-        self.assertEqual(status, diperrors.DIP_SUCCESS)
-
-        # Get status of deposit
-        result = result.splitlines()[0]
-        matchresult = re.match(r'token=(.*)$', result)
-        self.assertIsNotNone(matchresult)
-        token = matchresult.group(1)
-        argvstatus   = (
-            [ "dip", "status", "--dip", "testdip"
-            , "--collection_uri=%s"%(SSS.collection_uri)
-            , "--token=%s"%(token)
+                status = runCommand(self._cnfdir, self._dipdir, ["dip", "status", "--list"]+list(args))
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            lines = outstr.getvalue().splitlines()
+            self.assertEqual(lines[0].split(), ["TOKEN", "DEPOSITED", "STATUS", "STATE", "COLLECTION", "DIP"])
+            return [ l.split() for l in lines[1:] ]
+        self.assertEqual(
+            status_list(),
+            [ ["oldtoken1", "2013-06-01T00:00:00Z", "201", "unknown", "-", "-"]
+            , ["oldtoken2", "2013-07-01T00:00:00Z", "400", "failed", "-", "-"]
             ])
+        self.assertEqual(os.listdir(statusdir), ["0123.checkpoint"])
+        # Deposits are listed with their collection and DIP
+        dipdir = self.create_populate_tst_dip("testdip")
+        with SwordServer() as server:
+            collections = [ server.uri("/col/%d"%i) for i in range(2) ]
+            for c in collections:
+                argvconfig = ["dip", "config", "--collection_uri=%s"%(c)]
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                self.assertEqual(status, diperrors.DIP_SUCCESS)
+            argvdeposit = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ] +
+                [ "--collection_uri=%s"%(c) for c in collections ]
+                )
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+        rows = status_list("--collection_uri=%s"%(collections[1]))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][2:], ["201", "unknown", collections[1], dipdir])
+        self.assertEqual(sorted( r[0] for r in status_list("--dip=testdip") ), ["token1", "token2"])
+        self.assertEqual([ r[0] for r in status_list("--http_status=400") ], ["oldtoken2"])
+        self.assertEqual(sorted( r[0] for r in status_list("--since=2014-01-01") ), ["token1", "token2"])
+        self.assertEqual([ r[0] for r in status_list("--until=2013-06-01") ], ["oldtoken1"])
+        self.assertEqual(
+            [ r[0] for r in status_list("--since=2013-06-02", "--until=2013-07-01") ],
+            ["oldtoken2"])
+        # Imported deposits can be queried by token
         outstr = StringIO.StringIO()
-        with ChangeCurrentDir(BASE_DIR):
-            with SwitchStdout(outstr):
-                status = runCommand(self._cnfdir, self._dipdir, argvstatus)
-        result = outstr.getvalue()
-        result = result.splitlines()[0]
-        log.info(result)
+        with SwitchStdout(outstr):
+            status = runCommand(
+                self._cnfdir, self._dipdir,
+                ["dip", "status", "--dip=testdip", "--collection_uri=%s"%(collections[0]), "--token=oldtoken1"]
+                )
         self.assertEqual(status, diperrors.DIP_SUCCESS)
-        pkguri = "http://localhost:8080/cont-uri/%s/%s"%(SSS_COLL_ID, token)
-        self.assertEqual(result, pkguri)
+        self.assertEqual(outstr.getvalue(), "http://old/oldtoken1\n")
+        return
+
+    def test_57_dip_deposit_defer_drain(self):
+        # Deposits are queued, then sent with retries and dead-lettering
+        dipdir = self.create_populate_tst_dip("testdip")
+        failures = {'/col/1': 2}
+        def fail(path, headers):
+            if failures.get(path):
+                failures[path] -= 1
+                return True
+            return False
+        with SwordServer(fail=fail) as server:
+            collections = [ server.uri(p) for p in ["/col/0", "/col/1", "/nocol"] ]
+            for c in collections:
+                argvconfig = ["dip", "config", "--collection_uri=%s"%(c)]
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                self.assertEqual(status, diperrors.DIP_SUCCESS)
+            argvdeposit = (
+                [ "dip", "deposit", "--defer", "--dip", "testdip"
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ] +
+                [ "--collection_uri=%s"%(c) for c in collections ]
+                )
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            queued = outstr.getvalue().splitlines()
+            self.assertEqual(len(queued), 3)
+            for (q, c) in zip(queued, collections):
+                self.assertRegexpMatches(q, r"^queued=\d+ collection_uri=%s$"%(c))
+            self.assertEqual(server.containers, {})
+            outbox  = Outbox(self._cnfdir)
+            entries = outbox.entries()
+            self.assertEqual([ e['state'] for e in entries ], ["pending"]*3)
+            for e in entries:
+                self.assertTrue(os.path.isfile(e['package']))
+            # Drain the outbox
+            argvdrain = ["dip", "drain", "--jobs=2", "--retry_delay=0.01", "--max_attempts=3"]
+            outstr = StringIO.StringIO()
+            with SwitchStdout(outstr):
+                with SwitchStderr(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdrain)
+            self.assertEqual(status, diperrors.DIP_DEPOSITFAIL)
+            result = outstr.getvalue().splitlines()
+            self.assertEqual(len([ r for r in result if "retry=yes" in r ]), 2)
+            self.assertEqual(len([ r for r in result if "token=" in r ]), 2)
+            self.assertIn(
+                "%s collection_uri=%s exit_status=%d retry=no"%
+                    (queued[2].split()[0], collections[2], diperrors.DIP_DEPOSITFAIL),
+                result)
+            self.assertEqual(sorted(server.collections.values()), ["/col/0", "/col/1"])
+            entries = outbox.entries()
+            self.assertEqual([ e['state'] for e in entries ], ["done", "done", "dead"])
+            self.assertEqual([ e['attempts'] for e in entries ], [1, 3, 1])
+            self.assertFalse(os.path.exists(entries[0]['package']))
+            self.assertTrue(os.path.isfile(entries[2]['package']))
+            self.assertEqual(
+                read_deposit_status(self._cnfdir, entries[1]['token'])['collection_uri'],
+                collections[1])
+            # Dead-lettered deposits can be requeued
+            with SwitchStdout(StringIO.StringIO()):
+                with SwitchStderr(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, ["dip", "drain", "--requeue"])
+            self.assertEqual(status, diperrors.DIP_DEPOSITFAIL)
+            self.assertEqual(len(outbox.entries("dead")), 1)
+            self.assertEqual(len([ r for r in server.requests if r[1] == "/nocol" ]), 2)
+        return
+
+    def test_58_token_bucket(self):
+        clock = [100.0]
+        def sleep(t):
+            clock[0] += t
+        bucket = TokenBucket(10, clock=lambda: clock[0], sleep=sleep)
+        self.assertEqual(bucket.take(10), 0.0)
+        self.assertAlmostEqual(bucket.take(5), 0.5)
+        self.assertAlmostEqual(clock[0], 100.5)
+        # A request larger than the capacity waits for a full bucket
+        self.assertAlmostEqual(bucket.take(20), 1.0)
+        self.assertAlmostEqual(bucket.take(1), 1.1)
+        self.assertEqual(retry_after("2"), 2.0)
+        self.assertEqual(retry_after(None), 1.0)
+        self.assertEqual(retry_after("Fri, 31 Dec 1999 23:59:59 GMT"), 1.0)
+        return
+
+    def test_59_dip_deposit_throttle(self):
+        # Uploads to a throttled server are limited in concurrency and rate
+        dipdir = self.create_populate_tst_dip("testdip")
+        with SwordServer() as server:
+            collections = [ server.uri("/col/%d"%i) for i in range(3) ]
+            for c in collections:
+                argvconfig = ["dip", "config", "--collection_uri=%s"%(c)]
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvconfig)
+                self.assertEqual(status, diperrors.DIP_SUCCESS)
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, ["dip", "package", "--dip", "testdip"])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            pkgsize = os.path.getsize(dippackage.package_filename(dipdir))
+            config  = readconfig(self._cnfdir)
+            config['throttle'] = (
+                { "%s:%d"%server.server_address:
+                    { "max_uploads": 1, "bytes_per_second": pkgsize*2 }
+                })
+            writeconfig(self._cnfdir, config)
+            argvdeposit = (
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ] +
+                [ "--collection_uri=%s"%(c) for c in collections ]
+                )
+            start = time.time()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(StringIO.StringIO()):
+                    status = runCommand(self._cnfdir, self._dipdir, argvdeposit)
+            elapsed = time.time() - start
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertEqual(len(server.containers), 3)
+            self.assertEqual(server.max_active, 1)
+            # 3 packages at 2 packages per second, starting with a full bucket
+            self.assertGreaterEqual(elapsed, 0.45)
+        return
+
+    def test_60_dip_update(self):
+        # Deposit a DIP, change it, then send only the changes to the container
+        dipdir   = self.create_tst_dip("testdip")
+        newfiles = self.dpath("newfiles")
+        os.makedirs(newfiles)
+        for f in ["new1.txt", "new2.txt", "new3.txt"]:
+            with open(os.path.join(newfiles, f), "w") as nf:
+                nf.write("%s\n"%f)
+        def run(argv):
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argv)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            return outstr.getvalue()
+        def server_file(files, f):
+            names = [ n for n in files if n.endswith("/newfiles/"+f) ]
+            return names and files[names[0]]
+        run(["dip", "add-files", newfiles])
+        with SwordServer() as server:
+            collection = server.uri("/col")
+            run(["dip", "config", "--collection_uri=%s"%(collection)])
+            result = run(
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(collection)
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ])
+            self.assertEqual(result, "token=token1\n")
+            files = server.files["1"]
+            self.assertEqual(server_file(files, "new3.txt"), "new3.txt\n")
+            # Change, add and remove files
+            with open(os.path.join(newfiles, "new2.txt"), "a") as nf:
+                nf.write("changed\n")
+            with open(os.path.join(newfiles, "new4.txt"), "w") as nf:
+                nf.write("new4.txt\n")
+            run(["dip", "add-files", os.path.join(newfiles, "new4.txt")])
+            run(["dip", "remove-file", os.path.join(newfiles, "new3.txt")])
+            del server.requests[:]
+            result = run(["dip", "update", "--token=token1"])
+            m = re.match(r"^token=token1 added=1 changed=1 removed=1 bytes=(\d+)$", result.strip())
+            self.assertTrue(m, result)
+            self.assertEqual(server_file(files, "new1.txt"), "new1.txt\n")
+            self.assertEqual(server_file(files, "new2.txt"), "new2.txt\nchanged\n")
+            self.assertEqual(server_file(files, "new4.txt"), "new4.txt\n")
+            self.assertFalse(server_file(files, "new3.txt"))
+            # Only the changes were sent, to the existing container
+            posts = [ r[1] for r in server.requests if r[0] == "POST" ]
+            self.assertEqual(posts, ["/em/1"])
+            (filename, body) = server.containers["1"][-1]
+            self.assertEqual(len(body), int(m.group(1)))
+            names = zipfile.ZipFile(StringIO.StringIO(body)).namelist()
+            self.assertEqual(sorted( n.split("/")[-1] for n in names ), ["new2.txt", "new4.txt"])
+            self.assertEqual([ r[0] for r in server.requests if r[0] == "DELETE" ], ["DELETE"])
+            # Nothing more to send
+            del server.requests[:]
+            result = run(["dip", "update", "--token=token1"])
+            self.assertEqual(result, "token=token1 added=0 changed=0 removed=0 bytes=0\n")
+            self.assertEqual(server.requests, [])
+        return
+
+    def test_61_dip_startup_time(self):
+        # Commands that only use the configuration start without loading
+        # the dip and SWORD libraries, within the time budget
+        srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for argv in [["dip", "--version"], ["dip", "config"]]:
+            script = STARTUP_SCRIPT%(
+                { 'srcdir': srcdir, 'configbase': self._cnfdir, 'filebase': self._dipdir
+                , 'argv': argv
+                })
+            output = subprocess.check_output([sys.executable, "-c", script], stderr=subprocess.STDOUT)
+            result = json.loads(output.splitlines()[-1])
+            self.assertEqual(result['status'], diperrors.DIP_SUCCESS)
+            self.assertEqual([ m for m in HEAVY_MODULES if m in result['modules'] ], [])
+            self.assertLess(result['elapsed'], STARTUP_BUDGET, " ".join(argv))
+        # The deposit outbox is loaded only for deferred deposits
+        script = STARTUP_SCRIPT%(
+            { 'srcdir': srcdir, 'configbase': self._cnfdir, 'filebase': self._dipdir
+            , 'argv': ["dip", "deposit"]
+            })
+        output = subprocess.check_output([sys.executable, "-c", script], stderr=subprocess.STDOUT)
+        result = json.loads(output.splitlines()[-1])
+        self.assertNotIn("dipcmd.dipoutbox", result['modules'])
+        return
+
+    def test_62_dip_serve(self):
+        # Commands sent to a dip serve process are run there, in the client's
+        # current directory; with no server running, the client runs them
+        dipdir   = self.create_populate_tst_dip("testdip")
+        sockname = serve_socket(self._cnfdir)
+        self.assertIsNone(run_in_server(self._cnfdir, ["dip", "show"]))
+        server = threading.Thread(target=dip_serve, args=(self._cnfdir,))
+        with SwitchStdout(StringIO.StringIO()):
+            server.start()
+            while not os.path.exists(sockname):
+                time.sleep(0.01)
+        try:
+            outstr = StringIO.StringIO()
+            with SwitchStdout(outstr):
+                status = run_in_server(self._cnfdir, ["dip", "show"])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertIn("Deposit information package at %s"%dipdir, outstr.getvalue())
+            self.assertIn(" %s"%self.fpath("files/file1.txt"), outstr.getvalue())
+            # DIP objects are kept between commands
+            self.assertIs(open_dip(dipdir), open_dip(dipdir))
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    status = run_in_server(self._cnfdir, ["dip", "remove-file", "files/file1.txt"])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertIn("  %s"%self.fpath("files/file1.txt"), outstr.getvalue())
+            self.assertFilesInDip(filesabsent=["files/file1.txt"], filespresent=["files/file2.txt"])
+            # Error output is returned to the client
+            errstr = StringIO.StringIO()
+            with SwitchStderr(errstr):
+                status = run_in_server(self._cnfdir, ["dip", "use", "--dip", "nosuchdip"])
+                self.assertEqual(dip_serve(self._cnfdir), diperrors.DIP_SERVING)
+            self.assertEqual(status, diperrors.DIP_NOTEXISTS)
+            self.assertIn("Specified directory does not exist", errstr.getvalue())
+            self.assertIn("dip serve is already running", errstr.getvalue())
+            # Invalid requests and unusable directories do not stop the server
+            response = server_request(self._cnfdir, { 'argv': ["dip", "show"], 'cwd': "/nonexistent/dir" })
+            self.assertEqual(response['status'], diperrors.DIP_CMDFAIL)
+            self.assertIn("Cannot use directory /nonexistent/dir", response['stderr'])
+            for request in [{ 'cwd': BASE_DIR }, { 'argv': "dip show", 'cwd': BASE_DIR }, ["dip"]]:
+                response = server_request(self._cnfdir, request)
+                self.assertEqual(response['status'], diperrors.DIP_CMDFAIL)
+                self.assertIn("Invalid dip serve request", response['stderr'])
+            self.assertTrue(server.is_alive())
+            outstr = StringIO.StringIO()
+            with SwitchStdout(outstr):
+                status = run_in_server(self._cnfdir, ["dip", "show"])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            # Debug logging is enabled only for the command that requests it
+            rootlogger = logging.getLogger()
+            (level, handlers) = (rootlogger.level, list(rootlogger.handlers))
+            errstr = StringIO.StringIO()
+            with SwitchStdout(StringIO.StringIO()), SwitchStderr(errstr):
+                status = run_in_server(self._cnfdir, ["dip", "--debug", "show"])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertEqual((rootlogger.level, rootlogger.handlers), (level, handlers))
+            # Long-running commands are run by the client
+            for argv in [["dip", "status", "--watch"], ["dip", "drain"], ["dip", "deposit-all"]]:
+                self.assertIsNone(run_in_server(self._cnfdir, argv))
+        finally:
+            self.assertEqual(dip_serve_stop(self._cnfdir), diperrors.DIP_SUCCESS)
+            server.join()
+        self.assertFalse(os.path.exists(sockname))
+        self.assertIsNone(run_in_server(self._cnfdir, ["dip", "show"]))
+        return
+
+    def test_63_dip_session(self):
+        # Operations through the Python interface return results and write
+        # nothing to stdout
+        outstr = StringIO.StringIO()
+        with SwitchStdout(outstr):
+            session = DipSession(self._cnfdir, self._dipdir)
+            with session:
+                dipdir = session.create("testdip")
+                self.assertEqual(dipdir, self.dpath("testdip"))
+                added  = session.add_files([self.fpath("files")], recursive=True)
+                self.assertIn(self.fpath("files/file1.txt"), added)
+                self.assertEqual(session.add_files([self.fpath("files/file1.txt")]), [])
+                removed = session.remove_files([self.fpath("files/file2.txt")])
+                self.assertEqual(removed, [self.fpath("files/file2.txt")])
+            self.assertEqual(dip_get_default_dir(self._cnfdir), dipdir)
+            contents = session.show()
+            self.assertEqual(contents.dipdir, dipdir)
+            paths = session.files()
+            self.assertEqual(sorted(paths), sorted( f.path for f in contents.files ))
+            self.assertIn(self.fpath("files/file1.txt"), paths)
+            self.assertNotIn(self.fpath("files/file2.txt"), paths)
+            package = session.package()
+            self.assertTrue(zipfile.is_zipfile(package))
+            with SwordServer() as server:
+                collection = server.uri("/col")
+                with self.assertRaises(DipError) as cm:
+                    session.deposit(collection)
+                self.assertEqual(cm.exception.status, diperrors.DIP_UNKNOWNCOLL)
+                session.configure_collection(
+                    collection, servicedoc_uri=server.uri("/sd"), username="user", password="pass"
+                    )
+                # Details given replace those configured, as for the dip command
+                ss = session.service(collection, username="other")
+                self.assertEqual(ss, SwordService(
+                    collection_uri=collection, servicedoc_uri=server.uri("/sd"),
+                    username="other", password="pass"
+                    ))
+                token = session.deposit(collection)
+                self.assertEqual(token, "token1")
+                self.assertEqual(len(server.containers), 1)
+                # Other packaging formats are deposited as requested
+                binary = server.uri("/colbinary")
+                session.configure_collection(
+                    binary, servicedoc_uri=server.uri("/sd"), username="user", password="pass"
+                    )
+                with self.assertRaises(DipError) as cm:
+                    session.deposit(binary)
+                self.assertEqual(cm.exception.status, diperrors.DIP_BADPACKAGING)
+                token2 = session.deposit(binary, package=package, format=BINARY)
+                self.assertEqual(token2, "token2")
+                self.assertEqual(server.requests[-1][2]['packaging'], BINARY)
+            # A dropped connection is reported as a DipError
+            with SwordServer(fail=lambda path, headers: path == "/col") as server:
+                failing = server.uri("/col")
+                session.configure_collection(
+                    failing, servicedoc_uri=server.uri("/sd"), username="user", password="pass"
+                    )
+                with self.assertRaises(DipError) as cm:
+                    session.deposit(failing)
+                self.assertEqual(cm.exception.status, diperrors.DIP_INTERRUPTED)
+            with self.assertRaises(DipError) as cm:
+                session.create("testdip")
+            self.assertEqual(cm.exception.status, diperrors.DIP_EXISTS)
+            status = session.status(token)
+            self.assertEqual(status['collection_uri'], collection)
+            self.assertEqual(status['dipdir'], dipdir)
+            with self.assertRaises(DipError) as cm:
+                session.status("nosuchtoken")
+            self.assertEqual(cm.exception.status, diperrors.DIP_UNKNOWNTOKEN)
+            with self.assertRaises(DipError) as cm:
+                session.use("nosuchdip")
+            self.assertEqual(cm.exception.status, diperrors.DIP_NOTEXISTS)
+            self.assertEqual(session.remove("testdip"), dipdir)
+            self.assertFalse(os.path.exists(dipdir))
+        self.assertEqual(outstr.getvalue(), "")
+        return
+
+    def test_64_benchmark(self):
+        # The benchmark runs each stage for each tree, and records results
+        workdir = self.dpath("bench")
+        results = benchmark_dip.run_benchmark(
+            workdir, sizes=[20], shapes=benchmark_dip.SHAPES, huge_files=1, huge_mb=1
+            )
+        self.assertEqual(results['benchmark'], "dip")
+        stages  = [ (r['shape'], r['files'], r['stage']) for r in results['results'] ]
+        self.assertEqual(stages,
+            [ (shape, 1 if shape == "huge" else 20, stage)
+              for shape in benchmark_dip.SHAPES for stage in benchmark_dip.STAGES
+            ])
+        for r in results['results']:
+            self.assertEqual(r['status'], diperrors.DIP_SUCCESS, r)
+            self.assertGreater(r['seconds'], 0)
+            self.assertGreater(r['max_rss_kb'], 0)
+        self.assertEqual(results['results'][0]['bytes'], 20*benchmark_dip.FILESIZE)
+        # Each tree has the requested number of files, and is reused
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(workdir, "trees", "deep-20")):
+            self.assertLessEqual(len(filenames), benchmark_dip.DEEPFILES)
+        self.assertEqual(
+            sum( len(f) for (d, s, f) in os.walk(os.path.join(workdir, "trees", "tiny-20")) ), 20
+            )
+        self.assertEqual(benchmark_dip.make_tree(workdir, "tiny", 20)[2], results['results'][8]['bytes'])
+        return
+
+    def test_65_sword_server_conditions(self):
+        # The bundled SWORD server simulates latency, limited bandwidth and
+        # failed deposits
+        def request(server, method, path, body=None, headers={}):
+            conn = httplib.HTTPConnection(server.server_address[0], server.server_address[1])
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                return (resp.status, resp.read())
+            finally:
+                conn.close()
+        body    = "x"*200000
+        headers = { 'Content-Disposition': "attachment; filename=data.bin" }
+        with SwordServer(latency=0.2) as server:
+            start = time.time()
+            self.assertEqual(request(server, "GET", "/sd")[0], 200)
+            self.assertGreaterEqual(time.time()-start, 0.2)
+        with SwordServer(bandwidth=100000, keep_content=False) as server:
+            start = time.time()
+            self.assertEqual(request(server, "POST", "/col", body, headers)[0], 201)
+            # The first second's worth of data is sent at once
+            self.assertGreaterEqual(time.time()-start, 0.9)
+            self.assertEqual(server.received, len(body))
+            self.assertEqual(server.containers["1"], [("data.bin", "")])
+        # Without kept content or request records, SimpleZip packages are
+        # still unpacked, from a temporary file
+        zipdata = StringIO.StringIO()
+        z = zipfile.ZipFile(zipdata, "w")
+        z.writestr("a.txt", "a"*1000)
+        z.writestr("sub/b.txt", "b"*1000)
+        z.close()
+        zipheaders = dict(headers, Packaging="http://purl.org/net/sword/package/SimpleZip")
+        with SwordServer(keep_content=False, record_requests=False) as server:
+            self.assertEqual(request(server, "POST", "/col", zipdata.getvalue(), zipheaders)[0], 201)
+            self.assertEqual(request(server, "POST", "/em/1", body, headers)[0], 201)
+            self.assertEqual(server.files["1"], {"a.txt": "", "sub/b.txt": ""})
+            self.assertEqual(server.containers["1"], [("data.bin", ""), ("data.bin", "")])
+            self.assertEqual(server.received, len(zipdata.getvalue())+len(body))
+            self.assertEqual(server.requests, [])
+        with SwordServer(fail_rate=1.0, fail_status=503) as server:
+            self.assertEqual(request(server, "POST", "/col", body, headers)[0], 503)
+            self.assertEqual(request(server, "GET", "/sd")[0], 200)
+            self.assertEqual(server.containers, {})
+        with SwordServer(fail_rate=0.5, seed=1) as server:
+            for i in range(20):
+                try:
+                    request(server, "POST", "/col", "x", headers)
+                except (httplib.HTTPException, socket.error):
+                    pass
+            self.assertTrue(0 < len(server.containers) < 20)
+        return
+
+    def test_66_dip_update_remove_same_name(self):
+        # Removing a file deletes only that file from the container, not a
+        # file with the same name in a subdirectory
+        self.create_tst_dip("testdip")
+        newfiles = self.dpath("newfiles")
+        os.makedirs(os.path.join(newfiles, "sub"))
+        for f in ["b.txt", "sub/b.txt"]:
+            with open(os.path.join(newfiles, f), "w") as nf:
+                nf.write("%s\n"%f)
+        def run(argv):
+            outstr = StringIO.StringIO()
+            with ChangeCurrentDir(newfiles):
+                with SwitchStdout(outstr):
+                    status = runCommand(self._cnfdir, self._dipdir, argv)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            return outstr.getvalue()
+        run(["dip", "--recursive", "add-files", newfiles])
+        with SwordServer() as server:
+            collection = server.uri("/col")
+            run(["dip", "config", "--collection_uri=%s"%(collection)])
+            result = run(
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(collection)
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ])
+            self.assertEqual(result, "token=token1\n")
+            files = server.files["1"]
+            self.assertEqual(sorted(f for f in files if f.endswith("b.txt")), ["b.txt", "sub/b.txt"])
+            # Try both orders of the statement's entries
+            for name in ["b.txt", "sub/b.txt"]:
+                run(["dip", "remove-file", os.path.join(newfiles, name)])
+                result = run(["dip", "update", "--token=token1"])
+                self.assertEqual(result, "token=token1 added=0 changed=0 removed=1 bytes=0\n")
+                self.assertNotIn(name, files)
+                deleted = [ r[1] for r in server.requests if r[0] == "DELETE" ]
+                self.assertEqual(deleted[-1], "/cont/1/%s"%(name))
+                run(["dip", "add-files", os.path.join(newfiles, name)])
+                run(["dip", "update", "--token=token1"])
+                self.assertIn(name, files)
+        return
+
+    def test_67_dip_checksum_unreadable(self):
+        dipdir = self.create_populate_tst_dip("testdip")
+        file1path = self.fpath("files/file1.txt")
+        builtin_open = __builtin__.open
+        def unreadable_open(name, *args):
+            if os.path.abspath(name) == file1path:
+                raise IOError(errno.EACCES, "Permission denied", name)
+            return builtin_open(name, *args)
+        for jobs in ["1", "2"]:
+            argv   = ["dip", "checksum", "--jobs", jobs]
+            outstr = StringIO.StringIO()
+            errstr = StringIO.StringIO()
+            __builtin__.open = unreadable_open
+            try:
+                with SwitchStdout(outstr):
+                    with SwitchStderr(errstr):
+                        status = runCommand(self._cnfdir, self._dipdir, argv)
+            finally:
+                __builtin__.open = builtin_open
+            self.assertEqual(status, diperrors.DIP_FILEMISSING)
+            self.assertIn("Cannot read file for checksum: %s"%(file1path), errstr.getvalue())
+            self.assertNotIn(file1path, outstr.getvalue())
+            self.assertEqual(len(outstr.getvalue().splitlines()), 7)
+            with open(os.path.join(dipdir, "checksums.json")) as f:
+                self.assertNotIn(file1path, json.load(f))
+        return
+
+    def test_68_dip_add_files_concurrent(self):
+        # Concurrent updates of a DIP keep each other's file index entries
+        dipdir = self.create_tst_dip("testdip")
+        newfiles = self.dpath("newfiles")
+        os.makedirs(newfiles)
+        names = [ "new%d.txt"%i for i in range(8) ]
+        for f in names:
+            with open(os.path.join(newfiles, f), "w") as nf:
+                nf.write("%s\n"%f)
+        def add(name):
+            add_dip_files(dipdir, [os.path.join(newfiles, name)])
+        threads = [ threading.Thread(target=add, args=(f,)) for f in names ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with open(os.path.join(dipdir, "file_index.json")) as f:
+            index = json.load(f)
+        self.assertEqual(
+            sorted(index), sorted( os.path.join(newfiles, f) for f in names )
+            )
+        self.assertEqual(
+            sorted( df.path for df in open_dip(dipdir).get_files() ),
+            sorted( os.path.join(newfiles, f) for f in names )
+            )
+        self.assertEqual(
+            [ f for f in os.listdir(dipdir) if f.endswith(".tmp") or f.endswith(".journal") ], []
+            )
+        self.assertNotIn("open", sys.modules[DIP.__module__].__dict__)
+        return
+
+    def test_69_dip_status_watch_incomplete(self):
+        # Watching stops at the timeout, or after repeated failed polls
+        dipdir = self.create_populate_tst_dip("testdip")
+        def run(argv):
+            outstr = StringIO.StringIO()
+            errstr = StringIO.StringIO()
+            with ChangeCurrentDir(BASE_DIR):
+                with SwitchStdout(outstr):
+                    with SwitchStderr(errstr):
+                        status = runCommand(self._cnfdir, self._dipdir, argv)
+            return (status, outstr.getvalue(), errstr.getvalue())
+        argvwatch = ["dip", "status", "--watch", "--poll_interval=0.01", "--token=token1"]
+        with SwordServer() as server:
+            collection = server.uri("/col")
+            (status, out, err) = run(["dip", "config", "--collection_uri=%s"%(collection)])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            (status, out, err) = run(
+                [ "dip", "deposit", "--dip", "testdip"
+                , "--collection_uri=%s"%(collection)
+                , "--servicedoc_uri=%s"%(server.uri("/sd"))
+                , "--username=user", "--password=pass"
+                ])
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            server.states["1"] = [INPROGRESS]
+            start = time.time()
+            (status, out, err) = run(argvwatch+["--timeout=0.5"])
+            self.assertEqual(status, diperrors.DIP_WATCHINCOMPLETE)
+            self.assertLess(time.time()-start, 5)
+            self.assertIn("token=token1 state=inProgress", out)
+            self.assertIn("Timed out watching deposits: token1", err)
+            # A repository's own name for a final state ends watching
+            server.states["1"] = ["http://eprints.example.org/eprint_status/archive"]
+            (status, out, err) = run(argvwatch)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertIn("token=token1 state=archive", out)
+            write_deposit_status(
+                self._cnfdir, "token1", dict(read_deposit_status(self._cnfdir, "token1"), states=None)
+                )
+        # The server is no longer available
+        (status, out, err) = run(argvwatch)
+        self.assertEqual(status, diperrors.DIP_WATCHINCOMPLETE)
+        self.assertIn("Stopped watching deposit token1 after 5 failed polls", err)
+        return
+
+    def test_70_dip_deposit_receipt_without_id(self):
+        # A deposit whose receipt has no id fails, rather than raising an exception
+        dipdir = self.create_populate_tst_dip("testdip")
+        deposit_package  = dipdeposit.deposit_package
+        deposit_segments = dipdeposit.deposit_segments
+        def without_id(deposit):
+            def deposit_without_id(*args, **kwargs):
+                dr = deposit(*args, **kwargs)
+                dr.id = None
+                return dr
+            return deposit_without_id
+        with SwordServer() as server:
+            def deposit(segment_size=None):
+                errstr = StringIO.StringIO()
+                with ChangeCurrentDir(BASE_DIR):
+                    with SwitchStdout(StringIO.StringIO()), SwitchStderr(errstr):
+                        status = dip_deposit(
+                            self._cnfdir, dipdir,
+                            collection_uri=server.uri("/col"), servicedoc_uri=server.uri("/sd"),
+                            username="user", password="pass", basedir=BASE_DIR,
+                            segment_size=segment_size
+                            )
+                return (status, errstr.getvalue())
+            dipdeposit.deposit_package  = without_id(deposit_package)
+            dipdeposit.deposit_segments = without_id(deposit_segments)
+            try:
+                (status, result) = deposit()
+                self.assertEqual(status, diperrors.DIP_DEPOSITFAIL)
+                self.assertIn("SWORD deposit receipt has no usable id (status 201)", result)
+                (status, result) = deposit(segment_size=256)
+                self.assertEqual(status, diperrors.DIP_DEPOSITFAIL)
+                self.assertIn("run the deposit again to retry", result)
+            finally:
+                dipdeposit.deposit_package  = deposit_package
+                dipdeposit.deposit_segments = deposit_segments
+            self.assertEqual(read_deposit_status(self._cnfdir, "token1"), None)
+            # The checkpoint is kept, and the next attempt completes the deposit
+            package = dippackage.package_filename(dipdir, dippackage.SIMPLEZIP)
+            cpname  = checkpoint_filename(self._cnfdir, server.uri("/col"), package)
+            self.assertTrue(os.path.exists(cpname))
+            (status, result) = deposit(segment_size=256)
+            self.assertEqual(status, diperrors.DIP_SUCCESS)
+            self.assertFalse(os.path.exists(cpname))
         return
 
 if __name__ == "__main__":